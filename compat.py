@@ -0,0 +1,57 @@
+"""Helpers for running the same code under Python 2.7 and Python 3.
+
+Notes are read and matched as bytes under both versions, so multi-GB exports
+are never decoded as a whole. Text is only decoded when it is written out, as
+CSV, JSON or printed contexts. UTF-8 with surrogateescape is used in both
+directions, so bytes that are not valid UTF-8 pass through unchanged.
+"""
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    import cPickle as pickle
+    string_types = basestring
+    xrange = xrange
+else:
+    import pickle
+    string_types = str
+    xrange = range
+
+ENCODING = 'utf-8'
+ENCODING_ERRORS = 'surrogateescape'
+
+
+def to_bytes(value):
+    """Return value as bytes, encoding text with ENCODING."""
+    if isinstance(value, bytes):
+        return value
+    return value.encode(ENCODING, ENCODING_ERRORS if not PY2 else 'strict')
+
+
+def to_str(value):
+    """Return value as the native str type, decoding bytes under Python 3.
+
+    Other values, including None, are returned unchanged.
+    """
+    if PY2 or not isinstance(value, bytes):
+        return value
+    return value.decode(ENCODING, ENCODING_ERRORS)
+
+
+def to_display_str(value):
+    """Return value as the native str type for printing. Under Python 3,
+    bytes that are not valid UTF-8 are replaced, since the console may not
+    accept the surrogates to_str leaves for them."""
+    if PY2 or not isinstance(value, bytes):
+        return value
+    return value.decode(ENCODING, 'replace')
+
+
+def open_csv(filename, mode='r', buffering=-1):
+    """Open filename for the csv module, which takes binary files under
+    Python 2 and text files under Python 3."""
+    if PY2:
+        return open(filename, mode + 'b', buffering)
+    return open(filename, mode, buffering, encoding=ENCODING,
+                errors=ENCODING_ERRORS, newline='')
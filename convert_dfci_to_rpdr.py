@@ -1,7 +1,26 @@
 """Convert DFCI formatted files into the relevant fields of RPDR formatted
 files for use with train_crf and get_cohort"""
+from __future__ import print_function
+
 import argparse
 import csv
+import operator
+
+import compat
+import profiling
+
+RPDR_COLUMN_NAMES = ['EMPI', 'MRN', 'MRN_Type', 'Report_Number',
+                     'Report_Description', 'Report_Type', 'LMRNote_Date',
+                     'Comments']
+
+# DFCI columns read by convert_notes, in the order iterate_dfci_notes yields
+# them.
+DFCI_COLUMN_NAMES = ['#PATIENT_ID', 'DFCI_MRN', 'NOTE_ID',
+                     'INPATIENT_NOTE_TYPE_DESCR', 'INPATIENT_NOTE_TYPE_CD',
+                     'DATE_OF_SERVICE', 'NOTE_TXT']
+
+# Size of the write buffer used for the output RPDR file.
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
 
 def date_name_converter(date):
@@ -17,61 +36,80 @@ def date_name_converter(date):
     return '%s-%s-%s' % (date_mm, date_dd, date_yy)
 
 
-def iterate_dfci_notes(fname):
+def iterate_dfci_notes(fname, column_names=DFCI_COLUMN_NAMES):
+    """Yield a tuple of the values of `column_names` for each DFCI row, as
+    bytes.
+
+    The positions of the requested columns are looked up once from the header
+    row, so no per-row dict is built.
+    """
     if fname[-3:].lower() != 'txt':
         raise Exception('Expected txt file for DFCI notes')
     num_wrong_size_row = 0
+    row_num = 0
     with open(fname, 'rb') as f:
         for row_num, row in enumerate(f):
             if row_num == 0:
-                header_row = row.split('|')
+                header_row = compat.to_str(row).split('|')
                 header_row = [header_row_e.replace('\n', '').replace('\r', '')
                               for header_row_e in header_row]
+                missing_columns = [column_name for column_name in column_names
+                                   if column_name not in header_row]
+                if missing_columns:
+                    raise Exception('DFCI header is missing columns: %s' %
+                                    str(missing_columns))
+                column_indices = [header_row.index(column_name)
+                                  for column_name in column_names]
+                if len(column_indices) == 1:
+                    get_columns = lambda row: (row[column_indices[0]],)
+                else:
+                    get_columns = operator.itemgetter(*column_indices)
                 continue
-            row = row.split('|')
+            row = row.split(b'|')
             if len(row) == len(header_row) - 1 and not header_row[-1]:
                 pass
             elif len(row) != len(header_row):
                 num_wrong_size_row += 1
                 continue
-            yield {header_row_e: row_e for header_row_e, row_e in
-                   zip(header_row, row)}
-    print 'Num wrong sized rows:', num_wrong_size_row
-    print 'Num rows:', row_num
+            yield get_columns(row)
+    print('Num wrong sized rows:', num_wrong_size_row)
+    print('Num rows:', row_num)
+
+
+def convert_dfci_row(dfci_row):
+    """Map a row yielded by iterate_dfci_notes to an RPDR row ordered as in
+    RPDR_COLUMN_NAMES. Return None if the row has no date of service."""
+    (patient_id, dfci_mrn, note_id, note_type_descr, note_type_cd,
+     lmr_note_date, note_txt) = dfci_row
+    if lmr_note_date == b'null' or not lmr_note_date:
+        return None
+    lmr_note_date = lmr_note_date.split(b' ')[0]  # remove time data
+    comments = b'\n' + note_txt + b'\n[report_end]'
+    empi = b'DFCI_PATIENT_ID_' + patient_id
+    mrn = b'DFCI_MRN_' + dfci_mrn
+    mrn_type = b'DFCI'
+    return [empi, mrn, mrn_type, note_id, note_type_descr, note_type_cd,
+            lmr_note_date, comments]
 
 
 def convert_notes(input_filename):
-    rows = [['EMPI', 'MRN', 'MRN_Type', 'Report_Number', 'Report_Description',
-             'Report_Type', 'LMRNote_Date', 'Comments']]
+    """Yield the RPDR header row followed by one RPDR row per DFCI note."""
+    yield RPDR_COLUMN_NAMES
     num_null_date = 0
-    for row_num, row in enumerate(iterate_dfci_notes(input_filename)):
-        patient_id = row['DFCI_MRN']
-        mrn = 'DFCI_MRN_' + str(patient_id)
-        lmr_note_date = row['DATE_OF_SERVICE']
-        if lmr_note_date == 'null' or not lmr_note_date:
+    for dfci_row in iterate_dfci_notes(input_filename):
+        rpdr_row = convert_dfci_row(dfci_row)
+        if rpdr_row is None:
             num_null_date += 1
             continue
-        lmr_note_date = lmr_note_date.split(' ')[0]  # remove time data
-        if 'NOTE_TXT' not in row:
-            print row.keys()
-            raise
-        comments = '\n' + row['NOTE_TXT'] + '\n[report_end]'
-        empi = 'DFCI_PATIENT_ID_' + row['#PATIENT_ID']
-        mrn_type = 'DFCI'
-        report_number = row['NOTE_ID']
-        report_description = row['INPATIENT_NOTE_TYPE_DESCR']
-        report_type = row['INPATIENT_NOTE_TYPE_CD']
-        rows.append([empi, mrn, mrn_type, report_number, report_description,
-                     report_type, lmr_note_date, comments])
-    print 'Num notes file null date rows:', num_null_date
-    return rows
+        yield rpdr_row
+    print('Num notes file null date rows:', num_null_date)
 
 
 def main(input_filename, output_filename):
-    lno_rows = convert_notes(input_filename)
-    with open(output_filename, 'wb') as f:
+    with compat.open_csv(output_filename, 'w', OUTPUT_BUFFER_SIZE) as f:
         csv_writer = csv.writer(f, delimiter='|')
-        csv_writer.writerows(lno_rows)
+        for lno_row in convert_notes(input_filename):
+            csv_writer.writerow([compat.to_str(value) for value in lno_row])
 
 
 if __name__ == '__main__':
@@ -82,5 +120,8 @@ if __name__ == '__main__':
     parser.add_argument('output_filename',
                         help=('Path to write an RPDR file at'
                               'text file, e.g. /Users/user1/../file.txt'))
+    profiling.add_profile_arguments(parser)
     args = parser.parse_args()
-    main(args.input_filename, args.output_filename)
+    profiling.run_profiled(args.profile, args.profile_dir,
+                           'convert_dfci_to_rpdr', main, args.input_filename,
+                           args.output_filename)
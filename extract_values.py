@@ -1,55 +1,283 @@
+from __future__ import print_function
+
 import argparse
+import array
+import collections
+import copy
 import csv
+import datetime
+import functools
+import glob
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+import os
+import random
 import re
 import string
+import time
 
-import numpy as np
+import compat
+import convert_dfci_to_rpdr
+import match_store
+import memory_budget as memory_budget_module
+import note_index
+import profiling
 
 PHRASE_TYPE_WORD = 0
 PHRASE_TYPE_NUM = 1
 PHRASE_TYPE_DATE = 2
 
+TURK_CSV_HEADER = ['image1', 'guess', 'empi', 'report_number']
+
+# Columns every RPDR header must have.
+RPDR_REQUIRED_COLUMN_NAMES = ['EMPI', 'MRN_Type', 'MRN']
+
+AGGREGATE_MODES = ['first', 'last', 'min', 'max', 'mean', 'count', 'all']
+
+# Formats tried, in order, when ordering notes by report date.
+REPORT_DATE_FORMATS = ['%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S',
+                       '%m/%d/%Y %H:%M', '%m/%d/%Y', '%Y-%m-%d %H:%M:%S',
+                       '%Y-%m-%d']
+
+# Formats tried, in order, when comparing dates extracted from notes.
+EXTRACTED_DATE_FORMATS = ['%m/%d/%Y', '%m/%d/%y', '%Y-%m-%d', '%m-%d-%Y',
+                          '%m-%d-%y']
+
+# Replaces text cut from notes shown for turk verification.
+TRUNCATED_TEXT_MARKER = b'\n[...]\n'
+
+# Notes are split into chunks for deduplicated matching between the two line
+# breaks of a blank line.
+PARAGRAPH_BREAK_RE = re.compile(br'\n(?=\r?\n)')
+NON_WHITESPACE_RE = re.compile(br'\S')
+# Text that can follow a phrase and the whitespace after it in a number or
+# date match: the start of "of", "is", "was", "were", "are", ":" or a value.
+VALUE_CONTINUATION_CHARACTERS = frozenset(
+    character.encode('ascii') for character in 'oOiIwWaA:0123456789')
+# Words of context shown around matches of sampled notes if none are given,
+# and the number of most frequent contexts shown.
+SAMPLE_CONTEXT_WORDS = 3
+SAMPLE_TOP_CONTEXTS = 20
+
+# Number of distinct note and paragraph texts whose matches are kept for
+# deduplicated matching.
+TEXT_MATCH_CACHE_SIZE = 100000
+
+# Number of phrase lists whose compiled patterns are kept, e.g. for the
+# queries of a long running extraction server.
+MAX_CACHED_PHRASE_PATTERNS = 64
+
 
 class RPDRNote(object):
     """Works for Lno, Dis, Rad, and Opn RPDR files."""
-    def __init__(self, rpdr_column_name_to_key, rpdr_note):
-        self.empi = rpdr_column_name_to_key['EMPI']
-        self.mrn_type = rpdr_column_name_to_key['MRN_Type']
-        self.mrn = rpdr_column_name_to_key['MRN']
-        self.report_type = (rpdr_column_name_to_key.get('Report_Type') or
-                            rpdr_column_name_to_key.get('Subject'))
+    __slots__ = ('note_id', 'empi', 'mrn_type', 'mrn', 'report_type',
+                 'report_number', 'report_description', 'report_date', 'note',
+                 'source_filename')
+
+    def __init__(self, rpdr_column_name_to_key, rpdr_note, note_id=None,
+                 source_filename=None):
+        # Position of the note in its file, as numbered by the NoteReader.
+        self.note_id = note_id
+        self.source_filename = source_filename
+        # Header values repeated across notes are interned so that notes
+        # share a single copy of each.
+        self.empi = _intern(rpdr_column_name_to_key['EMPI'])
+        self.mrn_type = _intern(rpdr_column_name_to_key['MRN_Type'])
+        self.mrn = _intern(rpdr_column_name_to_key['MRN'])
+        self.report_type = _intern(
+            rpdr_column_name_to_key.get('Report_Type') or
+            rpdr_column_name_to_key.get('Subject'))
         self.report_number = (rpdr_column_name_to_key.get('Report_Number') or
                               rpdr_column_name_to_key.get('Record_Id'))
-        self.report_description = rpdr_column_name_to_key.get(
-            'Report_Description')
-        self.report_date = (rpdr_column_name_to_key.get('Report_Date_Time') or
-                            rpdr_column_name_to_key.get('LMRNote_Date'))
+        self.report_description = _intern(rpdr_column_name_to_key.get(
+            'Report_Description'))
+        self.report_date = _intern(
+            rpdr_column_name_to_key.get('Report_Date_Time') or
+            rpdr_column_name_to_key.get('LMRNote_Date'))
         self.note = rpdr_note
 
     def get_keys(self):
         return [self.empi, self.mrn_type, self.mrn, self.report_type,
                 self.report_number, self.report_date]
 
+    def intern_keys(self):
+        """Intern the header values again, e.g. after unpickling."""
+        self.empi = _intern(self.empi)
+        self.mrn_type = _intern(self.mrn_type)
+        self.mrn = _intern(self.mrn)
+        self.report_type = _intern(self.report_type)
+        self.report_description = _intern(self.report_description)
+        self.report_date = _intern(self.report_date)
+        self.source_filename = _intern(self.source_filename)
+
     def remove_punctuation_from_note(self):
         self.note = _remove_punctuation(self.note)
 
+    def get_note_length(self):
+        return len(self.note)
+
+
+class PhraseMatchTable(object):
+    """Stores phrase matches as parallel arrays, one row per match, instead
+    of one PhraseMatch object per match.
+
+    Numerical values are stored in a float array. Other values are kept in a
+    list, where the 1s of phrase presence matches are all the same object.
+    """
+    __slots__ = ('note_indices', 'match_starts', 'match_ends', 'phrase_ids',
+                 'extracted_values', 'phrases', 'phrase_to_id', 'num_notes')
+
+    def __init__(self, phrase_type=None):
+        self.note_indices = array.array('l')
+        self.match_starts = array.array('l')
+        self.match_ends = array.array('l')
+        self.phrase_ids = array.array('l')
+        if phrase_type == PHRASE_TYPE_NUM:
+            self.extracted_values = array.array('d')
+        else:
+            self.extracted_values = []
+        self.phrases = []
+        self.phrase_to_id = {}
+        self.num_notes = 0
+
+    def add_note(self):
+        """Return the note index to use for the next note's matches."""
+        self.num_notes += 1
+        return self.num_notes - 1
+
+    def add_match(self, note_index, extracted_value, match_start, match_end,
+                  phrase):
+        if phrase not in self.phrase_to_id:
+            self.phrase_to_id[phrase] = len(self.phrases)
+            self.phrases.append(phrase)
+        self.note_indices.append(note_index)
+        self.match_starts.append(match_start)
+        self.match_ends.append(match_end)
+        self.phrase_ids.append(self.phrase_to_id[phrase])
+        self.extracted_values.append(extracted_value)
+
+    def __len__(self):
+        return len(self.note_indices)
+
+    def get_phrase_match(self, row):
+        return PhraseMatch(self.extracted_values[row], self.match_starts[row],
+                           self.match_ends[row],
+                           self.phrases[self.phrase_ids[row]])
+
+    def get_match(self, row):
+        """Return (match_start, match_end, phrase, extracted_value) for
+        row."""
+        return (self.match_starts[row], self.match_ends[row],
+                self.phrases[self.phrase_ids[row]],
+                self.extracted_values[row])
+
 
 class NotePhraseMatches(object):
-    """Describes all phrase matches for a particular RPDR Note"""
-    def __init__(self, rpdr_note):
+    """Describes all phrase matches for a particular RPDR Note
+
+    Matches are held in a list until finalize_phrase_matches, and then stored
+    as consecutive rows of match_table. phrase_matches builds a PhraseMatch
+    for every match, so code reading many notes uses num_matches,
+    get_first_match, get_matches or get_extracted_values instead.
+    """
+    __slots__ = ('rpdr_note', 'match_table', 'note_index', 'first_row',
+                 'num_matches', 'pending_matches')
+
+    def __init__(self, rpdr_note, match_table=None):
         self.rpdr_note = rpdr_note
-        self.phrase_matches = []
+        if match_table is None:
+            match_table = PhraseMatchTable()
+        self.match_table = match_table
+        self.note_index = match_table.add_note()
+        self.first_row = 0
+        self.num_matches = 0
+        # (match_start, match_end, phrase, extracted_value) for each match
+        # until the matches are finalized.
+        self.pending_matches = []
+
+    @property
+    def phrase_matches(self):
+        """Return a read-only tuple of PhraseMatch objects, ordered by match
+        start once the matches are finalized. Matches are added with
+        add_match."""
+        return tuple(PhraseMatch(extracted_value, match_start, match_end,
+                                 phrase)
+                     for match_start, match_end, phrase, extracted_value
+                     in self.get_matches())
+
+    def get_matches(self):
+        """Return a list of (match_start, match_end, phrase, extracted_value)
+        for each match, in the order of phrase_matches."""
+        if self.pending_matches is not None:
+            return list(self.pending_matches)
+        return [self.match_table.get_match(row) for row in
+                compat.xrange(self.first_row,
+                              self.first_row + self.num_matches)]
+
+    def get_first_match(self):
+        """Return the first PhraseMatch of phrase_matches, or None if there
+        are no matches."""
+        if not self.num_matches:
+            return None
+        if self.pending_matches is not None:
+            match_start, match_end, phrase, extracted_value = (
+                self.pending_matches[0])
+            return PhraseMatch(extracted_value, match_start, match_end,
+                               phrase)
+        return self.match_table.get_phrase_match(self.first_row)
+
+    def get_extracted_values(self):
+        """Return a list of the extracted value of each match, in the order
+        of phrase_matches."""
+        if self.pending_matches is not None:
+            return [extracted_value for _, _, _, extracted_value in
+                    self.pending_matches]
+        return list(self.match_table.extracted_values[
+            self.first_row:self.first_row + self.num_matches])
+
+    def add_match(self, extracted_value, match_start, match_end, phrase):
+        self.pending_matches.append(
+            (match_start, match_end, phrase, extracted_value))
+        self.num_matches += 1
 
     def add_phrase_match(self, phrase_match):
-        self.phrase_matches.append(phrase_match)
+        self.add_match(phrase_match.extracted_value, phrase_match.match_start,
+                       phrase_match.match_end, phrase_match.phrase)
+
+    def __getstate__(self):
+        """Pickle only this note's matches rather than the whole table."""
+        return (self.rpdr_note, self.get_matches(),
+                self.pending_matches is None)
+
+    def __setstate__(self, state):
+        rpdr_note, matches, finalized = state
+        self.__init__(rpdr_note)
+        self.pending_matches = matches
+        self.num_matches = len(matches)
+        if finalized:
+            self.finalize_phrase_matches()
 
     def finalize_phrase_matches(self):
-        self.phrase_matches.sort(key=lambda x: x.match_start)
+        self.pending_matches.sort(key=lambda x: x[0])
+        self.first_row = len(self.match_table)
+        self.num_matches = len(self.pending_matches)
+        for match_start, match_end, phrase, extracted_value in (
+                self.pending_matches):
+            self.match_table.add_match(self.note_index, extracted_value,
+                                       match_start, match_end, phrase)
+        self.pending_matches = None
 
 
 class PhraseMatch(object):
     """Describes a single phrase match to a single RPDR Note for a phrase."""
+    __slots__ = ('extracted_value', 'match_start', 'match_end', 'phrase')
+
     def __init__(self, extracted_value, match_start, match_end, phrase):
         # Binary 0/1s for extracting phrase presence, else numerical value.
         self.extracted_value = extracted_value
@@ -69,97 +297,662 @@ class PhraseMatchContexts(object):
         if self.n_words_before == 0 and self.n_words_after == 0:
             return
         match_word = note[match_start:match_end]
-        words_before = note[:match_start].split(' ')[-self.n_words_before:]
-        words_after = note[match_end:].split(' ')[:self.n_words_after]
-        context = ' '.join(words_before + [match_word] + words_after)
+        words_before = note[:match_start].split(b' ')[-self.n_words_before:]
+        words_after = note[match_end:].split(b' ')[:self.n_words_after]
+        context = b' '.join(words_before + [match_word] + words_after)
         self.context_frequencies.setdefault(context, 0)
         self.context_frequencies[context] += 1
 
-    def print_ordered_contexts(self):
-        if self.n_words_before == 0 and self.n_words_after == 0:
-            return
+    def get_ordered_contexts(self):
+        """Return (context, frequency) tuples, most frequent first."""
         context_tuples = [(context, frequency) for context, frequency in
-                          self.context_frequencies.iteritems()]
+                          self.context_frequencies.items()]
         context_tuples.sort(key=lambda x: x[1], reverse=True)
-        print 'Frequency: context'
-        for context, frequency in context_tuples:
-            print '%d: %s' % (frequency, context)
+        return context_tuples
+
+    def print_ordered_contexts(self, max_contexts=None):
+        if self.n_words_before == 0 and self.n_words_after == 0:
+            return
+        print('Frequency: context')
+        for context, frequency in self.get_ordered_contexts()[:max_contexts]:
+            print('%d: %s' % (frequency, compat.to_display_str(context)))
+
+
+class PatientAggregate(object):
+    """Running aggregate of the values extracted from one patient's notes."""
+    def __init__(self, rpdr_note, note_key):
+        # Output keys are taken from the patient's earliest note.
+        self.keys = rpdr_note.get_keys()
+        self.source_filename = rpdr_note.source_filename
+        self.keys_note_key = note_key
+        self.first_note_key = None
+        self.first_value = None
+        self.last_note_key = None
+        self.last_value = None
+        self.min_key = None
+        self.min_value = None
+        self.max_key = None
+        self.max_value = None
+        self.total = 0
+        self.count = 0
+        self.note_values = []  # (note_key, values), only for all
+
+    def add_note_values(self, rpdr_note, note_key, values, aggregate,
+                        value_key):
+        if note_key < self.keys_note_key:
+            self.keys = rpdr_note.get_keys()
+            self.source_filename = rpdr_note.source_filename
+            self.keys_note_key = note_key
+        if not values:
+            return
+        if self.first_note_key is None or note_key < self.first_note_key:
+            self.first_note_key = note_key
+            self.first_value = values[0]
+        if self.last_note_key is None or note_key > self.last_note_key:
+            self.last_note_key = note_key
+            self.last_value = values[-1]
+        if aggregate in ('min', 'max'):
+            self._add_min_max_values(values, value_key)
+        elif aggregate == 'all':
+            self.note_values.append((note_key, values))
+        elif aggregate == 'mean':
+            self.total += sum(values)
+        self.count += len(values)
+
+    def _add_min_max_values(self, values, value_key):
+        """Update min_value and max_value, comparing values by value_key.
+        Values with a key of None are left out."""
+        keyed_values = [(value_key(value), value) for value in values]
+        keyed_values = [(key, value) for key, value in keyed_values
+                        if key is not None]
+        if not keyed_values:
+            return
+        note_min = min(keyed_values, key=lambda x: x[0])
+        note_max = max(keyed_values, key=lambda x: x[0])
+        if self.min_key is None or note_min[0] < self.min_key:
+            self.min_key, self.min_value = note_min
+        if self.max_key is None or note_max[0] > self.max_key:
+            self.max_key, self.max_value = note_max
+
+    def get_value(self, aggregate):
+        if aggregate == 'first':
+            return self.first_value
+        elif aggregate == 'last':
+            return self.last_value
+        elif aggregate == 'min':
+            return self.min_value
+        elif aggregate == 'max':
+            return self.max_value
+        elif aggregate == 'mean':
+            if not self.count:
+                return None
+            return float(self.total) / self.count
+        elif aggregate == 'count':
+            return self.count
+        elif aggregate == 'all':
+            self.note_values.sort(key=lambda x: x[0])
+            return ';'.join(str(compat.to_str(value))
+                            for _, values in self.note_values
+                            for value in values)
+        raise ValueError('Invalid aggregate %s' % aggregate)
+
+
+class PatientAggregator(object):
+    """Aggregates extracted values per EMPI as note matches arrive.
+
+    Notes may be added in any order. first, last and all follow the report
+    date of each note, with the order notes were added breaking ties, so
+    patient notes never need to be grouped or sorted up front. min and max
+    compare extracted dates as dates, leaving out dates that can't be
+    parsed.
+    """
+    def __init__(self, aggregate, phrase_type):
+        if aggregate not in AGGREGATE_MODES:
+            raise ValueError('Invalid aggregate %s. Expected one of %s' %
+                             (aggregate, AGGREGATE_MODES))
+        if aggregate == 'mean' and phrase_type != PHRASE_TYPE_NUM:
+            raise ValueError('Aggregate mean requires numerical values.')
+        self.aggregate = aggregate
+        if phrase_type == PHRASE_TYPE_DATE:
+            self.value_key = _extracted_date_key
+        else:
+            self.value_key = float
+        self.empi_to_patient_aggregate = {}
+        self.empis = []  # in order of first appearance
+        self.num_notes = 0
+
+    def add_note_phrase_matches(self, note_phrase_matches):
+        rpdr_note = note_phrase_matches.rpdr_note
+        note_key = (_report_date_sort_key(rpdr_note.report_date),
+                    self.num_notes)
+        self.num_notes += 1
+        patient_aggregate = self.empi_to_patient_aggregate.get(rpdr_note.empi)
+        if patient_aggregate is None:
+            patient_aggregate = PatientAggregate(rpdr_note, note_key)
+            self.empi_to_patient_aggregate[rpdr_note.empi] = patient_aggregate
+            self.empis.append(rpdr_note.empi)
+        patient_aggregate.add_note_values(
+            rpdr_note, note_key, note_phrase_matches.get_extracted_values(),
+            self.aggregate, self.value_key)
+
+    def get_rows(self, include_source_filename=False):
+        """Return one row per patient with the keys of the patient's earliest
+        note followed by the aggregated value, and the file of that note if
+        include_source_filename is True."""
+        rows = []
+        for empi in self.empis:
+            patient_aggregate = self.empi_to_patient_aggregate[empi]
+            row = [compat.to_str(key) for key in patient_aggregate.keys] + [
+                compat.to_str(patient_aggregate.get_value(self.aggregate))]
+            if include_source_filename:
+                row.append(patient_aggregate.source_filename)
+            rows.append(row)
+        return rows
+
+
+_report_date_sort_keys = {}  # memoized _report_date_sort_key results
+
+
+def _report_date_sort_key(report_date):
+    """Return a datetime for ordering notes by report date. Dates that can
+    not be parsed sort after all others."""
+    try:
+        return _report_date_sort_keys[report_date]
+    except KeyError:
+        pass
+    sort_key = datetime.datetime.max
+    for date_format in REPORT_DATE_FORMATS:
+        try:
+            sort_key = datetime.datetime.strptime(
+                compat.to_str(report_date), date_format)
+            break
+        except (TypeError, ValueError):
+            continue
+    _report_date_sort_keys[report_date] = sort_key
+    return sort_key
+
+
+def _extracted_date_key(extracted_date):
+    """Return the datetime of a date extracted from a note, or None if it
+    can't be parsed."""
+    for date_format in EXTRACTED_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(extracted_date, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+_interned_bytes = {}  # header values interned by _intern under Python 3
+
+
+def _intern(value):
+    if value is None:
+        return None
+    if compat.PY2:
+        return intern(value)
+    # Python 3 only interns str, so bytes are interned here.
+    return _interned_bytes.setdefault(value, value)
+
+
+PUNCTUATION = string.punctuation.encode('ascii')
 
 
 def _remove_punctuation(s):
-    return s.translate(None, string.punctuation)
+    return s.translate(None, PUNCTUATION)
 
 
-def _extract_phrase_from_notes(
-        phrase_type, phrases, rpdr_note, match_contexts):
-    """Return a PhraseMatch object with the value as a binary 0/1 indicating
-    whether one of the phrases was found in rpdr_note.note."""
+# (phrase_type, phrases) to compiled patterns, least recently used first.
+_phrase_patterns_cache = collections.OrderedDict()
+
+
+def _get_phrase_patterns(phrase_type, phrases):
+    """Return a list of (phrase, compiled pattern) for each phrase and each
+    pattern used for phrase_type. The patterns of the last
+    MAX_CACHED_PHRASE_PATTERNS phrase lists are cached, so repeated calls
+    for the same phrases don't recompile them."""
+    cache_key = (phrase_type, tuple(phrases))
+    if cache_key in _phrase_patterns_cache:
+        phrase_patterns = _phrase_patterns_cache.pop(cache_key)
+        _phrase_patterns_cache[cache_key] = phrase_patterns
+        return phrase_patterns
     if phrase_type == PHRASE_TYPE_WORD:
         pattern_strings = [
-            '(\s%s\s)', '(^%s\s)', '(\s%s$)', '(^%s$)', '(\s%s[\,\.\?\!\-])',
-            '(^%s[\,\.\?\!\-])'
+            br'(\s%s\s)', br'(^%s\s)', br'(\s%s$)', br'(^%s$)',
+            br'(\s%s[\,\.\?\!\-])', br'(^%s[\,\.\?\!\-])'
         ]
     elif phrase_type == PHRASE_TYPE_NUM:
         pattern_strings = [
-            '(?:%s)\s*(?:of|is|was|were|are|\:)?[:]*[\s]*([0-9]+\.?[0-9]*)']
+            br'(?:%s)\s*(?:of|is|was|were|are|\:)?[:]*[\s]*([0-9]+\.?[0-9]*)']
     elif phrase_type == PHRASE_TYPE_DATE:
         pattern_strings = [
-            '(?:%s)\s*(?:of|is|was|were|are|\:)?[:]*[\s]*(\d+/\d+/\d+)',
-            '(?:%s)\s*(?:of|is|was|were|are|\:)?[:]*[\s]*(\d+-\d+-\d+)']
+            br'(?:%s)\s*(?:of|is|was|were|are|\:)?[:]*[\s]*(\d+/\d+/\d+)',
+            br'(?:%s)\s*(?:of|is|was|were|are|\:)?[:]*[\s]*(\d+-\d+-\d+)']
     else:
         raise Exception('Invalid phrase extraction type.')
 
-    phrase_matches = NotePhraseMatches(rpdr_note)
+    phrase_patterns = []
+    re_flags = re.I | re.M | re.DOTALL
     for phrase in phrases:
         for pattern_string in pattern_strings:
-            pattern_string = pattern_string % phrase
-            re_flags = re.I | re.M | re.DOTALL
-            pattern = re.compile(pattern_string, flags=re_flags)
-            match_iter = pattern.finditer(rpdr_note.note)
-            try:
-                while True:
-                    match = next(match_iter)
-                    if phrase_type == PHRASE_TYPE_WORD:
-                        extracted_value = 1
-                    elif phrase_type == PHRASE_TYPE_NUM:
-                        extracted_value = float(match.groups()[0])
-                    elif phrase_type == PHRASE_TYPE_DATE:
-                        extracted_value = match.groups()[0]
-                    new_match = PhraseMatch(extracted_value, match.start(),
-                                            match.end(), phrase)
-                    phrase_matches.add_phrase_match(new_match)
-                    match_contexts.add_match_context(
-                        rpdr_note.note, match.start(), match.end())
-            except StopIteration:
+            pattern = re.compile(pattern_string % phrase, flags=re_flags)
+            phrase_patterns.append((phrase, pattern))
+    _phrase_patterns_cache[cache_key] = phrase_patterns
+    if len(_phrase_patterns_cache) > MAX_CACHED_PHRASE_PATTERNS:
+        _phrase_patterns_cache.popitem(last=False)
+    return phrase_patterns
+
+
+def _find_text_matches(phrase_type, phrase_patterns, text,
+                       phrase_seconds=None):
+    """Return a list of (match_start, match_end, phrase, extracted_value) for
+    each match of phrase_patterns in text, in pattern order.
+
+    If phrase_seconds is given, the seconds spent matching each phrase are
+    added to it.
+    """
+    matches = []
+    for phrase, pattern in phrase_patterns:
+        if phrase_seconds is not None:
+            start_time = time.time()
+        for match in pattern.finditer(text):
+            if phrase_type == PHRASE_TYPE_WORD:
+                extracted_value = 1
+            elif phrase_type == PHRASE_TYPE_NUM:
+                extracted_value = float(match.groups()[0])
+            elif phrase_type == PHRASE_TYPE_DATE:
+                extracted_value = compat.to_str(match.groups()[0])
+            matches.append((match.start(), match.end(), phrase,
+                            extracted_value))
+        if phrase_seconds is not None:
+            phrase_seconds[phrase] = (phrase_seconds.get(phrase, 0) +
+                                      time.time() - start_time)
+    return matches
+
+
+def _can_split_into_chunks(phrases):
+    """Return True if matches of phrases never span a paragraph break.
+
+    Literal phrases can't contain line breaks, so only regexes may match
+    across one.
+    """
+    return all(note_index.is_indexable_phrase(phrase) for phrase in phrases)
+
+
+def _split_note_into_chunks(note, phrase_type):
+    """Return a list of (offset, chunk) splitting note at paragraph breaks,
+    such that matching each chunk separately finds the same matches as
+    matching the whole note.
+
+    Notes are cut between the two line breaks of a blank line. The first
+    chunk then ends with a line break and the second starts with one, so a
+    word pattern can't match across the cut. Number and date patterns may
+    skip whitespace between the phrase and the value, so for those the note
+    is only cut when the next text after the break can't continue a match.
+    """
+    chunks = []
+    chunk_start = 0
+    for match in PARAGRAPH_BREAK_RE.finditer(note):
+        cut = match.end()
+        if phrase_type != PHRASE_TYPE_WORD:
+            next_text = NON_WHITESPACE_RE.search(note, cut)
+            if (next_text is not None and
+                    next_text.group() in VALUE_CONTINUATION_CHARACTERS):
                 continue
+        chunks.append((chunk_start, note[chunk_start:cut]))
+        chunk_start = cut
+    chunks.append((chunk_start, note[chunk_start:]))
+    return chunks
+
+
+class TextMatchCache(object):
+    """The matches found in each distinct note and paragraph text, keyed by
+    a hash of the text, for one set of phrases.
+
+    Holds at most max_entries texts and starts over when full.
+    """
+    def __init__(self, max_entries=TEXT_MATCH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.digest_to_matches = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get_matches(self, text, find_matches):
+        """Return find_matches(text), or the matches of an identical text
+        seen earlier. The returned list must not be modified."""
+        digest = hashlib.sha1(text).digest()
+        matches = self.digest_to_matches.get(digest)
+        if matches is not None:
+            self.num_hits += 1
+            return matches
+        self.num_misses += 1
+        matches = find_matches(text)
+        if len(self.digest_to_matches) >= self.max_entries:
+            self.digest_to_matches.clear()
+        self.digest_to_matches[digest] = matches
+        return matches
+
+
+def _find_deduplicated_text_matches(phrase_type, phrases, text,
+                                    text_match_cache, phrase_seconds=None):
+    """Return the same matches as _find_text_matches, reusing the matches of
+    whole notes and paragraphs already in text_match_cache."""
+    phrase_patterns = _get_phrase_patterns(phrase_type, phrases)
+
+    def find_matches(text):
+        return _find_text_matches(phrase_type, phrase_patterns, text,
+                                  phrase_seconds)
+
+    def find_note_matches(note):
+        if not _can_split_into_chunks(phrases):
+            return find_matches(note)
+        chunks = _split_note_into_chunks(note, phrase_type)
+        if len(chunks) == 1:
+            return find_matches(note)
+        matches = []
+        for chunk_start, chunk in chunks:
+            for match_start, match_end, phrase, extracted_value in (
+                    text_match_cache.get_matches(chunk, find_matches)):
+                matches.append((chunk_start + match_start,
+                                chunk_start + match_end, phrase,
+                                extracted_value))
+        return matches
+
+    return text_match_cache.get_matches(text, find_note_matches)
+
+
+def _extract_phrase_from_notes(
+        phrase_type, phrases, rpdr_note, match_contexts, match_table=None,
+        text_match_cache=None, slow_note_log=None):
+    """Return a PhraseMatch object with the value as a binary 0/1 indicating
+    whether one of the phrases was found in rpdr_note.note.
+
+    If slow_note_log is given, the time taken to match each phrase in the
+    note is added to it.
+    """
+    phrase_seconds = None
+    if slow_note_log is not None:
+        phrase_seconds = {}
+    # The text of shared corpus notes is copied out of the corpus on each
+    # access, so it is read once.
+    note = rpdr_note.note
+    if text_match_cache is None:
+        matches = _find_text_matches(
+            phrase_type, _get_phrase_patterns(phrase_type, phrases), note,
+            phrase_seconds)
+    else:
+        matches = _find_deduplicated_text_matches(
+            phrase_type, phrases, note, text_match_cache, phrase_seconds)
+    if slow_note_log is not None:
+        slow_note_log.add_note(rpdr_note, phrase_seconds)
+    phrase_matches = NotePhraseMatches(rpdr_note, match_table)
+    for match_start, match_end, phrase, extracted_value in matches:
+        phrase_matches.add_match(extracted_value, match_start, match_end,
+                                 phrase)
+        match_contexts.add_match_context(note, match_start, match_end)
+    phrase_matches.finalize_phrase_matches()
+    return phrase_matches
+
+
+def _can_use_note_index(phrase_type, phrases, ignore_punctuation,
+                        group_by_patient):
+    """Return True if the matches can be looked up in a NoteIndex.
+
+    Indexes answer literal phrase presence queries on the notes as they
+    appear in the indexed file.
+    """
+    return (phrase_type == PHRASE_TYPE_WORD and not ignore_punctuation and
+            not group_by_patient and
+            all(note_index.is_indexable_phrase(phrase) for phrase in phrases))
+
+
+def _extract_phrase_from_index(phrase_note_ids, rpdr_note, match_contexts,
+                               match_table=None):
+    """Return a NotePhraseMatches for rpdr_note, matching the patterns of
+    only the phrases that the index found in the note.
+
+    phrase_note_ids is a list of (phrase patterns, ids of the notes
+    NoteIndex.find_phrase found the phrase in) for each phrase. The index
+    finds every note the patterns of a phrase can match, so the matches are
+    exactly those of _extract_phrase_from_notes, but notes without any of
+    the phrases are never matched or read.
+    """
+    phrase_patterns = []
+    for patterns, note_ids in phrase_note_ids:
+        if rpdr_note.note_id in note_ids:
+            phrase_patterns.extend(patterns)
+    phrase_matches = NotePhraseMatches(rpdr_note, match_table)
+    if phrase_patterns:
+        note = rpdr_note.note
+        for match_start, match_end, phrase, extracted_value in (
+                _find_text_matches(PHRASE_TYPE_WORD, phrase_patterns, note)):
+            phrase_matches.add_match(extracted_value, match_start, match_end,
+                                     phrase)
+            match_contexts.add_match_context(note, match_start, match_end)
     phrase_matches.finalize_phrase_matches()
     return phrase_matches
 
 
-def _extract_values_from_rpdr_notes(
-        rpdr_notes, phrase_type, phrases, ignore_punctuation,
-        show_n_words_context_before, show_n_words_context_after):
-    """Return a list of NotePhraseMatches for each note in rpdr_notes."""
-    note_phrase_matches = []
-    if ignore_punctuation:
-        logging.info('ignore_punctuation is True, so we will also ignore '
-                     'any punctuation in the entered phrases.')
-        phrases = [_remove_punctuation(phrase) for phrase in phrases]
-    match_contexts = PhraseMatchContexts(
-        show_n_words_context_before, show_n_words_context_after)
+def _iterate_notes_without_punctuation(rpdr_notes):
     for rpdr_note in rpdr_notes:
-        if ignore_punctuation:
-            rpdr_note.remove_punctuation_from_note()
-        phrase_matches = _extract_phrase_from_notes(phrase_type, phrases,
-                                                    rpdr_note, match_contexts)
+        rpdr_note.remove_punctuation_from_note()
+        yield rpdr_note
+
+
+def _iterate_phrase_matches(rpdr_notes, phrase_type, phrases, match_contexts,
+                            patient_aggregator=None, rpdr_note_index=None,
+                            deduplicate_text=False, slow_note_log=None,
+                            match_table=None):
+    """Yield a NotePhraseMatches for each note in rpdr_notes as it is
+    searched, adding the context of each match to match_contexts.
+
+    Unless match_table is given, each note keeps its own table, so the
+    matches of a note are freed once the caller is done with it.
+    rpdr_note_index must only be given if _can_use_note_index is True. It
+    only selects the notes each phrase is matched against, so the matches
+    are the same as without it. Notes looked up in the index are not timed
+    for slow_note_log.
+    """
+    if rpdr_note_index is not None:
+        phrase_note_ids = [
+            (_get_phrase_patterns(phrase_type, [phrase]),
+             set(rpdr_note_index.find_phrase(phrase)))
+            for phrase in phrases]
+    text_match_cache = None
+    if deduplicate_text and rpdr_note_index is None:
+        text_match_cache = TextMatchCache()
+    for rpdr_note in rpdr_notes:
+        if rpdr_note_index is not None:
+            phrase_matches = _extract_phrase_from_index(
+                phrase_note_ids, rpdr_note, match_contexts, match_table)
+        else:
+            phrase_matches = _extract_phrase_from_notes(
+                phrase_type, phrases, rpdr_note, match_contexts, match_table,
+                text_match_cache, slow_note_log)
+        if patient_aggregator is not None:
+            patient_aggregator.add_note_phrase_matches(phrase_matches)
+        yield phrase_matches
+    if text_match_cache is not None:
+        logging.info('Reused the matches of %d of %d note and paragraph texts'
+                     % (text_match_cache.num_hits,
+                        text_match_cache.num_hits +
+                        text_match_cache.num_misses))
+
+
+def _find_phrase_matches(rpdr_notes, phrase_type, phrases, match_contexts,
+                         patient_aggregator=None, rpdr_note_index=None,
+                         memory_budget=None, deduplicate_text=False,
+                         slow_note_log=None):
+    """Return a list of the NotePhraseMatches of _iterate_phrase_matches, or
+    with memory_budget, a SpillList of them."""
+    if memory_budget is None:
+        match_table = PhraseMatchTable(phrase_type)
+        note_phrase_matches = []
+    else:
+        # Each note keeps its own table, so spilled matches are freed.
+        match_table = None
+        note_phrase_matches = memory_budget_module.SpillList(
+            memory_budget, _get_note_phrase_matches_size)
+    for phrase_matches in _iterate_phrase_matches(
+            rpdr_notes, phrase_type, phrases, match_contexts,
+            patient_aggregator, rpdr_note_index, deduplicate_text,
+            slow_note_log, match_table):
         note_phrase_matches.append(phrase_matches)
-    match_contexts.print_ordered_contexts()
     return note_phrase_matches
 
 
+# A phrase match found by ExtractionQuery, with the keys of its note. The
+# keys and phrase are native strings.
+MatchRecord = collections.namedtuple('MatchRecord', [
+    'empi', 'mrn_type', 'mrn', 'report_type', 'report_number', 'report_date',
+    'report_description', 'source_filename', 'note_id', 'phrase',
+    'match_start', 'match_end', 'extracted_value'])
+
+
+class ExtractionQuery(object):
+    """Phrases to extract from notes, compiled once and applied to any number
+    of notes:
+
+        query = ExtractionQuery(['ef', 'ejection fraction'], PHRASE_TYPE_NUM)
+        for match_record in query.match_file('notes.txt'):
+            print(match_record.empi, match_record.extracted_value)
+
+    Notes are skipped unless they have report_description and report_type,
+    if given. With ignore_punctuation, punctuation is removed from the
+    phrases and notes before matching, and match offsets refer to the note
+    text without punctuation. Notes passed to match_note and match_notes may
+    have text or bytes values, and match offsets refer to the note text
+    encoded as UTF-8.
+    """
+    def __init__(self, phrases, phrase_type=PHRASE_TYPE_WORD,
+                 ignore_punctuation=False, report_description=None,
+                 report_type=None):
+        if not phrases:
+            raise ValueError('Expected at least one phrase.')
+        if ignore_punctuation:
+            logging.info('ignore_punctuation is True, so we will also ignore '
+                         'any punctuation in the entered phrases.')
+        # The phrases as entered, which match stores keep, and as matched
+        # and reported in matches. Both are bytes like the notes they are
+        # matched against.
+        phrases = [compat.to_bytes(phrase) for phrase in phrases]
+        self.entered_phrases = phrases
+        if ignore_punctuation:
+            phrases = [_remove_punctuation(phrase) for phrase in phrases]
+        self.phrases = phrases
+        self.phrase_type = phrase_type
+        self.ignore_punctuation = ignore_punctuation
+        self.report_description = _to_bytes_or_none(report_description)
+        self.report_type = _to_bytes_or_none(report_type)
+        self.phrase_patterns = _get_phrase_patterns(phrase_type, self.phrases)
+
+    def filter_notes(self, rpdr_notes):
+        """Yield the notes of rpdr_notes kept by the report filters."""
+        return _iterate_rpdr_notes_by_column_val(
+            rpdr_notes, self.report_description, self.report_type)
+
+    def can_use_note_index(self, group_by_patient=False):
+        return _can_use_note_index(self.phrase_type, self.phrases,
+                                   self.ignore_punctuation, group_by_patient)
+
+    def find_phrase_matches(self, rpdr_notes, match_contexts=None,
+                            patient_aggregator=None, rpdr_note_index=None,
+                            memory_budget=None, deduplicate_text=False,
+                            slow_note_log=None):
+        """Return a NotePhraseMatches for each note in rpdr_notes, which are
+        not filtered, as _find_phrase_matches does. For ignore_punctuation,
+        punctuation is removed from the notes themselves."""
+        if match_contexts is None:
+            match_contexts = PhraseMatchContexts(0, 0)
+        if self.ignore_punctuation:
+            rpdr_notes = _iterate_notes_without_punctuation(rpdr_notes)
+        return _find_phrase_matches(
+            rpdr_notes, self.phrase_type, self.phrases, match_contexts,
+            patient_aggregator, rpdr_note_index, memory_budget,
+            deduplicate_text, slow_note_log)
+
+    def iterate_phrase_matches(self, rpdr_notes, match_contexts=None,
+                               patient_aggregator=None, rpdr_note_index=None,
+                               deduplicate_text=False, slow_note_log=None):
+        """Yield a NotePhraseMatches for each note in rpdr_notes as it is
+        searched, without keeping them, as _iterate_phrase_matches does."""
+        if match_contexts is None:
+            match_contexts = PhraseMatchContexts(0, 0)
+        if self.ignore_punctuation:
+            rpdr_notes = _iterate_notes_without_punctuation(rpdr_notes)
+        return _iterate_phrase_matches(
+            rpdr_notes, self.phrase_type, self.phrases, match_contexts,
+            patient_aggregator, rpdr_note_index, deduplicate_text,
+            slow_note_log)
+
+    def match_note(self, rpdr_note):
+        """Return a list of MatchRecord for the matches in rpdr_note ordered
+        by match start, or an empty list if the note is filtered out."""
+        return list(self.match_notes([rpdr_note]))
+
+    def match_notes(self, rpdr_notes):
+        """Yield a MatchRecord for each match in the notes of rpdr_notes kept
+        by the filters. The notes are left unchanged."""
+        for rpdr_note in self.filter_notes(
+                _get_note_as_bytes(rpdr_note) for rpdr_note in rpdr_notes):
+            note = rpdr_note.note
+            if self.ignore_punctuation:
+                note = _remove_punctuation(note)
+            matches = _find_text_matches(self.phrase_type,
+                                         self.phrase_patterns, note)
+            matches.sort(key=lambda match: match[0])
+            keys = [compat.to_str(key) for key in [
+                rpdr_note.empi, rpdr_note.mrn_type, rpdr_note.mrn,
+                rpdr_note.report_type, rpdr_note.report_number,
+                rpdr_note.report_date, rpdr_note.report_description]]
+            for match_start, match_end, phrase, extracted_value in matches:
+                yield MatchRecord(*keys + [
+                    rpdr_note.source_filename, rpdr_note.note_id,
+                    compat.to_str(phrase), match_start, match_end,
+                    extracted_value])
+
+    def match_file(self, input_filename, input_format='rpdr'):
+        """Yield a MatchRecord for each match in the notes of input_filename,
+        reading one note at a time."""
+        return self.match_notes(
+            _iterate_notes_from_files([input_filename], input_format))
+
+
+def _to_bytes_or_none(value):
+    if value is None:
+        return None
+    return compat.to_bytes(value)
+
+
+# RPDRNote attributes read and matched as bytes.
+RPDR_NOTE_BYTES_ATTRIBUTES = ['note', 'empi', 'mrn_type', 'mrn',
+                              'report_type', 'report_number',
+                              'report_description', 'report_date']
+
+
+def _get_note_as_bytes(rpdr_note):
+    """Return rpdr_note, or a copy of it with its text and header values
+    encoded as bytes if any of them are text, as for notes made by callers
+    of ExtractionQuery under Python 3."""
+    if all(isinstance(getattr(rpdr_note, attribute), (bytes, type(None)))
+           for attribute in RPDR_NOTE_BYTES_ATTRIBUTES):
+        return rpdr_note
+    rpdr_note = copy.copy(rpdr_note)
+    for attribute in RPDR_NOTE_BYTES_ATTRIBUTES:
+        setattr(rpdr_note, attribute,
+                _to_bytes_or_none(getattr(rpdr_note, attribute)))
+    return rpdr_note
+
+
 def _split_rpdr_key_line(text_line):
     """Remove newline chars and split the line by bars."""
-    return tuple(text_line.replace('\r', '').replace('\n', '').split('|'))
+    return tuple(text_line.replace(b'\r', b'').replace(b'\n', b'').split(b'|'))
+
+
+def _split_rpdr_header_line(text_line):
+    """Return the column names of an RPDR header line as native strings."""
+    return tuple(compat.to_str(column_name)
+                 for column_name in _split_rpdr_key_line(text_line))
 
 
 def _filter_rpdr_notes_by_column_val(rpdr_notes,
@@ -176,7 +969,14 @@ def _filter_rpdr_notes_by_column_val(rpdr_notes,
     from either `required_report_type` or `required_report_description` if
     those values are not None.
     """
-    filtered_rpdr_notes = []
+    return list(_iterate_rpdr_notes_by_column_val(
+        rpdr_notes, required_report_description, required_report_type))
+
+
+def _iterate_rpdr_notes_by_column_val(rpdr_notes,
+                                      required_report_description,
+                                      required_report_type):
+    """Yield the notes kept by _filter_rpdr_notes_by_column_val."""
     for rpdr_note in rpdr_notes:
         if (required_report_description is not None and
                 rpdr_note.report_description != required_report_description):
@@ -184,8 +984,7 @@ def _filter_rpdr_notes_by_column_val(rpdr_notes,
         if (required_report_type is not None and
                 rpdr_note.report_type != required_report_type):
             continue
-        filtered_rpdr_notes.append(rpdr_note)
-    return filtered_rpdr_notes
+        yield rpdr_note
 
 
 def _group_rpdr_notes_by_patient(rpdr_notes):
@@ -200,109 +999,806 @@ def _group_rpdr_notes_by_patient(rpdr_notes):
         empi_to_notes.setdefault(rpdr_note.empi, []).append(rpdr_note)
 
     grouped_rpdr_notes = []
-    for empi, rpdr_notes in empi_to_notes.iteritems():
-        first_note = rpdr_notes[0]
-        for rpdr_note in rpdr_notes[1:]:
-            first_note.note += ('\n\n\n\n' + rpdr_note.note)
+    for empi, rpdr_notes in empi_to_notes.items():
+        # Copy the first note so the input notes are left unchanged.
+        first_note = copy.copy(rpdr_notes[0])
+        first_note.note = b'\n\n\n\n'.join(
+            rpdr_note.note for rpdr_note in rpdr_notes)
         grouped_rpdr_notes.append(first_note)
     return grouped_rpdr_notes
 
 
-def _parse_rpdr_text_file(rpdr_filename):
-    """Return a list of RPDR Note objects"""
-    with open(rpdr_filename, 'rb') as rpdr_file:
-        rpdr_lines = rpdr_file.readlines()
-    header_column_names = _split_rpdr_key_line(rpdr_lines[0])
+class NoteReader(object):
+    """Yields an RPDRNote for each note in a notes file.
 
-    # None if at the start of the file or in between patient notes.
-    rpdr_keys = None
+    Subclasses define __iter__ for a particular file format and are
+    registered in NOTE_READERS under the name used by --input_format.
+    """
+    def __init__(self, filename):
+        self.filename = filename
 
-    rpdr_note = ''
-    rpdr_notes = []
 
-    ignore_lines = False  # True if bad formatted header
-    num_bad_formatted_headers = 0
-    for line_number, line in enumerate(rpdr_lines[1:]):
-        # If starting a new note and the current line is empty, continue.
-        if not rpdr_keys and not line.replace('\r', '').replace('\n', ''):
-            continue
-        # If not current notes, try to extract the RPDR column values.
-        if not rpdr_keys:
-            if '|' not in line:
-                raise ValueError('Expected RPDR column values as described in '
-                                 'the header, separated by | at the start of '
-                                 'a new note. Got %s' % line)
+class RPDRNoteReader(NoteReader):
+    """Reads Lno, Dis, Rad, and Opn RPDR text files."""
+    def __iter__(self):
+        with open(self.filename, 'rb') as rpdr_file:
+            header_column_names = self._read_header(rpdr_file)
+            num_bad_formatted_headers = 0
+            num_notes = 0
+            while True:
+                note = self._read_note(rpdr_file, header_column_names)
+                if note is None:
+                    break
+                rpdr_column_name_to_key, rpdr_note = note
+                if rpdr_column_name_to_key is None:
+                    num_bad_formatted_headers += 1
+                    continue
+                yield RPDRNote(rpdr_column_name_to_key, rpdr_note, num_notes,
+                               self.filename)
+                num_notes += 1
+        logging.info('Num bad formatted headers: %s' %
+                     num_bad_formatted_headers)
+
+    def iterate_notes_at(self, numbered_offsets):
+        """Yield the note starting at each byte offset of numbered_offsets, a
+        list of (note_id, offset) where offset is found by
+        _find_rpdr_note_offsets and note_id is its position in the offsets,
+        which is the note_id iterating the reader gives the note. Badly
+        formatted notes are skipped."""
+        with open(self.filename, 'rb') as rpdr_file:
+            header_column_names = self._read_header(rpdr_file)
+            for note_id, offset in numbered_offsets:
+                rpdr_file.seek(offset)
+                note = self._read_note(rpdr_file, header_column_names)
+                if note is None or note[0] is None:
+                    continue
+                yield RPDRNote(note[0], note[1], note_id, self.filename)
+
+    def _read_header(self, rpdr_file):
+        header_column_names = _split_rpdr_header_line(next(rpdr_file, b''))
+        missing_column_names = [
+            column_name for column_name in RPDR_REQUIRED_COLUMN_NAMES
+            if column_name not in header_column_names]
+        if missing_column_names:
+            raise ValueError(
+                'Expected an RPDR header line with the columns %s at the '
+                'start of %s. Missing %s' % (
+                    ', '.join(RPDR_REQUIRED_COLUMN_NAMES), self.filename,
+                    ', '.join(missing_column_names)))
+        return header_column_names
+
+    def _read_note(self, lines, header_column_names):
+        """Read the next note from lines.
+
+        Return (rpdr_column_name_to_key, note), (None, None) for a note whose
+        RPDR column values don't match the header, or None if there are no
+        more complete notes.
+        """
+        for line in lines:
+            # Empty lines in between notes are skipped.
+            if not line.replace(b'\r', b'').replace(b'\n', b''):
+                continue
+            if b'|' not in line:
+                raise ValueError(
+                    'Expected RPDR column values as described in the '
+                    'header, separated by | at the start of a new '
+                    'note in %s. Got %s' % (self.filename,
+                                            compat.to_str(line)))
             rpdr_keys = _split_rpdr_key_line(line)
             if len(rpdr_keys) != len(header_column_names):
-                ignore_lines = True
-                num_bad_formatted_headers += 1
+                for line in lines:
+                    if _is_report_end_line(line):
+                        return None, None
+                return None
+            # Lines are joined once at the end, since adding to bytes copies
+            # the whole note each time under Python 3.
+            note_lines = []
+            for line in lines:
+                note_lines.append(line)
+                if _is_report_end_line(line):
+                    rpdr_column_name_to_key = {
+                        column_name: key for (column_name, key) in
+                        zip(header_column_names, rpdr_keys)
+                    }
+                    return rpdr_column_name_to_key, b''.join(note_lines)
+            return None
+        return None
+
+
+def _is_report_end_line(line):
+    """Return True if line ends a note. _find_report_end finds the same
+    lines without splitting a file into lines."""
+    return b'[report_end]' in line
+
+
+def _find_rpdr_note_offsets(rpdr_filename):
+    """Return an array of the byte offsets in an RPDR file at which the notes
+    RPDRNoteReader reads start, in file order: after the header line, and
+    after each line that ends a note.
+
+    Offsets followed only by whitespace, and notes whose column values don't
+    match the header or that have no end, are left out, as the reader skips
+    them. The file is searched without parsing the notes, so this is much
+    faster than reading them.
+    """
+    offsets = array.array('l')
+    with open(rpdr_filename, 'rb') as rpdr_file:
+        file_size = os.fstat(rpdr_file.fileno()).st_size
+        if not file_size:
+            return offsets
+        num_columns = len(_split_rpdr_key_line(rpdr_file.readline()))
+        rpdr_data = mmap.mmap(rpdr_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = rpdr_data.find(b'\n') + 1
+            while 0 < offset < file_size:
+                note_text = NON_WHITESPACE_RE.search(rpdr_data, offset)
+                if note_text is None:
+                    break
+                key_line_start = rpdr_data.rfind(
+                    b'\n', offset, note_text.start()) + 1 or offset
+                key_line_end = _find_line_end(rpdr_data, key_line_start)
+                report_end = _find_report_end(rpdr_data, key_line_end)
+                if report_end == -1:
+                    break
+                if len(_split_rpdr_key_line(
+                        rpdr_data[key_line_start:key_line_end])) == (
+                            num_columns):
+                    offsets.append(offset)
+                offset = report_end
+        finally:
+            rpdr_data.close()
+    return offsets
+
+
+def _find_line_end(data, start):
+    """Return the offset after the line break ending the line at start, or
+    the end of data."""
+    return data.find(b'\n', start) + 1 or len(data)
+
+
+def _find_report_end(data, start):
+    """Return the offset after the first line from start, which must be the
+    start of a line, that ends a note as for _is_report_end_line, or -1 if
+    there is none."""
+    report_end = data.find(b'[report_end]', start)
+    if report_end == -1:
+        return -1
+    return _find_line_end(data, report_end)
+
+
+class DFCINoteReader(NoteReader):
+    """Reads DFCI clinical notes files directly, using the same field mapping
+    as convert_dfci_to_rpdr.py, so no converted RPDR file is needed."""
+    def __iter__(self):
+        column_names = convert_dfci_to_rpdr.RPDR_COLUMN_NAMES[:-1]
+        num_notes = 0
+        for dfci_row in convert_dfci_to_rpdr.iterate_dfci_notes(
+                self.filename):
+            rpdr_row = convert_dfci_to_rpdr.convert_dfci_row(dfci_row)
+            if rpdr_row is None:
                 continue
-                # raise ValueError('Expected RPDR column values of the same '
-                #                'length as the header (%s), got: %s of length'
-                #                  ' %s at line number: %s'
-                #                  % (len(header_column_names), str(rpdr_keys),
-                #                     len(rpdr_keys), line_number))
-            rpdr_column_name_to_key = {
-                column_name: key for (column_name, key) in
-                zip(header_column_names, rpdr_keys)
-            }
-            rpdr_note = ''
-        else:  # line is part of notes
-            if not ignore_lines:
-                rpdr_note += line
-            if '[report_end]' in line:
-                rpdr_keys = None
-                if not ignore_lines:
-                    rpdr_note = RPDRNote(rpdr_column_name_to_key, rpdr_note)
-                    rpdr_notes.append(rpdr_note)
-                ignore_lines = False
-    logging.info('Num bad formatted headers: %s' % num_bad_formatted_headers)
+            rpdr_column_name_to_key = dict(zip(column_names, rpdr_row[:-1]))
+            # The converted Comments value starts with a newline that ends the
+            # RPDR key line, which is not part of the note.
+            yield RPDRNote(rpdr_column_name_to_key, rpdr_row[-1][1:],
+                           num_notes, self.filename)
+            num_notes += 1
+
+
+NOTE_READERS = {
+    'rpdr': RPDRNoteReader,
+    'dfci': DFCINoteReader,
+}
+
+
+def _iterate_rpdr_notes_grouped_by_patient(rpdr_notes, memory_budget):
+    """Yield the notes of _group_rpdr_notes_by_patient, ordered by EMPI,
+    sorting the notes by EMPI on disk if memory_budget is exceeded."""
+    first_note = None
+    patient_notes = []
+    for empi, rpdr_note in memory_budget_module.iterate_sorted(
+            rpdr_notes, lambda rpdr_note: rpdr_note.empi, memory_budget,
+            _get_rpdr_note_size):
+        if first_note is not None and first_note.empi != empi:
+            first_note.note = b'\n\n\n\n'.join(patient_notes)
+            yield first_note
+            first_note = None
+        if first_note is None:
+            first_note = copy.copy(rpdr_note)
+            patient_notes = []
+        patient_notes.append(rpdr_note.note)
+    if first_note is not None:
+        first_note.note = b'\n\n\n\n'.join(patient_notes)
+        yield first_note
+
+
+def _get_rpdr_note_size(rpdr_note):
+    """Approximate number of bytes used by an RPDRNote."""
+    return rpdr_note.get_note_length() + 512
+
+
+def _get_note_phrase_matches_size(note_phrase_matches):
+    """Approximate number of bytes used by a NotePhraseMatches, including
+    its note."""
+    return (_get_rpdr_note_size(note_phrase_matches.rpdr_note) + 512 +
+            64 * note_phrase_matches.num_matches)
+
+
+def _parse_rpdr_text_file(rpdr_filename):
+    """Return a list of RPDR Note objects"""
+    return list(RPDRNoteReader(rpdr_filename))
+
+
+def _read_notes(input_filename, input_format='rpdr'):
+    """Return a list of RPDR Note objects read with the NoteReader registered
+    for input_format."""
+    if input_format not in NOTE_READERS:
+        raise ValueError('Invalid input format %s. Expected one of %s' %
+                         (input_format, sorted(NOTE_READERS)))
+    return list(NOTE_READERS[input_format](input_filename))
+
+
+def _expand_input_filenames(input_paths):
+    """Return the files named by input_paths, which may be filenames, glob
+    patterns or directories. The files of a directory or glob pattern are
+    sorted by name."""
+    input_filenames = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            filenames = sorted(
+                os.path.join(input_path, filename)
+                for filename in os.listdir(input_path)
+                if not filename.startswith('.') and
+                os.path.isfile(os.path.join(input_path, filename)))
+        elif glob.has_magic(input_path):
+            filenames = sorted(filename for filename in glob.glob(input_path)
+                               if os.path.isfile(filename))
+        else:
+            filenames = [input_path]
+        if not filenames:
+            raise ValueError('No input files found for %s' % input_path)
+        input_filenames.extend(filenames)
+    return input_filenames
+
+
+def _read_notes_from_files(input_filenames, input_format='rpdr', workers=1):
+    """Return a list of the notes of every file in input_filenames, in file
+    order, parsing up to workers files at a time in separate processes."""
+    if workers <= 1 or len(input_filenames) <= 1:
+        rpdr_notes = []
+        for input_filename in input_filenames:
+            rpdr_notes.extend(_read_notes(input_filename, input_format))
+        return rpdr_notes
+    pool = multiprocessing.Pool(min(workers, len(input_filenames)))
+    try:
+        file_rpdr_notes = pool.map(
+            functools.partial(_read_notes, input_format=input_format),
+            input_filenames, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    rpdr_notes = []
+    for input_filename, notes in zip(input_filenames, file_rpdr_notes):
+        logging.info('Read %d notes from %s' % (len(notes), input_filename))
+        for rpdr_note in notes:
+            # Interned values are not shared after leaving the worker.
+            rpdr_note.intern_keys()
+        rpdr_notes.extend(notes)
     return rpdr_notes
 
 
+def _iterate_notes_from_files(input_filenames, input_format='rpdr'):
+    """Yield the notes of every file in input_filenames, one file after
+    another."""
+    return itertools.chain.from_iterable(
+        NOTE_READERS[input_format](input_filename)
+        for input_filename in input_filenames)
+
+
+def _sample_notes(input_filenames, input_format, sample_notes=None,
+                  sample_fraction=None, random_seed=None):
+    """Return (sampled_notes, num_notes) for a seeded random sample of the
+    notes in input_filenames, of sample_notes notes or sample_fraction of
+    the notes, where num_notes is the number of notes sampled from.
+
+    RPDR notes are sampled from the byte offsets at which notes start, and
+    only the sampled notes are read. Notes of other formats are all read,
+    and a sample of them is kept.
+    """
+    sampler = random.Random(random_seed)
+    if input_format == 'rpdr':
+        file_offsets = [_find_rpdr_note_offsets(input_filename)
+                        for input_filename in input_filenames]
+        num_notes = sum(len(offsets) for offsets in file_offsets)
+    else:
+        file_notes = [_read_notes(input_filename, input_format)
+                      for input_filename in input_filenames]
+        num_notes = sum(len(rpdr_notes) for rpdr_notes in file_notes)
+    if sample_notes is None:
+        sample_notes = int(round(sample_fraction * num_notes))
+    sampled_positions = sorted(sampler.sample(compat.xrange(num_notes),
+                                              min(sample_notes, num_notes)))
+
+    sampled_notes = []
+    file_start = 0
+    for file_number, input_filename in enumerate(input_filenames):
+        if input_format == 'rpdr':
+            file_notes_or_offsets = file_offsets[file_number]
+        else:
+            file_notes_or_offsets = file_notes[file_number]
+        file_end = file_start + len(file_notes_or_offsets)
+        sampled = [(position - file_start,
+                    file_notes_or_offsets[position - file_start])
+                   for position in sampled_positions
+                   if file_start <= position < file_end]
+        if input_format == 'rpdr':
+            # Offsets are read in order, so the file is read front to back.
+            sampled = RPDRNoteReader(input_filename).iterate_notes_at(sampled)
+        else:
+            sampled = [rpdr_note for _, rpdr_note in sampled]
+        sampled_notes.extend(sampled)
+        file_start = file_end
+    return sampled_notes, num_notes
+
+
+def _get_wilson_interval(num_successes, num_trials, z=1.96):
+    """Return the Wilson score interval (low, high) for the proportion of
+    num_successes in num_trials, at 95% confidence by default."""
+    if not num_trials:
+        return 0.0, 1.0
+    proportion = float(num_successes) / num_trials
+    z_squared = z * z
+    denominator = 1 + z_squared / num_trials
+    center = (proportion + z_squared / (2 * num_trials)) / denominator
+    half_width = z * math.sqrt(
+        proportion * (1 - proportion) / num_trials +
+        z_squared / (4 * num_trials * num_trials)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def _print_sample_prevalence(note_phrase_matches, num_sampled_notes,
+                             num_notes):
+    """Print the share of sampled notes with a match, with a 95% confidence
+    interval, and the estimated number of such notes among num_notes.
+
+    note_phrase_matches are for the sampled notes left after filtering by
+    report description and type.
+    """
+    num_filtered_notes = 0
+    num_matching_notes = 0
+    for phrase_matches in note_phrase_matches:
+        num_filtered_notes += 1
+        if phrase_matches.num_matches:
+            num_matching_notes += 1
+    low, high = _get_wilson_interval(num_matching_notes, num_filtered_notes)
+    prevalence = (float(num_matching_notes) / num_filtered_notes
+                  if num_filtered_notes else 0.0)
+    # Share of all notes that pass the report filters, as sampled.
+    filtered_share = (float(num_filtered_notes) / num_sampled_notes
+                      if num_sampled_notes else 0.0)
+    print('Sampled %d of %d notes, %d after filtering.' % (
+        num_sampled_notes, num_notes, num_filtered_notes))
+    print('%d sampled notes matched: %.2f%% (95%% CI %.2f%% to %.2f%%), '
+          'about %d of all notes.' % (
+              num_matching_notes, 100 * prevalence, 100 * low, 100 * high,
+              round(prevalence * filtered_share * num_notes)))
+
+
+class ReservoirSampler(object):
+    """Keeps a uniform random sample, without replacement, of up to
+    sample_size of the items added to it, holding at most sample_size items
+    at a time."""
+    def __init__(self, sample_size, seed=None):
+        self.sample_size = sample_size
+        self.random = random.Random(seed)
+        self.num_seen = 0
+        self.sample = []
+
+    def add(self, item):
+        self.num_seen += 1
+        if not self.sample_size:
+            return
+        if len(self.sample) < self.sample_size:
+            self.sample.append(item)
+            return
+        replace_index = self.random.randint(0, self.num_seen - 1)
+        if replace_index < self.sample_size:
+            self.sample[replace_index] = item
+
+    def get_sample(self):
+        return list(self.sample)
+
+
+class StratifiedReservoirSampler(object):
+    """Samples up to sample_size items, split across the strata given by
+    get_stratum in proportion to the number of items added for each,
+    holding at most sample_size items at a time.
+
+    Each item gets a random key, and each stratum keeps the items with the
+    smallest keys, as many as its share of the items added so far. When a
+    stratum's share grows past the items it holds, it takes its next item,
+    and the stratum furthest over its share drops its largest key. Items
+    dropped earlier can't be taken back, so the next item stands in for
+    one of them, with the key that item would have had. A stratum's sample
+    is therefore only close to uniform when the mix of strata changes as
+    items are added, e.g. for notes ordered by report type.
+    """
+    def __init__(self, sample_size, get_stratum, seed=None):
+        self.sample_size = sample_size
+        self.get_stratum = get_stratum
+        self.random = random.Random(seed)
+        self.stratum_to_num_seen = {}
+        # Max heaps of (-key, item number, item) for each stratum.
+        self.stratum_to_heap = {}
+        self.num_seen = 0
+        self.num_held = 0
+
+    def _get_share(self, stratum):
+        return (float(self.sample_size) * self.stratum_to_num_seen[stratum] /
+                self.num_seen)
+
+    def add(self, item):
+        self.num_seen += 1
+        if not self.sample_size:
+            return
+        stratum = self.get_stratum(item)
+        num_seen = self.stratum_to_num_seen.get(stratum, 0) + 1
+        self.stratum_to_num_seen[stratum] = num_seen
+        heap = self.stratum_to_heap.setdefault(stratum, [])
+        key = self.random.random()
+        if len(heap) < self._get_share(stratum):
+            max_key = -heap[0][0] if heap else 0.0
+            num_not_held = num_seen - 1 - len(heap)
+            if key > max_key and num_not_held:
+                # The smallest key of the items not held is the minimum of
+                # num_not_held keys above max_key.
+                key = min(key, max_key + (1 - max_key) * (
+                    1 - self.random.random() ** (1.0 / num_not_held)))
+            heapq.heappush(heap, (-key, self.num_seen, item))
+            self.num_held += 1
+            if self.num_held > self.sample_size:
+                stratum = max(self.stratum_to_heap, key=lambda stratum: (
+                    len(self.stratum_to_heap[stratum]) -
+                    self._get_share(stratum)))
+                heapq.heappop(self.stratum_to_heap[stratum])
+                self.num_held -= 1
+        elif heap and key < -heap[0][0]:
+            heapq.heapreplace(heap, (-key, self.num_seen, item))
+
+    def get_sample(self):
+        if not self.num_seen or not self.sample_size:
+            return []
+        sample_size = min(self.sample_size, self.num_seen)
+        # None, e.g. for notes without a report type, sorts first.
+        strata = sorted(self.stratum_to_heap,
+                        key=lambda stratum: (stratum is not None, stratum))
+        # Largest remainder allocation of the sample across the strata.
+        quotas = [float(sample_size) * self.stratum_to_num_seen[stratum] /
+                  self.num_seen for stratum in strata]
+        allocations = [int(quota) for quota in quotas]
+        by_remainder = sorted(range(len(strata)),
+                              key=lambda i: allocations[i] - quotas[i])
+        for i in by_remainder[:sample_size - sum(allocations)]:
+            allocations[i] += 1
+        sample = []
+        unused_entries = []
+        for stratum, allocation in zip(strata, allocations):
+            entries = sorted(self.stratum_to_heap[stratum], reverse=True)
+            sample.extend(item for _, _, item in entries[:allocation])
+            unused_entries.extend(entries[allocation:])
+        # A stratum may hold one item fewer than its allocation, which is
+        # made up from the smallest keys held for other strata.
+        unused_entries.sort(reverse=True)
+        sample.extend(item for _, _, item in
+                      unused_entries[:sample_size - len(sample)])
+        return sample
+
+
 def _html_clean_rpdr_note(html_note):
-    html_note = html_note.replace('\r\n', '<br>')
-    html_note = html_note.replace('"', "'")
-    html_note = html_note.replace('\n', '<br>')
-    html_note = html_note.replace('\r', '<br>')
+    html_note = html_note.replace(b'\r\n', b'<br>')
+    html_note = html_note.replace(b'"', b"'")
+    html_note = html_note.replace(b'\n', b'<br>')
+    html_note = html_note.replace(b'\r', b'<br>')
     return html_note
 
 
+def _truncate_note_around_matches(note, matches, max_chars):
+    """Return (note, matches) with note cut down to about max_chars
+    characters around the (match_start, match_end) matches, and the matches
+    moved to their offsets in the cut note.
+
+    Cut text is replaced by TRUNCATED_TEXT_MARKER. Matches too far apart to
+    fit are dropped, keeping the earliest ones.
+    """
+    if len(note) <= max_chars:
+        return note, matches
+    if not matches:
+        return note[:max_chars] + TRUNCATED_TEXT_MARKER, []
+    match_chars = sum(match_end - match_start
+                      for match_start, match_end in matches)
+    padding = max(0, (max_chars - match_chars) // (2 * len(matches)))
+    windows = []  # [start, end] of the text kept around the matches
+    for match_start, match_end in matches:
+        window_start = max(0, match_start - padding)
+        window_end = min(len(note), match_end + padding)
+        if windows and window_start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], window_end)
+        else:
+            windows.append([window_start, window_end])
+
+    pieces = []
+    num_chars = 0  # note characters kept
+    truncated_length = 0
+    previous_window_end = 0
+    window_shifts = []  # (window_start, window_end, shift)
+    for window_start, window_end in windows:
+        if (window_shifts and
+                num_chars + window_end - window_start > max_chars):
+            break
+        if window_start > previous_window_end:
+            pieces.append(TRUNCATED_TEXT_MARKER)
+            truncated_length += len(TRUNCATED_TEXT_MARKER)
+        window_shifts.append((window_start, window_end,
+                              truncated_length - window_start))
+        pieces.append(note[window_start:window_end])
+        truncated_length += window_end - window_start
+        num_chars += window_end - window_start
+        previous_window_end = window_end
+    if previous_window_end < len(note):
+        pieces.append(TRUNCATED_TEXT_MARKER)
+
+    truncated_matches = []
+    for match_start, match_end in matches:
+        for window_start, window_end, shift in window_shifts:
+            if window_start <= match_start and match_end <= window_end:
+                truncated_matches.append((match_start + shift,
+                                          match_end + shift))
+                break
+    return b''.join(pieces), truncated_matches
+
+
 def _write_turk_verification_csv(
         phrase_matches_by_note, phrases, context_size, turk_csv_name,
-        num_negative_matches_to_show=0):
+        num_negative_matches_to_show=0, random_seed=None,
+        stratify_negative_matches=False, shard_size=None,
+        max_note_chars=None):
+    """Write the rows from _iterate_turk_verification_rows to turk_csv_name
+    with a TurkTaskWriter and return the number of rows."""
+    turk_task_writer = TurkTaskWriter(
+        turk_csv_name, context_size, num_negative_matches_to_show,
+        random_seed, stratify_negative_matches, shard_size, max_note_chars)
+    for note_phrase_matches in phrase_matches_by_note:
+        turk_task_writer.add_note_phrase_matches(note_phrase_matches)
+    return turk_task_writer.close()
+
+
+class TurkTaskWriter(object):
+    """Writes the localturk tasks of notes as their matches are found, so
+    the notes don't have to be kept until all of them are searched.
+
+    The row of a note with a match is written as soon as it is added, and
+    the sampled notes without a match when the writer is closed, as
+    _iterate_turk_verification_rows orders them. Rows are written to
+    turk_csv_name, or if shard_size is given, to the shards of a
+    TurkShardWriter.
+    """
+    def __init__(self, turk_csv_name, context_size,
+                 num_negative_matches_to_show=0, random_seed=None,
+                 stratify_negative_matches=False, shard_size=None,
+                 max_note_chars=None):
+        self.turk_rows = TurkVerificationRows(
+            context_size, num_negative_matches_to_show, random_seed,
+            stratify_negative_matches, max_note_chars)
+        self.shard_writer = None
+        self.turk_csv = None
+        if shard_size is not None:
+            self.shard_writer = TurkShardWriter(turk_csv_name, shard_size)
+        else:
+            self.turk_csv = compat.open_csv(turk_csv_name, 'w')
+            self.csvwriter = csv.writer(self.turk_csv)
+            self.csvwriter.writerow(TURK_CSV_HEADER)
+        self.num_rows = 0
+
+    def add_note_phrase_matches(self, note_phrase_matches):
+        row = self.turk_rows.get_row(note_phrase_matches)
+        if row is not None:
+            self._add_row(row)
+
+    def _add_row(self, row):
+        if self.shard_writer is not None:
+            self.shard_writer.add_row(row)
+        else:
+            self.csvwriter.writerow(row)
+        self.num_rows += 1
+
+    def close(self):
+        """Write the rows of the sampled notes without a match, finish the
+        file or shards and return the number of rows."""
+        for row in self.turk_rows.iterate_negative_rows():
+            self._add_row(row)
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+        else:
+            self.turk_csv.close()
+        return self.num_rows
+
+
+def get_turk_shard_filename(turk_csv_name, shard_number):
+    """Return the filename of shard shard_number, counting from 1, e.g.
+    localturk/tasks_0001.csv for localturk/tasks.csv."""
+    base_filename, extension = os.path.splitext(turk_csv_name)
+    return '%s_%04d%s' % (base_filename, shard_number, extension or '.csv')
+
+
+def get_turk_manifest_filename(turk_csv_name):
+    return os.path.splitext(turk_csv_name)[0] + '_manifest.json'
+
+
+def _write_json_atomically(filename, value):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as json_file:
+        json.dump(value, json_file, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+    os.rename(temp_filename, filename)
+
+
+class TurkShardWriter(object):
+    """Writes rows to shard files of up to shard_size rows, each with the
+    localturk header.
+
+    A manifest listing the finished shards is rewritten after each shard,
+    so the first shards can be loaded into localturk while later ones are
+    still being written. Its complete field is true once the writer is
+    closed, which also removes the shards of an earlier run that wrote more
+    shards than this one.
+    """
+    def __init__(self, turk_csv_name, shard_size):
+        if shard_size < 1:
+            raise ValueError('Shard size must be at least 1, got %d' %
+                             shard_size)
+        self.turk_csv_name = turk_csv_name
+        self.shard_size = shard_size
+        self.manifest_filename = get_turk_manifest_filename(turk_csv_name)
+        self.manifest = {'shard_size': shard_size, 'num_tasks': 0,
+                         'shards': [], 'complete': False}
+        _write_json_atomically(self.manifest_filename, self.manifest)
+        self.shard_rows = []
+
+    def add_row(self, row):
+        self.shard_rows.append(row)
+        if len(self.shard_rows) == self.shard_size:
+            self._write_shard()
+            _write_json_atomically(self.manifest_filename, self.manifest)
+
+    def _write_shard(self):
+        shard_filename = get_turk_shard_filename(
+            self.turk_csv_name, len(self.manifest['shards']) + 1)
+        with compat.open_csv(shard_filename, 'w') as turk_csv:
+            csvwriter = csv.writer(turk_csv)
+            csvwriter.writerow(TURK_CSV_HEADER)
+            csvwriter.writerows(self.shard_rows)
+        self.manifest['shards'].append({
+            'filename': os.path.basename(shard_filename),
+            'num_tasks': len(self.shard_rows)})
+        self.manifest['num_tasks'] += len(self.shard_rows)
+        self.shard_rows = []
+
+    def close(self):
+        """Write the last shard and the complete manifest, and return the
+        number of rows."""
+        if self.shard_rows:
+            self._write_shard()
+        shard_number = len(self.manifest['shards']) + 1
+        while os.path.exists(get_turk_shard_filename(self.turk_csv_name,
+                                                     shard_number)):
+            os.remove(get_turk_shard_filename(self.turk_csv_name,
+                                              shard_number))
+            shard_number += 1
+        self.manifest['complete'] = True
+        _write_json_atomically(self.manifest_filename, self.manifest)
+        logging.info('Wrote %d turk tasks to %d shards listed in %s' % (
+            self.manifest['num_tasks'], len(self.manifest['shards']),
+            self.manifest_filename))
+        return self.manifest['num_tasks']
+
+
+def _write_turk_verification_shards(rows, turk_csv_name, shard_size):
+    """Write rows with a TurkShardWriter and return the number of rows."""
+    shard_writer = TurkShardWriter(turk_csv_name, shard_size)
+    for row in rows:
+        shard_writer.add_row(row)
+    return shard_writer.close()
+
+
+def _get_turk_verification_rows(
+        phrase_matches_by_note, context_size, num_negative_matches_to_show=0,
+        random_seed=None, stratify_negative_matches=False,
+        max_note_chars=None):
+    """Return a list of the rows of _iterate_turk_verification_rows."""
+    return list(_iterate_turk_verification_rows(
+        phrase_matches_by_note, context_size, num_negative_matches_to_show,
+        random_seed, stratify_negative_matches, max_note_chars))
+
+
+def _iterate_turk_verification_rows(
+        phrase_matches_by_note, context_size, num_negative_matches_to_show=0,
+        random_seed=None, stratify_negative_matches=False,
+        max_note_chars=None):
     """Convert the notes to HTML with regex extracted value bolded.
 
-    Return only rows for which there was a value extracted. I.e. if extracting
+    Yield only rows for which there was a value extracted. I.e. if extracting
     a numerical value, only rows with a non-None value will be returned. If
     checking phrase presence, only rows with a 1 binary value indicating phrase
     presence will be included.
 
     If context_size is specified, it will return context_size words before and
     after each match, with each match separated by line breaks.
+
+    If max_note_chars is specified, longer notes are cut down to about that
+    many characters around their matches before being converted to HTML.
+
+    Up to num_negative_matches_to_show notes without matches are sampled
+    with a seeded reservoir sampler as the notes are read, optionally
+    stratified by report type, and yielded at the end.
     """
-    return_rows = []
-    non_match_notes = []  # indices in phrase_matches_by_note
+    turk_rows = TurkVerificationRows(
+        context_size, num_negative_matches_to_show, random_seed,
+        stratify_negative_matches, max_note_chars)
     for note_phrase_matches in phrase_matches_by_note:
+        row = turk_rows.get_row(note_phrase_matches)
+        if row is not None:
+            yield row
+    for row in turk_rows.iterate_negative_rows():
+        yield row
+
+
+class TurkVerificationRows(object):
+    """Converts notes to the rows of _iterate_turk_verification_rows one
+    note at a time, sampling the notes without matches."""
+    def __init__(self, context_size, num_negative_matches_to_show=0,
+                 random_seed=None, stratify_negative_matches=False,
+                 max_note_chars=None):
+        self.context_size = context_size
+        self.max_note_chars = max_note_chars
+        if stratify_negative_matches:
+            self.negative_match_sampler = StratifiedReservoirSampler(
+                num_negative_matches_to_show,
+                lambda note_phrase_matches: (
+                    note_phrase_matches.rpdr_note.report_type),
+                random_seed)
+        else:
+            self.negative_match_sampler = ReservoirSampler(
+                num_negative_matches_to_show, random_seed)
+
+    def get_row(self, note_phrase_matches):
+        """Return the row of a note with matches, or None for a note without
+        matches, which is sampled instead."""
+        context_size = self.context_size
         rpdr_note = note_phrase_matches.rpdr_note.note
-        html_note = ''  # extra variable used for context_size matches
+        html_note = b''  # extra variable used for context_size matches
         note_offset = 0  # offset due to HTML formatting
-        if not note_phrase_matches.phrase_matches:  # no matches
-            non_match_notes.append(note_phrase_matches)
-            continue
-        for phrase_match in note_phrase_matches.phrase_matches:
-            match_start = phrase_match.match_start + note_offset
-            match_end = phrase_match.match_end + note_offset
-            extracted_value_html = ("<span class='highlight'>%s</span>" %
+        phrase_matches = note_phrase_matches.get_matches()
+        if not phrase_matches:  # no matches
+            self.negative_match_sampler.add(note_phrase_matches)
+            return None
+        matches = [(match_start, match_end)
+                   for match_start, match_end, _, _ in phrase_matches]
+        if self.max_note_chars is not None:
+            rpdr_note, matches = _truncate_note_around_matches(
+                rpdr_note, matches, self.max_note_chars)
+        for match_start, match_end in matches:
+            match_start += note_offset
+            match_end += note_offset
+            extracted_value_html = (b"<span class='highlight'>%s</span>" %
                                     rpdr_note[match_start:match_end])
             # if context_size specified, only get a small context pre/post
             if context_size is not None:
-                pre_match_words = ' '.join(
-                    rpdr_note[:match_start].split(' ')[-context_size:])
-                post_match_words = ' '.join(
-                    rpdr_note[match_end:].split(' ')[:context_size])
+                pre_match_words = b' '.join(
+                    rpdr_note[:match_start].split(b' ')[-context_size:])
+                post_match_words = b' '.join(
+                    rpdr_note[match_end:].split(b' ')[:context_size])
                 html_note += (pre_match_words + extracted_value_html +
-                              post_match_words + '<br><br>')
+                              post_match_words + b'<br><br>')
             rpdr_note = (rpdr_note[:match_start] + extracted_value_html +
                          rpdr_note[match_end:])
             if context_size is None:
@@ -318,75 +1814,356 @@ def _write_turk_verification_csv(
         # were multiple matches. this is obviously correct when doing phrase
         # matches. this might not be correct behavior when extracting
         # numerical values, however.
-        extracted_value = note_phrase_matches.phrase_matches[0].extracted_value
-        return_rows.append((
-            html_note, extracted_value, note_phrase_matches.rpdr_note.empi,
-            note_phrase_matches.rpdr_note.report_number))
-
-    num_negative_matches_to_show = min(num_negative_matches_to_show,
-                                       len(non_match_notes))
-    if non_match_notes:
-        negative_matches_to_show = np.random.choice(
-            non_match_notes, num_negative_matches_to_show)
-    else:
-        negative_matches_to_show = []
-    for note_phrase_matches in negative_matches_to_show:
-        html_note = _html_clean_rpdr_note(note_phrase_matches.rpdr_note.note)
-        extracted_value = None
-        return_rows.append((
-            html_note, extracted_value, note_phrase_matches.rpdr_note.empi,
-            note_phrase_matches.rpdr_note.report_number))
+        _, _, _, extracted_value = phrase_matches[0]
+        return (compat.to_str(html_note), extracted_value,
+                compat.to_str(note_phrase_matches.rpdr_note.empi),
+                compat.to_str(note_phrase_matches.rpdr_note.report_number))
 
-    with open(turk_csv_name, 'wb') as turk_csv:
-        csvwriter = csv.writer(turk_csv)
-        csvwriter.writerow(['image1', 'guess', 'empi', 'report_number'])
-        csvwriter.writerows(return_rows)
-    return return_rows
+    def iterate_negative_rows(self):
+        """Yield the rows of the sampled notes without matches."""
+        for note_phrase_matches in self.negative_match_sampler.get_sample():
+            rpdr_note = note_phrase_matches.rpdr_note.note
+            if self.max_note_chars is not None:
+                rpdr_note, _ = _truncate_note_around_matches(
+                    rpdr_note, [], self.max_note_chars)
+            html_note = _html_clean_rpdr_note(rpdr_note)
+            extracted_value = None
+            yield (compat.to_str(html_note), extracted_value,
+                   compat.to_str(note_phrase_matches.rpdr_note.empi),
+                   compat.to_str(note_phrase_matches.rpdr_note.report_number))
 
 
-def _write_csv_output(note_phrase_matches, output_filename):
+def _write_csv_output(note_phrase_matches, output_filename,
+                      include_source_filename=False):
     """Write one CSV row for each phrase_match where the row contains all of
     the RPDR note keys along with the extracted numerical value at the end of
-    the row."""
-    rpdr_rows_with_regex_value = []
+    the row, followed by the note's file if include_source_filename is
+    True."""
+    csv_output_writer = CSVOutputWriter(output_filename,
+                                        include_source_filename)
     for phrase_matches in note_phrase_matches:
-        row = phrase_matches.rpdr_note.get_keys()
-        if not phrase_matches.phrase_matches:
-            extracted_value = None
-        else:
-            extracted_value = phrase_matches.phrase_matches[0].extracted_value
-        row.append(extracted_value)
-        rpdr_rows_with_regex_value.append(row)
+        csv_output_writer.add_note_phrase_matches(phrase_matches)
+    csv_output_writer.close()
+
+
+class CSVOutputWriter(object):
+    """Writes the rows of _write_csv_output one note at a time."""
+    def __init__(self, output_filename, include_source_filename=False):
+        self.include_source_filename = include_source_filename
+        self.output_file = compat.open_csv(output_filename, 'w')
+        self.csv_writer = csv.writer(self.output_file)
+
+    def add_note_phrase_matches(self, phrase_matches):
+        self.csv_writer.writerow(_get_csv_output_row(
+            phrase_matches, self.include_source_filename))
+
+    def close(self):
+        self.output_file.close()
+
+
+def _get_csv_output_rows(note_phrase_matches, include_source_filename=False):
+    """Return the rows written by _write_csv_output."""
+    return [_get_csv_output_row(phrase_matches, include_source_filename)
+            for phrase_matches in note_phrase_matches]
+
 
-    with open(output_filename, 'wb') as output_file:
+def _get_csv_output_row(phrase_matches, include_source_filename=False):
+    row = [compat.to_str(key) for key in phrase_matches.rpdr_note.get_keys()]
+    if not phrase_matches.num_matches:
+        extracted_value = None
+    else:
+        extracted_value = phrase_matches.get_first_match().extracted_value
+    row.append(extracted_value)
+    if include_source_filename:
+        row.append(phrase_matches.rpdr_note.source_filename)
+    return row
+
+
+def _write_aggregate_csv_output(patient_aggregator, output_filename,
+                                include_source_filename=False):
+    """Write one CSV row per patient with the keys of the patient's earliest
+    note and the aggregated value at the end of the row."""
+    with compat.open_csv(output_filename, 'w') as output_file:
         csv_writer = csv.writer(output_file)
-        csv_writer.writerows(rpdr_rows_with_regex_value)
+        csv_writer.writerows(
+            patient_aggregator.get_rows(include_source_filename))
+
+
+class ExtractionOutputs(object):
+    """The files an ExtractionRun writes: the output CSV, the localturk tasks
+    and, if match_store_filename is given, a match store. The turk options
+    are those of _write_turk_verification_csv."""
+    def __init__(self, output_filename, turk_csv_filename, context_size=None,
+                 num_negative_matches_to_show=0, turk_random_seed=None,
+                 stratify_negative_matches=False, turk_shard_size=None,
+                 turk_max_note_chars=None, match_store_filename=None):
+        self.output_filename = output_filename
+        self.turk_csv_filename = turk_csv_filename
+        self.context_size = context_size
+        self.num_negative_matches_to_show = num_negative_matches_to_show
+        self.turk_random_seed = turk_random_seed
+        self.stratify_negative_matches = stratify_negative_matches
+        self.turk_shard_size = turk_shard_size
+        self.turk_max_note_chars = turk_max_note_chars
+        self.match_store_filename = match_store_filename
+
+    def write(self, note_phrase_matches, query, patient_aggregator=None,
+              include_source_filename=False):
+        """Write the outputs for note_phrase_matches, found with query, one
+        note at a time, so note_phrase_matches may be an iterator that
+        searches the notes as they are written. With patient_aggregator, the
+        output CSV has its rows instead, written once all notes are
+        searched."""
+        writers = [TurkTaskWriter(
+            self.turk_csv_filename, self.context_size,
+            self.num_negative_matches_to_show, self.turk_random_seed,
+            self.stratify_negative_matches, self.turk_shard_size,
+            self.turk_max_note_chars)]
+        if patient_aggregator is None:
+            writers.append(CSVOutputWriter(self.output_filename,
+                                           include_source_filename))
+        if self.match_store_filename is not None:
+            writers.append(match_store.MatchStoreWriter(
+                self.match_store_filename, query.phrase_type,
+                query.entered_phrases, query.ignore_punctuation))
+        for phrase_matches in note_phrase_matches:
+            for writer in writers:
+                writer.add_note_phrase_matches(phrase_matches)
+        for writer in writers:
+            writer.close()
+        if patient_aggregator is not None:
+            _write_aggregate_csv_output(patient_aggregator,
+                                        self.output_filename,
+                                        include_source_filename)
+
+
+class ExtractionRun(object):
+    """Searches the notes of input_filenames, or of the shared corpus named
+    shared_corpus_name, for the phrases of query, as extract_values.py does:
+
+        extraction_run = ExtractionRun(query, ['notes.txt'], aggregate='max')
+        extraction_run.run(ExtractionOutputs('output.csv', 'tasks.csv'))
+
+    The options are those of main. Options that can't be combined raise an
+    exception here, before any notes are read.
+    """
+    def __init__(self, query, input_filenames, input_format='rpdr',
+                 group_by_patient=False, aggregate=None, index_filename=None,
+                 max_memory=None, spill_dir=None, deduplicate_text=False,
+                 workers=1, sample_notes=None, sample_fraction=None,
+                 sample_seed=None, shared_corpus_name=None,
+                 log_slow_notes=None, show_n_words_context_before=0,
+                 show_n_words_context_after=0):
+        if isinstance(input_filenames, compat.string_types):
+            input_filenames = [input_filenames]
+        if shared_corpus_name is not None and input_filenames:
+            raise Exception('Input files can not be given with '
+                            '--shared_corpus.')
+        self.sample = sample_notes is not None or sample_fraction is not None
+        self.max_contexts = None
+        if self.sample:
+            if shared_corpus_name is not None:
+                raise Exception('Sampling notes can not be combined with '
+                                '--shared_corpus.')
+            if group_by_patient or aggregate is not None or index_filename:
+                raise Exception('Sampling notes can not be combined with '
+                                'group_by_patient, aggregate or '
+                                'index_filename.')
+            if (not show_n_words_context_before and
+                    not show_n_words_context_after):
+                show_n_words_context_before = SAMPLE_CONTEXT_WORDS
+                show_n_words_context_after = SAMPLE_CONTEXT_WORDS
+            self.max_contexts = SAMPLE_TOP_CONTEXTS
+        if aggregate is not None:
+            # Checks the aggregate before any notes are read.
+            PatientAggregator(aggregate, query.phrase_type)
+            # Aggregation is per patient, so notes don't need to be
+            # concatenated.
+            group_by_patient = False
+        self.query = query
+        self.input_filenames = input_filenames
+        self.input_format = input_format
+        self.group_by_patient = group_by_patient
+        self.aggregate = aggregate
+        self.index_filename = index_filename
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.deduplicate_text = deduplicate_text
+        self.workers = workers
+        self.sample_notes = sample_notes
+        self.sample_fraction = sample_fraction
+        self.sample_seed = sample_seed
+        self.shared_corpus_name = shared_corpus_name
+        self.log_slow_notes = log_slow_notes
+        self.show_n_words_context_before = show_n_words_context_before
+        self.show_n_words_context_after = show_n_words_context_after
+
+    def run(self, outputs):
+        """Search the notes and write the results to outputs, an
+        ExtractionOutputs."""
+        corpus = None
+        if self.shared_corpus_name is not None:
+            # shared_corpus imports this module, so it's imported when needed.
+            import shared_corpus
+            corpus = shared_corpus.attach_shared_corpus(
+                self.shared_corpus_name)
+            input_filenames = corpus.input_filenames
+            input_format = corpus.input_format
+        else:
+            input_filenames = _expand_input_filenames(self.input_filenames)
+            input_format = self.input_format
+        # Rows are only labelled with their file when there are several files.
+        include_source_filename = len(input_filenames) > 1
+        rpdr_note_index = self._open_note_index(input_filenames, input_format)
+        patient_aggregator = None
+        if self.aggregate is not None:
+            patient_aggregator = PatientAggregator(self.aggregate,
+                                                   self.query.phrase_type)
+        memory_budget = None
+        if self.max_memory is not None and not self.sample:
+            memory_budget = memory_budget_module.MemoryBudget(
+                self.max_memory, self.spill_dir)
+        if self.sample:
+            rpdr_notes, num_notes = _sample_notes(
+                input_filenames, input_format, self.sample_notes,
+                self.sample_fraction, self.sample_seed)
+            num_sampled_notes = len(rpdr_notes)
+            rpdr_notes = list(self.query.filter_notes(rpdr_notes))
+        else:
+            rpdr_notes = self._read_notes(corpus, input_filenames,
+                                          input_format, memory_budget)
+        # The outputs are written as the notes are searched, so the matches
+        # of a note are freed once it is written.
+        note_phrase_matches = self._iterate_phrase_matches(
+            rpdr_notes, corpus, rpdr_note_index, patient_aggregator)
+        if self.sample:
+            # Sampled notes are few, so their matches are kept for counting.
+            note_phrase_matches = list(note_phrase_matches)
+            _print_sample_prevalence(note_phrase_matches, num_sampled_notes,
+                                     num_notes)
+        outputs.write(note_phrase_matches, self.query, patient_aggregator,
+                      include_source_filename)
+        if rpdr_note_index is not None:
+            rpdr_note_index.close()
+
+    def _open_note_index(self, input_filenames, input_format):
+        """Return the NoteIndex of index_filename, or None if there is none
+        or it can't answer the query."""
+        if self.index_filename is None:
+            return None
+        if len(input_filenames) > 1:
+            raise Exception('--index_filename can only be used with a single '
+                            'input file.')
+        if not self.query.can_use_note_index(self.group_by_patient):
+            logging.warning('Not using index %s, it can only be used to check'
+                            ' for the presence of literal phrases without '
+                            'ignore_punctuation or group_by_patient.' %
+                            self.index_filename)
+            return None
+        rpdr_note_index = note_index.NoteIndex(self.index_filename)
+        rpdr_note_index.check_source(input_filenames[0], input_format)
+        return rpdr_note_index
+
+    def _read_notes(self, corpus, input_filenames, input_format,
+                    memory_budget):
+        """Return the notes to search, kept by the report filters and, for
+        group_by_patient, joined per patient."""
+        if corpus is not None:
+            # Notes only hold their offsets in the corpus, so they are cheap
+            # to keep in memory.
+            rpdr_notes = self.query.filter_notes(corpus)
+        elif memory_budget is not None:
+            # Notes are streamed from the reader, and grouped notes and
+            # matches are spilled to disk when the budget is exceeded.
+            rpdr_notes = self.query.filter_notes(
+                _iterate_notes_from_files(input_filenames, input_format))
+        else:
+            rpdr_notes = list(self.query.filter_notes(_read_notes_from_files(
+                input_filenames, input_format, self.workers)))
+        if self.group_by_patient and memory_budget is not None:
+            rpdr_notes = _iterate_rpdr_notes_grouped_by_patient(
+                rpdr_notes, memory_budget)
+        elif self.group_by_patient:
+            rpdr_notes = _group_rpdr_notes_by_patient(rpdr_notes)
+        return rpdr_notes
+
+    def _iterate_phrase_matches(self, rpdr_notes, corpus, rpdr_note_index,
+                                patient_aggregator):
+        """Yield the NotePhraseMatches of rpdr_notes as they are searched,
+        then print the match contexts and slow notes."""
+        slow_note_log = None
+        if self.log_slow_notes:
+            slow_note_log = profiling.SlowNoteLog(self.log_slow_notes)
+        if (corpus is not None and self.workers > 1 and
+                not self.group_by_patient and rpdr_note_index is None):
+            import shared_corpus
+            for phrase_matches in shared_corpus.iterate_phrase_matches(
+                    corpus, rpdr_notes, self.query.phrase_type,
+                    self.query.entered_phrases, self.query.ignore_punctuation,
+                    self.show_n_words_context_before,
+                    self.show_n_words_context_after, self.workers,
+                    patient_aggregator, self.deduplicate_text,
+                    self.max_contexts, slow_note_log):
+                yield phrase_matches
+        else:
+            match_contexts = PhraseMatchContexts(
+                self.show_n_words_context_before,
+                self.show_n_words_context_after)
+            for phrase_matches in self.query.iterate_phrase_matches(
+                    rpdr_notes, match_contexts, patient_aggregator,
+                    rpdr_note_index, self.deduplicate_text, slow_note_log):
+                yield phrase_matches
+            match_contexts.print_ordered_contexts(self.max_contexts)
+        if slow_note_log is not None:
+            slow_note_log.print_slow_notes()
 
 
-def main(input_filename, output_filename, phrase_type, phrases,
+def main(input_filenames, output_filename, phrase_type, phrases,
          report_description, report_type, group_by_patient, context_size,
          ignore_punctuation, turk_csv_filename, num_negative_matches_to_show,
-         show_n_words_context_before, show_n_words_context_after):
-    rpdr_notes = _parse_rpdr_text_file(input_filename)
-    rpdr_notes = _filter_rpdr_notes_by_column_val(
-        rpdr_notes, report_description, report_type)
-    if group_by_patient:
-        rpdr_notes = _group_rpdr_notes_by_patient(rpdr_notes)
-
-    note_phrase_matches = _extract_values_from_rpdr_notes(
-        rpdr_notes, phrase_type, phrases, ignore_punctuation,
-        show_n_words_context_before, show_n_words_context_after)
-    _write_csv_output(note_phrase_matches, output_filename)
-
-    _write_turk_verification_csv(
-        note_phrase_matches, phrases, context_size, turk_csv_filename,
-        num_negative_matches_to_show)
+         show_n_words_context_before, show_n_words_context_after,
+         input_format='rpdr', aggregate=None, index_filename=None,
+         turk_random_seed=None, stratify_negative_turk_matches=False,
+         max_memory=None, spill_dir=None, deduplicate_text=False, workers=1,
+         match_store_filename=None, turk_shard_size=None,
+         turk_max_note_chars=None, sample_notes=None, sample_fraction=None,
+         sample_seed=None, shared_corpus_name=None, log_slow_notes=None):
+    query = ExtractionQuery(phrases, phrase_type, ignore_punctuation,
+                            report_description, report_type)
+    extraction_run = ExtractionRun(
+        query, input_filenames, input_format, group_by_patient, aggregate,
+        index_filename, max_memory, spill_dir, deduplicate_text, workers,
+        sample_notes, sample_fraction, sample_seed, shared_corpus_name,
+        log_slow_notes, show_n_words_context_before,
+        show_n_words_context_after)
+    extraction_run.run(ExtractionOutputs(
+        output_filename, turk_csv_filename, context_size,
+        num_negative_matches_to_show, turk_random_seed,
+        stratify_negative_turk_matches, turk_shard_size, turk_max_note_chars,
+        match_store_filename))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_filename',
-                        help=('Path to an RPDR formatted '
-                              'text file, e.g. /Users/user1/../file.txt'))
+    parser.add_argument('input_filenames', nargs='*',
+                        help=('Paths to RPDR formatted text files, e.g. '
+                              '/Users/user1/../file.txt. Directories and glob'
+                              ' patterns such as "notes/*.txt" read every '
+                              'file they match.'))
+    parser.add_argument(
+        '--shared_corpus', help=(
+            'Name of a corpus loaded into shared memory with '
+            '"shared_corpus.py create", to read the notes from instead of '
+            'input files.'))
+    parser.add_argument(
+        '--workers', type=int, default=1, help=(
+            'Number of input files to parse at the same time, each in its '
+            'own process, or with --shared_corpus, the number of processes '
+            'searching the notes. Defaults to 1.'))
+    parser.add_argument(
+        '--input_format', default='rpdr', choices=sorted(NOTE_READERS),
+        help=('Format of the input file. "dfci" reads DFCI clinical notes '
+              'files directly without converting them to RPDR first. '
+              'Defaults to rpdr.'))
     parser.add_argument('--output_filename', default='output.csv',
                         help=('Path to csv file to output results. Defaults to'
                               ' ./output.csv'))
@@ -417,6 +2194,25 @@ if __name__ == '__main__':
             'Enabling this also means that only some context for the extracted'
             'value will be displayed on localturk instead of the entire '
             'patient note.'))
+    parser.add_argument(
+        '--aggregate', choices=AGGREGATE_MODES, help=(
+            'Output one row per patient with the values extracted from all of '
+            'the patient\'s notes aggregated with this function. first and '
+            'last are by report date, min and max compare extracted dates as '
+            'dates, mean requires --extract_numerical_value and all lists '
+            'every value separated by ";". Patient notes are not '
+            'concatenated, so localturk shows each note separately.'))
+    parser.add_argument(
+        '--index_filename', help=(
+            'Path to an index of the input file built with note_index.py. '
+            'If given, phrase presence is looked up in the index instead of '
+            'scanning every note.'))
+    parser.add_argument(
+        '--match_store', help=(
+            'Path to an SQLite file to save every note and match to, from '
+            'which match_store.py can write the output CSV, localturk tasks '
+            'and match contexts again with different options, without '
+            'searching the notes again.'))
     parser.add_argument('--context_size', type=int, help=(
         'Amount of context to show before/after a match (number of words).'))
     parser.add_argument(
@@ -427,11 +2223,62 @@ if __name__ == '__main__':
         '--num_negative_turk_matches_to_show', type=int, default=0, help=(
             'Turk verification will ask to verify all positive matches, and '
             'up to this many negative matches.'))
+    parser.add_argument(
+        '--turk_random_seed', type=int, help=(
+            'Seed for sampling the negative matches shown for turk '
+            'verification, so the same notes are sampled on every run.'))
+    parser.add_argument(
+        '--stratify_negative_turk_matches', default=False,
+        action='store_true', help=(
+            'Sample negative matches from each report type in proportion to '
+            'the number of negative matches of that report type.'))
+    parser.add_argument(
+        '--turk_shard_size', type=int, help=(
+            'Write the turk verification tasks to numbered files of this many '
+            'tasks each, e.g. localturk/tasks_0001.csv, along with '
+            'localturk/tasks_manifest.json listing the finished files, '
+            'instead of a single file.'))
+    parser.add_argument(
+        '--turk_max_note_chars', type=int, help=(
+            'Cut notes longer than this many characters down to the text '
+            'around their matches for turk verification, so very long notes '
+            'don\'t slow down localturk.'))
     parser.add_argument(
         '--ignore_punctuation', default=False, action='store_true', help=(
             'If specified, punctuation characters will be ignored when '
             'finding a match. E.g. "full code confirmed" would also match '
             '"full code (confirmed)" and "full code -- confirmed".'))
+    parser.add_argument(
+        '--max_memory', type=memory_budget_module.parse_memory_size, help=(
+            'Memory limit such as 512M or 2G. Notes are read one at a time, '
+            'and notes grouped by patient are moved to temporary files on '
+            'disk whenever their estimated size or the measured resident '
+            'memory of the process exceeds the limit, so large inputs run '
+            'slower instead of running out of memory.'))
+    parser.add_argument(
+        '--spill_dir', help=(
+            'Directory for the temporary files written with --max_memory. '
+            'Defaults to the system temporary directory.'))
+    parser.add_argument(
+        '--sample_notes', type=int, help=(
+            'Only search a random sample of this many notes, and print the '
+            'estimated share of notes with a match and the most frequent '
+            'match contexts. Useful for quickly trying out phrases on a '
+            'large file.'))
+    parser.add_argument(
+        '--sample_fraction', type=float, help=(
+            'Like --sample_notes, but sample this fraction of the notes, '
+            'e.g. 0.01.'))
+    parser.add_argument(
+        '--sample_seed', type=int, help=(
+            'Seed for --sample_notes and --sample_fraction, so the same '
+            'notes are sampled on every run.'))
+    parser.add_argument(
+        '--deduplicate_text', default=False, action='store_true', help=(
+            'Match each distinct note text only once, and if all phrases are '
+            'literal phrases, each distinct paragraph too, reusing the '
+            'matches wherever the same text appears again, e.g. in copied '
+            'forward notes. Results are the same as without it.'))
     parser.add_argument('--verbosity', '-v', action='count')
     parser.add_argument(
         '--show_n_words_context_before', type=int, default=0,
@@ -445,13 +2292,21 @@ if __name__ == '__main__':
             'If specified, N words of context will be printed to the '
             'console after each text match in order of and along with '
             'their frequency of occuring in the text.'))
+    parser.add_argument(
+        '--log_slow_notes', type=int, metavar='N', help=(
+            'Print the N notes that took longest to match for each phrase, '
+            'with their note number, file, EMPI, report number and '
+            'length.'))
+    profiling.add_profile_arguments(parser)
     parser.add_argument('--v', action='count')
 
     args = parser.parse_args()
+    if not args.input_filenames and args.shared_corpus is None:
+        parser.error('Expected input files or --shared_corpus.')
 
     if args.verbosity == 1:
         logging.basicConfig(filename='extraction.log', level=logging.INFO)
-    elif args.verbosity > 1:
+    elif args.verbosity:
         logging.basicConfig(filename='extraction.log', level=logging.DEBUG)
 
     if not args.extract_numerical_value:
@@ -462,7 +2317,7 @@ if __name__ == '__main__':
     if args.context_size is None and args.group_by_patient:
         args.context_size = 10
     logging.debug('%s from %s and outputting rows to %s.' %
-                  (extract_type_string, args.input_filename,
+                  (extract_type_string, ', '.join(args.input_filenames),
                    args.output_filename))
     phrases = args.phrases.split(',')
 
@@ -470,6 +2325,13 @@ if __name__ == '__main__':
         raise Exception('Cannot both extract_numerical_value and extract_date'
                         '. Choose one option.')
 
+    if args.sample_notes is not None and args.sample_fraction is not None:
+        raise Exception('Cannot both sample_notes and sample_fraction. Choose '
+                        'one option.')
+    if args.sample_fraction is not None and not 0 < args.sample_fraction <= 1:
+        raise Exception('--sample_fraction must be between 0 and 1.')
+
+
     if args.extract_numerical_value:
         phrase_type = PHRASE_TYPE_NUM
     elif args.extract_date:
@@ -477,8 +2339,16 @@ if __name__ == '__main__':
     else:
         phrase_type = PHRASE_TYPE_WORD
 
-    main(args.input_filename, args.output_filename, phrase_type, phrases,
-         args.report_description, args.report_type, args.group_by_patient,
-         args.context_size, args.ignore_punctuation,
-         args.turk_csv_filename, args.num_negative_turk_matches_to_show,
-         args.show_n_words_context_before, args.show_n_words_context_after)
+    profiling.run_profiled(
+        args.profile, args.profile_dir, 'extract_values', main,
+        args.input_filenames, args.output_filename, phrase_type, phrases,
+        args.report_description, args.report_type, args.group_by_patient,
+        args.context_size, args.ignore_punctuation,
+        args.turk_csv_filename, args.num_negative_turk_matches_to_show,
+        args.show_n_words_context_before, args.show_n_words_context_after,
+        args.input_format, args.aggregate, args.index_filename,
+        args.turk_random_seed, args.stratify_negative_turk_matches,
+        args.max_memory, args.spill_dir, args.deduplicate_text,
+        args.workers, args.match_store, args.turk_shard_size,
+        args.turk_max_note_chars, args.sample_notes, args.sample_fraction,
+        args.sample_seed, args.shared_corpus, args.log_slow_notes)
@@ -1,27 +1,36 @@
+import csv
+import gc
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import weakref
 
+import compat
+import convert_dfci_to_rpdr
 import extract_values
 
 
 class TestFilterRPDRNotesByColumnVal(unittest.TestCase):
     def setUp(self):
         rpdr_note1 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, 'note1')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b'note1')
 
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi2', 'MRN_Type': 'mrn_type2',
-             'Report_Number': '1232', 'MRN': '1232',
-             'Report_Type': 'report_type2',
-             'Report_Description': 'report_description2'}, 'note2')
+            {'EMPI': b'empi2', 'MRN_Type': b'mrn_type2',
+             'Report_Number': b'1232', 'MRN': b'1232',
+             'Report_Type': b'report_type2',
+             'Report_Description': b'report_description2'}, b'note2')
 
         rpdr_note3 = extract_values.RPDRNote(
-            {'EMPI': 'empi3', 'MRN_Type': 'mrn_type3',
-             'Report_Number': '1233', 'MRN': '1233',
-             'Report_Type': 'report_type3',
-             'Report_Description': 'report_description3'}, 'note3')
+            {'EMPI': b'empi3', 'MRN_Type': b'mrn_type3',
+             'Report_Number': b'1233', 'MRN': b'1233',
+             'Report_Type': b'report_type3',
+             'Report_Description': b'report_description3'}, b'note3')
 
         self.rpdr_notes = [rpdr_note1, rpdr_note2, rpdr_note3]
 
@@ -34,50 +43,50 @@ class TestFilterRPDRNotesByColumnVal(unittest.TestCase):
     def test_one_filter_works(self):
         filtered_rpdr_notes = (
             extract_values._filter_rpdr_notes_by_column_val(
-                self.rpdr_notes, 'report_description1', None))
+                self.rpdr_notes, b'report_description1', None))
         self.assertEqual(1, len(filtered_rpdr_notes))
 
     def test_two_filters_work(self):
         filtered_rpdr_notes = (
             extract_values._filter_rpdr_notes_by_column_val(
-                self.rpdr_notes, 'report_description1',
-                'report_type1'))
+                self.rpdr_notes, b'report_description1',
+                b'report_type1'))
         self.assertEqual(1, len(filtered_rpdr_notes))
 
 
 class TestRegexPhraseMatch(unittest.TestCase):
     def setUp(self):
         self.rpdr_note = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, 'ventilate')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b'ventilate')
 
     def test_dont_match_at_start_of_longer_word(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['vent'], self.rpdr_note, phrase_match_context)
+            0, [b'vent'], self.rpdr_note, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(0, len(phrase_matches))
 
     def test_dont_match_at_end_of_longer_word(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ate'], self.rpdr_note, phrase_match_context)
+            0, [b'ate'], self.rpdr_note, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(0, len(phrase_matches))
 
     def test_dont_match_in_middle_of_longer_word(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['tila'], self.rpdr_note, phrase_match_context)
+            0, [b'tila'], self.rpdr_note, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(0, len(phrase_matches))
 
     def test_match_exact_single_phrase_begin_and_end(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], self.rpdr_note, phrase_match_context)
+            0, [b'ventilate'], self.rpdr_note, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -86,12 +95,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_space_surround1(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, ' ventilate')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b' ventilate')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -100,12 +109,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_space_surround2(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, ' ventilate ')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b' ventilate ')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -114,13 +123,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_surrounded_by_punctuation_ignore_true(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, ' (ventilate).')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b' (ventilate).')
         rpdr_note2.remove_punctuation_from_note()
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -129,13 +138,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_surrounded_by_punctuation_ignore_true_no_space(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, '(ventilate).')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b'(ventilate).')
         rpdr_note2.remove_punctuation_from_note()
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -144,13 +153,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_punctuation_ignore_true(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, ' ventilate.')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b' ventilate.')
         rpdr_note2.remove_punctuation_from_note()
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -159,12 +168,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_punctuation_ignore_false(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, ' ventilate.')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b' ventilate.')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -173,12 +182,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_punctuation2_ignore_false(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, ' ventilate?')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b' ventilate?')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -187,12 +196,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_beginning_punctuation_ignore_false(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, 'ventilate.')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b'ventilate.')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -201,13 +210,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_beginning_punctuation_ignore_true(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, 'ventilate.')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b'ventilate.')
         rpdr_note2.remove_punctuation_from_note()
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -216,12 +225,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_match_beginning_punctuation2(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'}, 'ventilate?')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'}, b'ventilate?')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         phrase_match = phrase_matches[0]
@@ -230,13 +239,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_multiple_matches_same_phrase(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ventilate ventilate')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ventilate ventilate')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(2, len(phrase_matches))
         for phrase_match in phrase_matches:
@@ -245,13 +254,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_many_matches_same_phrase(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ventilate ventilate alex alex alex ventilate, ventilate alex')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ventilate ventilate alex alex alex ventilate, ventilate alex')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(4, len(phrase_matches))
         for phrase_match in phrase_matches:
@@ -260,13 +269,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_multiple_matches_different_phrase(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ventilate g-tube')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ventilate g-tube')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            0, ['ventilate', 'g-tube'], rpdr_note2, phrase_match_context)
+            0, [b'ventilate', b'g-tube'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(2, len(phrase_matches))
         self.assertEqual(0, phrase_matches[0].match_start)
@@ -277,12 +286,12 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_multiple_matches_different_phrase_punctuation_in_phrase(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ventilate g-tube')
-        phrases = ['ventilate', 'g-tube']
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ventilate g-tube')
+        phrases = [b'ventilate', b'g-tube']
         phrases = [
             extract_values._remove_punctuation(phrase) for phrase in phrases]
         rpdr_note2.remove_punctuation_from_note()
@@ -298,13 +307,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_numerical(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ef 2.0')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ef 2.0')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            1, ['ef'], rpdr_note2, phrase_match_context)
+            1, [b'ef'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         self.assertEqual(2.0, phrase_matches[0].extracted_value)
@@ -312,13 +321,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_date_forward_slash(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'date is 02/22/2222')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'date is 02/22/2222')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            2, ['date'], rpdr_note2, phrase_match_context)
+            2, [b'date'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         self.assertEqual('02/22/2222', phrase_matches[0].extracted_value)
@@ -326,13 +335,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_date_dash(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'date is 02-22-2222')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'date is 02-22-2222')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            2, ['date'], rpdr_note2, phrase_match_context)
+            2, [b'date'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         self.assertEqual('02-22-2222', phrase_matches[0].extracted_value)
@@ -340,13 +349,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_date_two_digit_year(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'date is 02-22-22')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'date is 02-22-22')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            2, ['date'], rpdr_note2, phrase_match_context)
+            2, [b'date'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         self.assertEqual('02-22-22', phrase_matches[0].extracted_value)
@@ -354,13 +363,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_date_one_digit_month(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'date is 2-22-22')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'date is 2-22-22')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            2, ['date'], rpdr_note2, phrase_match_context)
+            2, [b'date'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         self.assertEqual('2-22-22', phrase_matches[0].extracted_value)
@@ -368,13 +377,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_date_one_digit_day(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'date is 2-2-22')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'date is 2-2-22')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            2, ['date'], rpdr_note2, phrase_match_context)
+            2, [b'date'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(1, len(phrase_matches))
         self.assertEqual('2-2-22', phrase_matches[0].extracted_value)
@@ -382,13 +391,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_multiple_numerical(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ef 2.0 alex alex ef 20.0')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ef 2.0 alex alex ef 20.0')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            1, ['ef'], rpdr_note2, phrase_match_context)
+            1, [b'ef'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(2, len(phrase_matches))
         self.assertEqual(2.0, phrase_matches[0].extracted_value)
@@ -397,13 +406,13 @@ class TestRegexPhraseMatch(unittest.TestCase):
     def test_extract_multiple_numerical_multiple_phrases(self):
         phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
         rpdr_note2 = extract_values.RPDRNote(
-            {'EMPI': 'empi1', 'MRN_Type': 'mrn_type1',
-             'Report_Number': '1231', 'MRN': '1231',
-             'Report_Type': 'report_type1',
-             'Report_Description': 'report_description1'},
-            'ef 2.0 alex alex ef 20.0 alex ejection fraction 4.0')
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+             'Report_Number': b'1231', 'MRN': b'1231',
+             'Report_Type': b'report_type1',
+             'Report_Description': b'report_description1'},
+            b'ef 2.0 alex alex ef 20.0 alex ejection fraction 4.0')
         note_phrase_matches = extract_values._extract_phrase_from_notes(
-            1, ['ef', 'ejection fraction'], rpdr_note2, phrase_match_context)
+            1, [b'ef', b'ejection fraction'], rpdr_note2, phrase_match_context)
         phrase_matches = note_phrase_matches.phrase_matches
         self.assertEqual(3, len(phrase_matches))
         self.assertEqual(2.0, phrase_matches[0].extracted_value)
@@ -411,5 +420,565 @@ class TestRegexPhraseMatch(unittest.TestCase):
         self.assertEqual(4.0, phrase_matches[2].extracted_value)
 
 
+class TestPhraseMatchTable(unittest.TestCase):
+    def test_notes_share_match_table(self):
+        phrase_match_context = extract_values.PhraseMatchContexts(0, 0)
+        match_table = extract_values.PhraseMatchTable(
+            extract_values.PHRASE_TYPE_NUM)
+        note_phrase_matches = []
+        for note in [b'ef 20 alex ef 30', b'no match',
+                     b'ejection fraction 40']:
+            rpdr_note = extract_values.RPDRNote(
+                {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+                 'Report_Number': b'1231', 'MRN': b'1231',
+                 'Report_Type': b'report_type1',
+                 'Report_Description': b'report_description1'}, note)
+            note_phrase_matches.append(
+                extract_values._extract_phrase_from_notes(
+                    1, [b'ejection fraction', b'ef'], rpdr_note,
+                    phrase_match_context, match_table))
+        self.assertEqual(3, len(match_table))
+        self.assertEqual(
+            [[20.0, 30.0], [], [40.0]],
+            [[phrase_match.extracted_value
+              for phrase_match in phrase_matches.phrase_matches]
+             for phrase_matches in note_phrase_matches])
+        phrase_match = note_phrase_matches[2].phrase_matches[0]
+        self.assertEqual(b'ejection fraction', phrase_match.phrase)
+        self.assertEqual(0, phrase_match.match_start)
+        self.assertEqual(20, phrase_match.match_end)
+
+    def test_accessors(self):
+        rpdr_note = extract_values.RPDRNote(
+            {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1', 'MRN': b'1231'},
+            b'ef 30 ef 20')
+        note_phrase_matches = extract_values.NotePhraseMatches(rpdr_note)
+        self.assertIsNone(note_phrase_matches.get_first_match())
+        note_phrase_matches.add_match(20.0, 6, 11, b'ef')
+        note_phrase_matches.add_match(30.0, 0, 5, b'ef')
+        self.assertEqual(2, note_phrase_matches.num_matches)
+        note_phrase_matches.finalize_phrase_matches()
+        self.assertEqual(2, note_phrase_matches.num_matches)
+        self.assertEqual(30.0,
+                         note_phrase_matches.get_first_match().extracted_value)
+        self.assertEqual([30.0, 20.0],
+                         note_phrase_matches.get_extracted_values())
+        self.assertEqual([(0, 5, b'ef', 30.0), (6, 11, b'ef', 20.0)],
+                         note_phrase_matches.get_matches())
+        self.assertRaises(AttributeError, getattr,
+                          note_phrase_matches.phrase_matches, 'append')
+
+
+class TestDeduplicatedMatching(unittest.TestCase):
+    NOTES = [
+        b'HPI: ef 20, vent\n\nExam: normal\r\n\r\nEF:\n\n35\n',
+        b'Plan: vent.\n\nHPI: ef 20, vent\n\nExam: normal\n',
+        b'HPI: ef 20, vent\n\nExam: normal\r\n\r\nEF:\n\n35\n',
+        b'ef\n\nwas 40 on 1/2/2010\n\n\nvent\n\n\ndate of\n\n3-4-2011',
+    ]
+
+    def _get_matches(self, phrase_type, phrases, text_match_cache):
+        matches = []
+        for note in self.NOTES:
+            rpdr_note = extract_values.RPDRNote(
+                {'EMPI': b'empi1', 'MRN_Type': b'mrn_type1',
+                 'Report_Number': b'1231', 'MRN': b'1231',
+                 'Report_Type': b'report_type1',
+                 'Report_Description': b'report_description1'}, note)
+            phrase_matches = extract_values._extract_phrase_from_notes(
+                phrase_type, phrases, rpdr_note,
+                extract_values.PhraseMatchContexts(0, 0),
+                text_match_cache=text_match_cache)
+            matches.append([
+                (phrase_match.extracted_value, phrase_match.match_start,
+                 phrase_match.match_end, phrase_match.phrase)
+                for phrase_match in phrase_matches.phrase_matches])
+        return matches
+
+    def test_same_matches_as_whole_notes(self):
+        for phrase_type, phrases in [
+                (extract_values.PHRASE_TYPE_WORD, [b'vent', b'exam', b'ef']),
+                (extract_values.PHRASE_TYPE_NUM, [b'ef', b'hpi: ef']),
+                (extract_values.PHRASE_TYPE_DATE, [b'on', b'date of']),
+                (extract_values.PHRASE_TYPE_NUM, [b'e.']),
+        ]:
+            text_match_cache = extract_values.TextMatchCache()
+            self.assertEqual(
+                self._get_matches(phrase_type, phrases, None),
+                self._get_matches(phrase_type, phrases, text_match_cache))
+            self.assertTrue(text_match_cache.num_hits > 0)
+
+    def test_values_are_not_split_from_phrases(self):
+        chunks = extract_values._split_note_into_chunks(
+            self.NOTES[3], extract_values.PHRASE_TYPE_NUM)
+        self.assertEqual(
+            [b'ef\n\nwas 40 on 1/2/2010\n', b'\n', b'\nvent\n', b'\n',
+             b'\ndate of\n\n3-4-2011'],
+            [chunk for _, chunk in chunks])
+        self.assertEqual([0, 23, 24, 30, 31],
+                         [chunk_start for chunk_start, _ in chunks])
+
+
+class TestPhrasePatternCache(unittest.TestCase):
+    def test_keeps_recently_used_phrase_lists(self):
+        word = extract_values.PHRASE_TYPE_WORD
+        phrase_patterns = extract_values._get_phrase_patterns(word, [b'ef'])
+        for i in range(extract_values.MAX_CACHED_PHRASE_PATTERNS * 2):
+            extract_values._get_phrase_patterns(word, [b'phrase%d' % i])
+            self.assertIs(phrase_patterns,
+                          extract_values._get_phrase_patterns(word, [b'ef']))
+        self.assertEqual(extract_values.MAX_CACHED_PHRASE_PATTERNS,
+                         len(extract_values._phrase_patterns_cache))
+        self.assertNotIn((word, (b'phrase0',)),
+                         extract_values._phrase_patterns_cache)
+
+
+class TestExtractionQuery(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'rpdr.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(
+                b'EMPI|MRN_Type|MRN|Report_Number|Report_Type|Report_Text\n'
+                b'1|MGH|11|R1|CAR|\nE.F. is 40, ejection fraction 45\n'
+                b'[report_end]\n'
+                b'2|MGH|22|R2|PRG|\nef 50\n[report_end]\n')
+        self.query = extract_values.ExtractionQuery(
+            [b'ejection fraction', b'e.f.'], extract_values.PHRASE_TYPE_NUM,
+            ignore_punctuation=True, report_type=b'CAR')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_match_file(self):
+        self.assertEqual(
+            [('1', 'R1', 'ef', 0, 8, 40.0),
+             ('1', 'R1', 'ejection fraction', 9, 29, 45.0)],
+            [(match_record.empi, match_record.report_number,
+              match_record.phrase, match_record.match_start,
+              match_record.match_end, match_record.extracted_value)
+             for match_record in self.query.match_file(self.rpdr_filename)])
+
+    def test_match_note_leaves_note_unchanged(self):
+        rpdr_notes = extract_values._read_notes(self.rpdr_filename)
+        self.assertEqual(2, len(self.query.match_note(rpdr_notes[0])))
+        self.assertEqual([], self.query.match_note(rpdr_notes[1]))
+        self.assertTrue(rpdr_notes[0].note.startswith(b'E.F. is 40'))
+
+    def test_match_text_note(self):
+        rpdr_note = extract_values.RPDRNote(
+            {'EMPI': '1', 'MRN_Type': 'MGH', 'MRN': '11',
+             'Report_Number': 'R1', 'Report_Type': 'CAR'},
+            'E.F. is 40 - ejection fraction 45')
+        self.assertEqual(
+            [('1', 'R1', 'ef', 0, 8, 40.0),
+             ('1', 'R1', 'ejection fraction', 10, 30, 45.0)],
+            [(match_record.empi, match_record.report_number,
+              match_record.phrase, match_record.match_start,
+              match_record.match_end, match_record.extracted_value)
+             for match_record in self.query.match_note(rpdr_note)])
+        self.assertEqual('E.F. is 40 - ejection fraction 45', rpdr_note.note)
+
+    def test_same_matches_as_find_phrase_matches(self):
+        rpdr_notes = extract_values._read_notes(self.rpdr_filename)
+        match_records = list(self.query.match_notes(rpdr_notes))
+        note_phrase_matches = self.query.find_phrase_matches(
+            self.query.filter_notes(rpdr_notes))
+        self.assertEqual(
+            [(match_record.match_start, match_record.match_end,
+              match_record.phrase, match_record.extracted_value)
+             for match_record in match_records],
+            [(phrase_match.match_start, phrase_match.match_end,
+              compat.to_str(phrase_match.phrase),
+              phrase_match.extracted_value)
+             for phrase_matches in note_phrase_matches
+             for phrase_match in phrase_matches.phrase_matches])
+
+
+class WeakReferencedNotePhraseMatches(extract_values.NotePhraseMatches):
+    """NotePhraseMatches has __slots__, so it can't be weakly referenced."""
+
+
+class TestExtractionRun(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'rpdr.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(
+                b'EMPI|MRN_Type|MRN|Report_Number|Report_Type|Report_Text\n'
+                b'1|MGH|11|R1|CAR|\nef 40\n[report_end]\n'
+                b'2|MGH|22|R2|CAR|\nno match\n[report_end]\n'
+                b'1|MGH|11|R3|CAR|\nef 45\n[report_end]\n')
+        self.query = extract_values.ExtractionQuery(
+            [b'ef'], extract_values.PHRASE_TYPE_NUM)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _run(self, **kwargs):
+        outputs = extract_values.ExtractionOutputs(
+            os.path.join(self.tmp_dir, 'output.csv'),
+            os.path.join(self.tmp_dir, 'tasks.csv'),
+            num_negative_matches_to_show=1)
+        extract_values.ExtractionRun(
+            self.query, self.rpdr_filename, **kwargs).run(outputs)
+        rows = []
+        for filename in [outputs.output_filename, outputs.turk_csv_filename]:
+            with compat.open_csv(filename) as csv_file:
+                rows.append(list(csv.reader(csv_file)))
+        return rows
+
+    def test_run(self):
+        output_rows, turk_rows = self._run()
+        self.assertEqual(
+            [['1', 'MGH', '11', 'CAR', 'R1', '', '40.0'],
+             ['2', 'MGH', '22', 'CAR', 'R2', '', ''],
+             ['1', 'MGH', '11', 'CAR', 'R3', '', '45.0']], output_rows)
+        self.assertEqual([('40.0', 'R1'), ('45.0', 'R3'), ('', 'R2')],
+                         [(row[1], row[3]) for row in turk_rows[1:]])
+        self.assertEqual([output_rows, turk_rows],
+                         self._run(max_memory=1, deduplicate_text=True))
+
+    def test_aggregate(self):
+        output_rows, turk_rows = self._run(aggregate='max')
+        self.assertEqual([['1', 'MGH', '11', 'CAR', 'R1', '', '45.0'],
+                          ['2', 'MGH', '22', 'CAR', 'R2', '', '']],
+                         output_rows)
+        self.assertEqual(4, len(turk_rows))
+
+    def test_outputs_dont_keep_matches(self):
+        outputs = extract_values.ExtractionOutputs(
+            os.path.join(self.tmp_dir, 'output.csv'),
+            os.path.join(self.tmp_dir, 'tasks.csv'),
+            match_store_filename=os.path.join(self.tmp_dir, 'matches.db'))
+        patient_aggregator = extract_values.PatientAggregator(
+            'max', extract_values.PHRASE_TYPE_NUM)
+        phrase_matches_refs = []
+        num_kept_phrase_matches = []
+
+        def iterate_note_phrase_matches():
+            for rpdr_note in extract_values._read_notes(self.rpdr_filename):
+                gc.collect()
+                num_kept_phrase_matches.append(sum(
+                    phrase_matches_ref() is not None
+                    for phrase_matches_ref in phrase_matches_refs[:-1]))
+                phrase_matches = WeakReferencedNotePhraseMatches(rpdr_note)
+                phrase_matches.add_match(1.0, 0, 2, b'ef')
+                phrase_matches.finalize_phrase_matches()
+                phrase_matches_refs.append(weakref.ref(phrase_matches))
+                patient_aggregator.add_note_phrase_matches(phrase_matches)
+                yield phrase_matches
+
+        outputs.write(iterate_note_phrase_matches(), self.query,
+                      patient_aggregator)
+        self.assertEqual([0, 0, 0], num_kept_phrase_matches)
+
+    def test_invalid_options(self):
+        for kwargs in [{'sample_notes': 1, 'aggregate': 'max'},
+                       {'sample_notes': 1, 'shared_corpus_name': 'corpus'},
+                       {'shared_corpus_name': 'corpus'},
+                       {'aggregate': 'median'}]:
+            self.assertRaises(Exception, extract_values.ExtractionRun,
+                              self.query, self.rpdr_filename, **kwargs)
+
+
+class TestPatientAggregator(unittest.TestCase):
+    def setUp(self):
+        self.note_phrase_matches = []
+        for empi, report_date, values in [
+                (b'empi1', b'02/01/2016 10:00:00 AM', [5.0, 7.0]),
+                (b'empi1', b'01/01/2016 10:00:00 AM', [3.0]),
+                (b'empi2', b'01/01/2016', []),
+                (b'empi1', b'03/01/2016 10:00:00 AM', [4.0])]:
+            rpdr_note = extract_values.RPDRNote(
+                {'EMPI': empi, 'MRN_Type': b'mrn_type1',
+                 'Report_Number': report_date, 'MRN': b'1231',
+                 'Report_Type': b'report_type1',
+                 'Report_Description': b'report_description1',
+                 'Report_Date_Time': report_date}, b'note')
+            note_phrase_matches = extract_values.NotePhraseMatches(rpdr_note)
+            for match_start, value in enumerate(values):
+                note_phrase_matches.add_phrase_match(
+                    extract_values.PhraseMatch(
+                        value, match_start, match_start + 1, b'ef'))
+            self.note_phrase_matches.append(note_phrase_matches)
+
+    def _aggregate(self, aggregate):
+        patient_aggregator = extract_values.PatientAggregator(
+            aggregate, extract_values.PHRASE_TYPE_NUM)
+        for note_phrase_matches in self.note_phrase_matches:
+            patient_aggregator.add_note_phrase_matches(note_phrase_matches)
+        return patient_aggregator.get_rows()
+
+    def test_rows_use_keys_of_earliest_note(self):
+        rows = self._aggregate('first')
+        self.assertEqual(2, len(rows))
+        self.assertEqual('empi1', rows[0][0])
+        self.assertEqual('01/01/2016 10:00:00 AM', rows[0][4])
+
+    def test_first_and_last_follow_report_date(self):
+        self.assertEqual([3.0, None],
+                         [row[-1] for row in self._aggregate('first')])
+        self.assertEqual([4.0, None],
+                         [row[-1] for row in self._aggregate('last')])
+
+    def test_numerical_aggregates(self):
+        self.assertEqual([3.0, None],
+                         [row[-1] for row in self._aggregate('min')])
+        self.assertEqual([7.0, None],
+                         [row[-1] for row in self._aggregate('max')])
+        self.assertEqual([4.75, None],
+                         [row[-1] for row in self._aggregate('mean')])
+        self.assertEqual([4, 0], [row[-1] for row in self._aggregate('count')])
+
+    def test_all_values_ordered_by_report_date(self):
+        self.assertEqual(['3.0;5.0;7.0;4.0', ''],
+                         [row[-1] for row in self._aggregate('all')])
+
+    def test_min_and_max_compare_dates(self):
+        rpdr_note = self.note_phrase_matches[0].rpdr_note
+        note_phrase_matches = extract_values.NotePhraseMatches(rpdr_note)
+        for match_start, value in enumerate(
+                ['12/1/2015', '2016-01-05', '9/30/15', '99/99/99']):
+            note_phrase_matches.add_phrase_match(extract_values.PhraseMatch(
+                value, match_start, match_start + 1, b'date'))
+        for aggregate, expected_value in [('min', '9/30/15'),
+                                          ('max', '2016-01-05')]:
+            patient_aggregator = extract_values.PatientAggregator(
+                aggregate, extract_values.PHRASE_TYPE_DATE)
+            patient_aggregator.add_note_phrase_matches(note_phrase_matches)
+            self.assertEqual(expected_value,
+                             patient_aggregator.get_rows()[0][-1])
+
+    def test_mean_requires_numerical_values(self):
+        for phrase_type in [extract_values.PHRASE_TYPE_WORD,
+                            extract_values.PHRASE_TYPE_DATE]:
+            self.assertRaises(ValueError, extract_values.PatientAggregator,
+                              'mean', phrase_type)
+
+
+class TestReservoirSampler(unittest.TestCase):
+    def test_sample_without_replacement(self):
+        sampler = extract_values.ReservoirSampler(10, seed=1)
+        for item in range(1000):
+            sampler.add(item)
+        sample = sampler.get_sample()
+        self.assertEqual(10, len(sample))
+        self.assertEqual(10, len(set(sample)))
+
+    def test_fewer_items_than_sample_size(self):
+        sampler = extract_values.ReservoirSampler(10, seed=1)
+        for item in range(3):
+            sampler.add(item)
+        self.assertEqual([0, 1, 2], sorted(sampler.get_sample()))
+
+    def test_seed_makes_sample_repeatable(self):
+        samples = []
+        for _ in range(2):
+            sampler = extract_values.ReservoirSampler(5, seed=7)
+            for item in range(100):
+                sampler.add(item)
+            samples.append(sampler.get_sample())
+        self.assertEqual(samples[0], samples[1])
+
+    def test_stratified_sample_is_proportional(self):
+        sampler = extract_values.StratifiedReservoirSampler(
+            10, lambda item: item % 4 == 0, seed=1)
+        for item in range(400):
+            sampler.add(item)
+        sample = sampler.get_sample()
+        self.assertEqual(10, len(set(sample)))
+        # 1 in 4 items is in the True stratum, so 2.5 rounds to 2 or 3.
+        self.assertIn(len([item for item in sample if item % 4 == 0]),
+                      [2, 3])
+
+    def test_stratified_sample_holds_at_most_sample_size_items(self):
+        sampler = extract_values.StratifiedReservoirSampler(
+            10, lambda item: item // 100, seed=1)
+        # Strata are added one after another, as in a file sorted by report
+        # type.
+        for item in range(1000):
+            sampler.add(item)
+            self.assertLessEqual(
+                sum(len(heap) for heap in sampler.stratum_to_heap.values()),
+                10)
+        sample = sampler.get_sample()
+        self.assertEqual(10, len(set(sample)))
+        self.assertEqual(list(range(10)),
+                         sorted(item // 100 for item in sample))
+
+
+class TestTurkVerification(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_truncate_note_around_matches(self):
+        note = b'a' * 20 + b'ef 40' + b'b' * 20 + b'ef 50' + b'c' * 20
+        truncated_note, matches = (
+            extract_values._truncate_note_around_matches(
+                note, [(20, 25), (45, 50)], 20))
+        marker = extract_values.TRUNCATED_TEXT_MARKER
+        self.assertEqual(
+            marker + b'aaef 40bb' + marker + b'bbef 50cc' + marker,
+            truncated_note)
+        self.assertEqual([b'ef 40', b'ef 50'],
+                         [truncated_note[match_start:match_end]
+                          for match_start, match_end in matches])
+        self.assertEqual((note, [(20, 25)]),
+                         extract_values._truncate_note_around_matches(
+                             note, [(20, 25)], 100))
+
+    def test_write_shards_with_manifest(self):
+        turk_csv_name = os.path.join(self.tmp_dir, 'tasks.csv')
+        rows = [('note%d' % i, 1, 'empi', 'R%d' % i) for i in range(5)]
+        # Shards of an earlier run with more tasks.
+        for shard_number in [4, 5]:
+            open(extract_values.get_turk_shard_filename(
+                turk_csv_name, shard_number), 'w').close()
+        self.assertEqual(5, extract_values._write_turk_verification_shards(
+            iter(rows), turk_csv_name, 2))
+        with open(extract_values.get_turk_manifest_filename(
+                turk_csv_name)) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertTrue(manifest['complete'])
+        self.assertEqual(['tasks_0001.csv', 'tasks_0002.csv',
+                          'tasks_0003.csv'],
+                         [shard['filename'] for shard in manifest['shards']])
+        self.assertEqual([2, 2, 1], [shard['num_tasks']
+                                     for shard in manifest['shards']])
+        with compat.open_csv(extract_values.get_turk_shard_filename(
+                turk_csv_name, 3)) as shard_file:
+            self.assertEqual(
+                [extract_values.TURK_CSV_HEADER, ['note4', '1', 'empi', 'R4']],
+                list(csv.reader(shard_file)))
+        self.assertEqual(['tasks_%04d.csv' % i for i in [1, 2, 3]] +
+                         ['tasks_manifest.json'],
+                         sorted(os.listdir(self.tmp_dir)))
+
+    def test_task_writer_writes_matches_as_they_are_added(self):
+        turk_csv_name = os.path.join(self.tmp_dir, 'tasks.csv')
+        turk_task_writer = extract_values.TurkTaskWriter(
+            turk_csv_name, None, num_negative_matches_to_show=1,
+            shard_size=1)
+        for report_number, matches in [(b'R1', []), (b'R2', [(0, 2)])]:
+            rpdr_note = extract_values.RPDRNote(
+                {'EMPI': b'1', 'MRN_Type': b'MGH', 'MRN': b'11',
+                 'Report_Number': report_number}, b'ef 40')
+            note_phrase_matches = extract_values.NotePhraseMatches(rpdr_note)
+            for match_start, match_end in matches:
+                note_phrase_matches.add_match(1, match_start, match_end,
+                                              b'ef')
+            turk_task_writer.add_note_phrase_matches(note_phrase_matches)
+        self.assertTrue(os.path.exists(
+            extract_values.get_turk_shard_filename(turk_csv_name, 1)))
+        self.assertFalse(os.path.exists(
+            extract_values.get_turk_shard_filename(turk_csv_name, 2)))
+        self.assertEqual(2, turk_task_writer.close())
+        with compat.open_csv(extract_values.get_turk_shard_filename(
+                turk_csv_name, 2)) as shard_file:
+            self.assertEqual('R1', list(csv.reader(shard_file))[1][3])
+
+
+class TestNoteReaders(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dfci_filename = os.path.join(self.tmp_dir, 'dfci.txt')
+        with open(self.dfci_filename, 'wb') as dfci_file:
+            dfci_file.write(
+                b'#PATIENT_ID|DFCI_MRN|NOTE_ID|INPATIENT_NOTE_TYPE_DESCR|'
+                b'INPATIENT_NOTE_TYPE_CD|DATE_OF_SERVICE|NOTE_TXT|\n'
+                b'1|11|n1|Progress|PRG|10/17/2011 10:00|on vent|\n'
+                b'2|22|n2|Progress|PRG|null|no date|\n'
+                b'3|33|n3|Discharge|DIS|10/18/2011 10:00|ef 40|\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dfci_reader_skips_null_dates(self):
+        rpdr_notes = extract_values._read_notes(self.dfci_filename, 'dfci')
+        self.assertEqual([b'n1', b'n3'],
+                         [rpdr_note.report_number for rpdr_note in rpdr_notes])
+        self.assertEqual(b'DFCI_PATIENT_ID_1', rpdr_notes[0].empi)
+        self.assertEqual(b'10/17/2011', rpdr_notes[0].report_date)
+        self.assertEqual(b'DIS', rpdr_notes[1].report_type)
+
+    def test_dfci_reader_matches_converted_rpdr_file(self):
+        rpdr_filename = os.path.join(self.tmp_dir, 'rpdr.txt')
+        convert_dfci_to_rpdr.main(self.dfci_filename, rpdr_filename)
+        rpdr_notes = extract_values._read_notes(rpdr_filename, 'rpdr')
+        dfci_notes = extract_values._read_notes(self.dfci_filename, 'dfci')
+        self.assertEqual(
+            [rpdr_note.get_keys() for rpdr_note in rpdr_notes],
+            [dfci_note.get_keys() for dfci_note in dfci_notes])
+
+    def test_read_directory_of_files_concurrently(self):
+        rpdr_dir = os.path.join(self.tmp_dir, 'rpdr')
+        os.mkdir(rpdr_dir)
+        for filename, report_number in [('b.txt', b'R2'), ('a.txt', b'R1')]:
+            with open(os.path.join(rpdr_dir, filename), 'wb') as rpdr_file:
+                rpdr_file.write(
+                    b'EMPI|MRN_Type|MRN|Report_Number|Report_Text\n'
+                    b'1|MGH|11|%s|\nef 40\n[report_end]\n' % report_number)
+        input_filenames = extract_values._expand_input_filenames([rpdr_dir])
+        self.assertEqual([os.path.join(rpdr_dir, 'a.txt'),
+                          os.path.join(rpdr_dir, 'b.txt')], input_filenames)
+        rpdr_notes = extract_values._read_notes_from_files(
+            input_filenames, workers=2)
+        self.assertEqual(
+            [(b'R1', input_filenames[0]), (b'R2', input_filenames[1])],
+            [(rpdr_note.report_number, rpdr_note.source_filename)
+             for rpdr_note in rpdr_notes])
+
+    def test_sample_notes_at_byte_offsets(self):
+        rpdr_filename = os.path.join(self.tmp_dir, 'rpdr.txt')
+        with open(rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(b'EMPI|MRN_Type|MRN|Report_Number|Report_Text\n')
+            for i in range(8):
+                rpdr_file.write(b'1|MGH|11|R%d|\nef %d\n\n[report_end]\n\n' %
+                                (i, i))
+            rpdr_file.write(b'1|MGH|bad header\nignored\n[report_end]\n')
+            rpdr_file.write(b'1|MGH|11|[report_end]|\nef 9\n[report_end]\n')
+            rpdr_file.write(b'1|MGH|11|R10|\nline a|b [report_end]\n')
+            rpdr_file.write(b'1|MGH|11|R11|\nef 11\n[report_end]\n')
+            rpdr_file.write(b'\r\n\n')
+        offsets = extract_values._find_rpdr_note_offsets(rpdr_filename)
+        self.assertEqual(11, len(offsets))
+        rpdr_notes = extract_values._read_notes(rpdr_filename)
+        offset_notes = list(extract_values.RPDRNoteReader(
+            rpdr_filename).iterate_notes_at(enumerate(offsets)))
+        self.assertEqual([(rpdr_note.get_keys(), rpdr_note.note,
+                           rpdr_note.note_id) for rpdr_note in rpdr_notes],
+                         [(rpdr_note.get_keys(), rpdr_note.note,
+                           rpdr_note.note_id) for rpdr_note in offset_notes])
+        sampled_notes, num_notes = extract_values._sample_notes(
+            [rpdr_filename], 'rpdr', sample_notes=4, random_seed=1)
+        self.assertEqual(11, num_notes)
+        self.assertEqual(4, len(sampled_notes))
+        for rpdr_note in sampled_notes:
+            self.assertEqual(rpdr_notes[rpdr_note.note_id].get_keys(),
+                             rpdr_note.get_keys())
+        self.assertEqual(
+            [rpdr_note.report_number for rpdr_note in sampled_notes],
+            [rpdr_note.report_number for rpdr_note in
+             extract_values._sample_notes([rpdr_filename], 'rpdr',
+                                          sample_notes=4, random_seed=1)[0]])
+
+    def test_wilson_interval(self):
+        low, high = extract_values._get_wilson_interval(10, 100)
+        self.assertAlmostEqual(0.0552, low, places=4)
+        self.assertAlmostEqual(0.1744, high, places=4)
+        self.assertEqual((0.0, 1.0), extract_values._get_wilson_interval(0, 0))
+
+    def test_rpdr_reader_rejects_missing_header_columns(self):
+        rpdr_filename = os.path.join(self.tmp_dir, 'rpdr.txt')
+        with open(rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(b'1|MGH|11|R1|\nef 40\n[report_end]\n')
+        self.assertRaises(ValueError, extract_values._read_notes,
+                          rpdr_filename)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,17 +1,27 @@
 import argparse
 import csv
 import datetime
+import io
+import mmap
+import multiprocessing
+import os
+
+import numpy as np
+
+import compat
+import profiling
 
 
 def _convert_rpdr_timestamp_to_seconds(rpdr_timestamp_string):
-    date = datetime.datetime.strptime(rpdr_timestamp_string, '%m/%d/%Y')
+    date = datetime.datetime.strptime(compat.to_str(rpdr_timestamp_string),
+                                      '%m/%d/%Y')
     epoch = datetime.datetime.utcfromtimestamp(0)
     return (date - epoch).total_seconds()
 
 
 def _get_empi_to_date_range(filter_csv_filename):
     empi_to_date_range = {}  # map empi to (seconds_start, seconds_end)
-    with open(filter_csv_filename, 'rb') as filter_csv:
+    with compat.open_csv(filter_csv_filename) as filter_csv:
         csv_reader = csv.reader(filter_csv)
         for row_num, row in enumerate(csv_reader):
             if row_num == 0:
@@ -24,13 +34,16 @@ def _get_empi_to_date_range(filter_csv_filename):
                                     (str(expected_header_row), str(row)))
                 continue
             empi, procedure_date, days_before, days_after, include = row
+            # Notes are filtered as bytes.
+            empi = compat.to_bytes(empi)
             days_before = int(days_before)
             days_after = int(days_after)
             include = int(include)
             if include == 0:
                 continue
             if empi in empi_to_date_range:
-                raise Exception('Seen EMPI: %s multiple times' % empi)
+                raise Exception('Seen EMPI: %s multiple times' %
+                                compat.to_str(empi))
             one_day_seconds = 60 * 60 * 24
             procedure_date_seconds = _convert_rpdr_timestamp_to_seconds(
                 procedure_date)
@@ -44,30 +57,47 @@ def _get_empi_to_date_range(filter_csv_filename):
 
 def _split_rpdr_key_line(text_line):
     """Remove newline chars and split the line by bars."""
-    return tuple(text_line.replace('\r', '').replace('\n', '').split('|'))
+    return tuple(text_line.replace(b'\r', b'').replace(b'\n', b'').split(b'|'))
+
+
+def _split_rpdr_header_line(text_line):
+    """Return the column names of an RPDR header line as native strings."""
+    return tuple(compat.to_str(column_name)
+                 for column_name in _split_rpdr_key_line(text_line))
 
 
 def _filter_rpdr_notes(empi_to_date_range, rpdr_filename):
     """Return only RPDR notes for EMPIs in empi_to_date_range with dates
     within that range."""
-    filtered_notes = ''
     with open(rpdr_filename, 'rb') as rpdr_file:
         rpdr_lines = rpdr_file.readlines()
-    header_column_names = _split_rpdr_key_line(rpdr_lines[0])
+    header_column_names = _split_rpdr_header_line(rpdr_lines[0])
+    filtered_notes = _filter_rpdr_lines(empi_to_date_range,
+                                        header_column_names, rpdr_lines[1:])
+    filtered_notes = rpdr_lines[0] + b'\n' + filtered_notes
+    return filtered_notes
+
+
+def _filter_rpdr_lines(empi_to_date_range, header_column_names, rpdr_lines):
+    """Return the lines of the notes in rpdr_lines, the lines of an RPDR
+    file after its header, kept by _filter_rpdr_notes."""
+    # Kept lines are joined once at the end, since adding to bytes copies
+    # them each time under Python 3.
+    filtered_notes = []
 
     # None if at the start of the file or in between patient notes.
     rpdr_keys = None
     ignore_lines = False  # True if bad formatted header or no EMPI/date match
-    for line_number, line in enumerate(rpdr_lines[1:]):
+    for line_number, line in enumerate(rpdr_lines):
         # If starting a new note and the current line is empty, continue.
-        if not rpdr_keys and not line.replace('\r', '').replace('\n', ''):
+        if not rpdr_keys and not line.replace(b'\r', b'').replace(b'\n', b''):
             continue
         # If not current notes, try to extract the RPDR column values.
         if not rpdr_keys:
-            if '|' not in line:
+            if b'|' not in line:
                 raise ValueError('Expected RPDR column values as described in '
                                  'the header, separated by | at the start of '
-                                 'a new note. Got %s' % line)
+                                 'a new note. Got %s' % compat.to_str(line))
             rpdr_keys = _split_rpdr_key_line(line)
             if len(rpdr_keys) != len(header_column_names):
                 ignore_lines = True
@@ -79,7 +109,7 @@ def _filter_rpdr_notes(empi_to_date_range, rpdr_filename):
             empi = rpdr_column_name_to_key['EMPI']
             note_date = (rpdr_column_name_to_key.get('Report_Date_Time') or
                          rpdr_column_name_to_key.get('LMRNote_Date'))
-            note_date = note_date.split(' ')[0]  # after space is the time
+            note_date = note_date.split(b' ')[0]  # after space is the time
             # Ignore lines if we're not interested in this EMPI
             if empi not in empi_to_date_range:
                 ignore_lines = True
@@ -91,20 +121,217 @@ def _filter_rpdr_notes(empi_to_date_range, rpdr_filename):
                     note_date_seconds > date_range_end):
                 ignore_lines = True
                 continue
-            filtered_notes += line
+            filtered_notes.append(line)
         else:  # line is part of notes
             if not ignore_lines:
-                filtered_notes += line
-            if '[report_end]' in line:
+                filtered_notes.append(line)
+            if b'[report_end]' in line:
                 rpdr_keys = None
                 ignore_lines = False
-    filtered_notes = rpdr_lines[0] + '\n' + filtered_notes
-    return filtered_notes
+    return b''.join(filtered_notes)
+
+
+def _find_rpdr_chunk_boundaries(rpdr_data, start, num_chunks):
+    """Return the byte offsets splitting rpdr_data from start to its end
+    into about num_chunks chunks that each start in between notes.
+
+    Chunks end after a line containing [report_end] and no |. Such a line
+    can't be the column values line of a note, so it always ends a note.
+    """
+    boundaries = [start]
+    chunk_size = max(1, (len(rpdr_data) - start) // num_chunks)
+    while True:
+        report_end = rpdr_data.find(b'[report_end]',
+                                    boundaries[-1] + chunk_size)
+        while report_end != -1:
+            line_start = rpdr_data.rfind(b'\n', 0, report_end) + 1
+            line_end = rpdr_data.find(b'\n', report_end)
+            if line_end == -1:
+                line_end = len(rpdr_data)
+            else:
+                line_end += 1
+            if rpdr_data.find(b'|', line_start, line_end) == -1:
+                break
+            report_end = rpdr_data.find(b'[report_end]', line_end)
+        if report_end == -1 or line_end >= len(rpdr_data):
+            break
+        boundaries.append(line_end)
+    boundaries.append(len(rpdr_data))
+    return boundaries
+
+
+# Set in each worker process by _init_filter_worker.
+_worker_empi_to_date_range = None
+_worker_header_column_names = None
+
+
+def _init_filter_worker(empi_to_date_range, header_column_names):
+    global _worker_empi_to_date_range, _worker_header_column_names
+    _worker_empi_to_date_range = empi_to_date_range
+    _worker_header_column_names = header_column_names
+
+
+def _filter_rpdr_chunk(chunk):
+    """Return the kept notes of the bytes start to end of an RPDR file, a
+    chunk found by _find_rpdr_chunk_boundaries."""
+    rpdr_filename, start, end = chunk
+    with open(rpdr_filename, 'rb') as rpdr_file:
+        rpdr_file.seek(start)
+        rpdr_lines = io.BytesIO(rpdr_file.read(end - start)).readlines()
+    return _filter_rpdr_lines(_worker_empi_to_date_range,
+                              _worker_header_column_names, rpdr_lines)
+
+
+def _filter_rpdr_notes_parallel(empi_to_date_range, rpdr_filename, workers):
+    """Same output as _filter_rpdr_notes, filtering chunks of whole notes
+    in workers processes and joining their output in file order."""
+    with open(rpdr_filename, 'rb') as rpdr_file:
+        header_line = rpdr_file.readline()
+        if not os.fstat(rpdr_file.fileno()).st_size:
+            raise ValueError('%s is empty' % rpdr_filename)
+        rpdr_data = mmap.mmap(rpdr_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            boundaries = _find_rpdr_chunk_boundaries(
+                rpdr_data, len(header_line), workers * 4)
+        finally:
+            rpdr_data.close()
+    header_column_names = _split_rpdr_header_line(header_line)
+    pool = multiprocessing.Pool(workers, _init_filter_worker,
+                                (empi_to_date_range, header_column_names))
+    try:
+        filtered_chunks = pool.imap(
+            _filter_rpdr_chunk,
+            [(rpdr_filename, start, end)
+             for start, end in zip(boundaries[:-1], boundaries[1:])])
+        filtered_notes = b''.join(filtered_chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return header_line + b'\n' + filtered_notes
+
 
+_rpdr_date_cache = {}  # map RPDR date strings to datetime64 days
 
-def main(rpdr_filename, filter_csv_filename, output_filename):
+
+def _parse_rpdr_date(rpdr_date_string):
+    """Memoized conversion of an RPDR date to a numpy datetime64 day.
+
+    Note dates repeat heavily, so almost every call is a dict lookup.
+    """
+    try:
+        return _rpdr_date_cache[rpdr_date_string]
+    except KeyError:
+        date = datetime.datetime.strptime(compat.to_str(rpdr_date_string),
+                                          '%m/%d/%Y')
+        day = np.datetime64(date.date(), 'D')
+        _rpdr_date_cache[rpdr_date_string] = day
+        return day
+
+
+def _collect_rpdr_note_headers(rpdr_lines):
+    """Return (first_lines, last_lines, empis, note_dates) for each well
+    formatted note, where first_lines and last_lines index the note's key
+    line and [report_end] line in rpdr_lines."""
+    header_column_names = _split_rpdr_header_line(rpdr_lines[0])
+    empi_column = header_column_names.index('EMPI')
+    date_columns = [header_column_names.index(column_name) for column_name in
+                    ('Report_Date_Time', 'LMRNote_Date')
+                    if column_name in header_column_names]
+
+    first_lines = []
+    last_lines = []
+    empis = []
+    note_dates = []
+    in_note = False
+    collect_note = False  # False for notes with a bad formatted header
+    for line_number in compat.xrange(1, len(rpdr_lines)):
+        line = rpdr_lines[line_number]
+        if not in_note:
+            if not line.replace(b'\r', b'').replace(b'\n', b''):
+                continue
+            if b'|' not in line:
+                raise ValueError('Expected RPDR column values as described in '
+                                 'the header, separated by | at the start of '
+                                 'a new note. Got %s' % compat.to_str(line))
+            in_note = True
+            rpdr_keys = _split_rpdr_key_line(line)
+            collect_note = len(rpdr_keys) == len(header_column_names)
+            if not collect_note:
+                continue
+            note_date = None
+            for date_column in date_columns:
+                note_date = note_date or rpdr_keys[date_column]
+            first_lines.append(line_number)
+            # Notes missing a final [report_end] run to the end of the file.
+            last_lines.append(len(rpdr_lines) - 1)
+            empis.append(rpdr_keys[empi_column])
+            note_dates.append(note_date.split(b' ')[0])  # after space is time
+        elif b'[report_end]' in line:
+            in_note = False
+            if collect_note:
+                last_lines[-1] = line_number
+    return first_lines, last_lines, empis, note_dates
+
+
+def _filter_rpdr_notes_vectorized(empi_to_date_range, rpdr_filename):
+    """Same output as _filter_rpdr_notes, but the EMPI and date range checks
+    run on numpy arrays for all notes at once.
+
+    Note headers are collected in one pass, joined against the sorted filter
+    EMPIs with searchsorted, and only dates of notes for those EMPIs are
+    parsed. Note bodies are only copied for notes that pass the filter.
+    """
+    with open(rpdr_filename, 'rb') as rpdr_file:
+        rpdr_lines = rpdr_file.readlines()
+    first_lines, last_lines, empis, note_dates = _collect_rpdr_note_headers(
+        rpdr_lines)
+
+    filtered_notes = []
+    if empis and empi_to_date_range:
+        one_day_seconds = 60 * 60 * 24
+        filter_empis = sorted(empi_to_date_range)
+        range_starts = np.array(
+            [empi_to_date_range[empi][0] // one_day_seconds
+             for empi in filter_empis], dtype='int64').astype('datetime64[D]')
+        range_ends = np.array(
+            [empi_to_date_range[empi][1] // one_day_seconds
+             for empi in filter_empis], dtype='int64').astype('datetime64[D]')
+        filter_empis = np.array(filter_empis)
+
+        note_empis = np.array(empis)
+        range_indices = np.searchsorted(filter_empis, note_empis)
+        range_indices[range_indices == len(filter_empis)] = 0
+        empi_matched = filter_empis[range_indices] == note_empis
+        matched_notes = np.flatnonzero(empi_matched)
+        matched_range_indices = range_indices[matched_notes]
+
+        matched_dates = np.array(
+            [_parse_rpdr_date(note_dates[note_index])
+             for note_index in matched_notes], dtype='datetime64[D]')
+        in_range = ((matched_dates >= range_starts[matched_range_indices]) &
+                    (matched_dates <= range_ends[matched_range_indices]))
+        for note_index in matched_notes[in_range]:
+            filtered_notes.extend(
+                rpdr_lines[first_lines[note_index]:
+                           last_lines[note_index] + 1])
+    return rpdr_lines[0] + b'\n' + b''.join(filtered_notes)
+
+
+def main(rpdr_filename, filter_csv_filename, output_filename,
+         vectorized=False, workers=1):
     empi_to_date_range = _get_empi_to_date_range(filter_csv_filename)
-    filtered_notes = _filter_rpdr_notes(empi_to_date_range, rpdr_filename)
+    if vectorized and workers > 1:
+        raise Exception('Cannot use both vectorized and workers. Choose one '
+                        'option.')
+    if workers > 1:
+        filtered_notes = _filter_rpdr_notes_parallel(
+            empi_to_date_range, rpdr_filename, workers)
+    elif vectorized:
+        filtered_notes = _filter_rpdr_notes_vectorized(empi_to_date_range,
+                                                       rpdr_filename)
+    else:
+        filtered_notes = _filter_rpdr_notes(empi_to_date_range,
+                                            rpdr_filename)
     with open(output_filename, 'wb') as output_file:
         output_file.write(filtered_notes)
 
@@ -118,6 +345,16 @@ if __name__ == '__main__':
                         help=('Path to a CSV file specifying EMPIs and '
                               'procedure dates of interest.'))
     parser.add_argument('--output_filename', required=False)
+    parser.add_argument(
+        '--vectorized', default=False, action='store_true', help=(
+            'Check note EMPIs and dates for all notes at once with numpy. '
+            'Produces the same output, but is much faster when filtering a '
+            'small cohort out of a large notes file.'))
+    parser.add_argument(
+        '--workers', type=int, default=1, help=(
+            'Number of processes filtering parts of the notes file at the '
+            'same time. Produces the same output. Defaults to 1.'))
+    profiling.add_profile_arguments(parser)
     args = parser.parse_args()
     if not args.output_filename:
         input_fname_list = args.rpdr_filename.split('.')
@@ -125,4 +362,6 @@ if __name__ == '__main__':
                            input_fname_list[1])
     else:
         output_filename = args.output_filename
-    main(args.rpdr_filename, args.filter_csv_filename, output_filename)
+    profiling.run_profiled(args.profile, args.profile_dir, 'filter_notes',
+                           main, args.rpdr_filename, args.filter_csv_filename,
+                           output_filename, args.vectorized, args.workers)
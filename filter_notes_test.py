@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import filter_notes
+
+RPDR_NOTES = (
+    b'EMPI|MRN_Type|MRN|Report_Number|Report_Date_Time|Report_Description|'
+    b'Report_Type|Report_Text\r\n'
+    b'1111|MGH|1|R1|05/01/2016 10:00:00 AM|Note|PRG|\r\n'
+    b'in range\r\n'
+    b'[report_end]\r\n'
+    b'\r\n'
+    b'1111|MGH|1|R2|01/01/2016 10:00:00 AM|Note|PRG|\r\n'
+    b'too early\r\n'
+    b'[report_end]\r\n'
+    b'1121|MGH|2|R3|05/13/2016 10:00:00 AM|Note|PRG|\r\n'
+    b'excluded patient\r\n'
+    b'[report_end]\r\n'
+    b'bad|header\r\n'
+    b'ignored\r\n'
+    b'[report_end]\r\n'
+    b'2222|MGH|3|R4|not a date|Note|PRG|\r\n'
+    b'unfiltered patient with a bad date\r\n'
+    b'[report_end]\r\n'
+    b'1131|MGH|4|R5|5/20/2016|Note|PRG|\r\n'
+    b'last day of range\r\n'
+    b'[report_end]\r\n'
+    b'1111|MGH|1|R6|05/12/2016 10:00:00 AM|Note|PRG|\r\n'
+    b'no report end\r\n')
+
+FILTER_CSV = (
+    b'empi,procedure_date,days_before,days_after,include\n'
+    b'1111,5/12/2016,30,0,1\n'
+    b'1121,5/13/2016,10,10,0\n'
+    b'1131,5/10/2016,0,10,1\n')
+
+
+class TestFilterRPDRNotes(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        filter_csv_filename = os.path.join(self.tmp_dir, 'filter.csv')
+        with open(filter_csv_filename, 'wb') as filter_csv:
+            filter_csv.write(FILTER_CSV)
+        self.empi_to_date_range = filter_notes._get_empi_to_date_range(
+            filter_csv_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_filter_by_empi_and_date_range(self):
+        filtered_notes = filter_notes._filter_rpdr_notes(
+            self.empi_to_date_range, self.rpdr_filename)
+        self.assertIn(b'in range', filtered_notes)
+        self.assertIn(b'last day of range', filtered_notes)
+        self.assertIn(b'no report end', filtered_notes)
+        self.assertNotIn(b'too early', filtered_notes)
+        self.assertNotIn(b'excluded patient', filtered_notes)
+        self.assertNotIn(b'ignored', filtered_notes)
+
+    def test_vectorized_output_is_identical(self):
+        self.assertEqual(
+            filter_notes._filter_rpdr_notes(self.empi_to_date_range,
+                                            self.rpdr_filename),
+            filter_notes._filter_rpdr_notes_vectorized(
+                self.empi_to_date_range, self.rpdr_filename))
+
+    def test_vectorized_no_filter_empis(self):
+        self.assertEqual(
+            filter_notes._filter_rpdr_notes({}, self.rpdr_filename),
+            filter_notes._filter_rpdr_notes_vectorized(
+                {}, self.rpdr_filename))
+
+    def test_parallel_output_is_identical(self):
+        self.assertEqual(
+            filter_notes._filter_rpdr_notes(self.empi_to_date_range,
+                                            self.rpdr_filename),
+            filter_notes._filter_rpdr_notes_parallel(
+                self.empi_to_date_range, self.rpdr_filename, 2))
+
+    def test_chunks_start_in_between_notes(self):
+        header_end = RPDR_NOTES.index(b'\n') + 1
+        boundaries = filter_notes._find_rpdr_chunk_boundaries(
+            RPDR_NOTES, header_end, len(RPDR_NOTES))
+        self.assertEqual(header_end, boundaries[0])
+        self.assertEqual(len(RPDR_NOTES), boundaries[-1])
+        self.assertEqual(8, len(boundaries))
+        # Each chunk after the first starts after a [report_end] line.
+        for boundary in boundaries[1:-1]:
+            self.assertEqual(
+                b'[report_end]\r\n',
+                RPDR_NOTES[RPDR_NOTES.rindex(b'\n', 0, boundary - 1) + 1:
+                           boundary])
+        header_column_names = filter_notes._split_rpdr_header_line(
+            RPDR_NOTES[:header_end])
+        self.assertEqual(
+            filter_notes._filter_rpdr_notes(
+                self.empi_to_date_range,
+                self.rpdr_filename)[header_end + 1:],
+            b''.join(filter_notes._filter_rpdr_lines(
+                self.empi_to_date_range, header_column_names,
+                RPDR_NOTES[start:end].splitlines(True))
+                for start, end in zip(boundaries[:-1], boundaries[1:])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+"""Save extraction results to an SQLite file and render outputs from it.
+
+extract_values.py --match_store writes every note that was searched, with
+its compressed text and every phrase match, so the output CSV, localturk
+tasks and match contexts can be regenerated with different options without
+searching the notes again:
+
+    python match_store.py matches.db --context_size 20 \
+        --num_negative_turk_matches_to_show 50
+
+Note text is stored as it was searched, i.e. with punctuation removed for
+ignore_punctuation and with a patient's notes joined for group_by_patient,
+so match offsets always refer to the stored text.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import zlib
+
+import compat
+import extract_values
+
+STORE_VERSION = 1
+
+SCHEMA = [
+    'CREATE TABLE store_info (name TEXT PRIMARY KEY, value)',
+    # note_row is the position of the note in the extraction output.
+    'CREATE TABLE notes (note_row INTEGER PRIMARY KEY, empi TEXT, '
+    'mrn_type TEXT, mrn TEXT, report_type TEXT, report_number TEXT, '
+    'report_description TEXT, report_date TEXT, source_filename TEXT, '
+    'note_id INTEGER, note BLOB)',
+    # extracted_value has no type, so numbers and dates keep their types.
+    'CREATE TABLE matches (note_row INTEGER, match_start INTEGER, '
+    'match_end INTEGER, phrase TEXT, extracted_value)',
+    'CREATE INDEX notes_empi ON notes (empi)',
+    'CREATE INDEX matches_note_row ON matches (note_row)',
+    'CREATE INDEX matches_phrase ON matches (phrase)',
+]
+
+
+def _connect(store_filename):
+    connection = sqlite3.connect(store_filename)
+    # Note keys and text are byte strings in the notes' own encoding. Under
+    # Python 3 they are written as text, so stores are the same under both
+    # versions, and read back as bytes.
+    connection.text_factory = bytes
+    return connection
+
+
+def write_match_store(store_filename, note_phrase_matches, phrase_type,
+                      phrases, ignore_punctuation=False):
+    """Write the notes and matches of note_phrase_matches to a new store at
+    store_filename with a MatchStoreWriter."""
+    match_store_writer = MatchStoreWriter(store_filename, phrase_type,
+                                          phrases, ignore_punctuation)
+    for phrase_matches in note_phrase_matches:
+        match_store_writer.add_note_phrase_matches(phrase_matches)
+    match_store_writer.close()
+
+
+class MatchStoreWriter(object):
+    """Writes notes and their matches to a new store at store_filename, one
+    note at a time, replacing any existing file. phrases are the phrases as
+    entered, before any punctuation was removed. The store is written in one
+    transaction, committed by close."""
+    def __init__(self, store_filename, phrase_type, phrases,
+                 ignore_punctuation=False):
+        if os.path.exists(store_filename):
+            os.remove(store_filename)
+        self.connection = _connect(store_filename)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.executemany(
+            'INSERT INTO store_info VALUES (?, ?)',
+            [('version', STORE_VERSION), ('phrase_type', phrase_type),
+             ('phrases', json.dumps([compat.to_str(phrase)
+                                     for phrase in phrases])),
+             ('ignore_punctuation', int(ignore_punctuation))])
+        self.num_notes = 0
+
+    def add_note_phrase_matches(self, phrase_matches):
+        note_row = self.num_notes
+        rpdr_note = phrase_matches.rpdr_note
+        self.connection.execute(
+            'INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (note_row, compat.to_str(rpdr_note.empi),
+             compat.to_str(rpdr_note.mrn_type),
+             compat.to_str(rpdr_note.mrn),
+             compat.to_str(rpdr_note.report_type),
+             compat.to_str(rpdr_note.report_number),
+             compat.to_str(rpdr_note.report_description),
+             compat.to_str(rpdr_note.report_date),
+             rpdr_note.source_filename, rpdr_note.note_id,
+             sqlite3.Binary(zlib.compress(rpdr_note.note))))
+        self.connection.executemany(
+            'INSERT INTO matches VALUES (?, ?, ?, ?, ?)',
+            [(note_row, match_start, match_end, compat.to_str(phrase),
+              extracted_value)
+             for match_start, match_end, phrase, extracted_value in
+             phrase_matches.get_matches()])
+        self.num_notes += 1
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class MatchStore(object):
+    """A store written by write_match_store."""
+    def __init__(self, store_filename):
+        if not os.path.exists(store_filename):
+            raise ValueError('Match store %s does not exist' % store_filename)
+        self.store_filename = store_filename
+        self.connection = _connect(store_filename)
+        store_info = dict(
+            (compat.to_str(name), value) for name, value in
+            self.connection.execute('SELECT name, value FROM store_info'))
+        if store_info['version'] != STORE_VERSION:
+            raise ValueError('Match store %s has version %s, expected %s. '
+                             'Run extract_values.py again to rebuild it.' %
+                             (store_filename, store_info['version'],
+                              STORE_VERSION))
+        self.phrase_type = store_info['phrase_type']
+        self.phrases = [compat.to_bytes(phrase) for phrase in
+                        json.loads(compat.to_str(store_info['phrases']))]
+        self.ignore_punctuation = bool(store_info['ignore_punctuation'])
+
+    def close(self):
+        self.connection.close()
+
+    def iterate_note_phrase_matches(self, phrases=None):
+        """Yield a NotePhraseMatches for each stored note, in the order they
+        were written, keeping only the matches of phrases if given."""
+        match_table = extract_values.PhraseMatchTable(self.phrase_type)
+        match_query = ('SELECT note_row, match_start, match_end, phrase, '
+                       'extracted_value FROM matches')
+        query_args = []
+        if phrases is not None:
+            if self.ignore_punctuation:
+                # Matches were found with the punctuation removed.
+                phrases = [extract_values._remove_punctuation(phrase)
+                           for phrase in phrases]
+            match_query += ' WHERE phrase IN (%s)' % ', '.join(
+                '?' for _ in phrases)
+            query_args = [compat.to_str(phrase) for phrase in phrases]
+        # Rows of one note are in the order they were written.
+        match_query += ' ORDER BY note_row, rowid'
+        matches = self.connection.execute(match_query, query_args)
+        next_match = matches.fetchone()
+        for row in self.connection.cursor().execute(
+                'SELECT note_row, empi, mrn_type, mrn, report_type, '
+                'report_number, report_description, report_date, '
+                'source_filename, note_id, note FROM notes '
+                'ORDER BY note_row'):
+            note_row = row[0]
+            rpdr_note = extract_values.RPDRNote(
+                {'EMPI': row[1], 'MRN_Type': row[2], 'MRN': row[3],
+                 'Report_Type': row[4], 'Report_Number': row[5],
+                 'Report_Description': row[6], 'Report_Date_Time': row[7]},
+                zlib.decompress(row[10]), row[9], compat.to_str(row[8]))
+            phrase_matches = extract_values.NotePhraseMatches(rpdr_note,
+                                                              match_table)
+            while next_match is not None and next_match[0] == note_row:
+                _, match_start, match_end, phrase, extracted_value = (
+                    next_match)
+                # Dates are the only values stored as text.
+                extracted_value = compat.to_str(extracted_value)
+                phrase_matches.add_match(extracted_value, match_start,
+                                         match_end, phrase)
+                next_match = matches.fetchone()
+            phrase_matches.finalize_phrase_matches()
+            yield phrase_matches
+
+    def has_multiple_source_files(self):
+        num_source_filenames, = self.connection.execute(
+            'SELECT COUNT(DISTINCT source_filename) FROM notes').fetchone()
+        return num_source_filenames > 1
+
+
+def main(store_filename, output_filename, turk_csv_filename, context_size,
+         num_negative_matches_to_show, show_n_words_context_before,
+         show_n_words_context_after, aggregate=None, phrases=None,
+         turk_random_seed=None, stratify_negative_turk_matches=False,
+         turk_shard_size=None, turk_max_note_chars=None):
+    match_store = MatchStore(store_filename)
+    if phrases is not None:
+        phrases = [compat.to_bytes(phrase) for phrase in phrases]
+        unknown_phrases = set(phrases).difference(match_store.phrases)
+        if unknown_phrases:
+            raise ValueError('Phrases not in match store %s: %s' % (
+                store_filename, ', '.join(sorted(
+                    compat.to_str(phrase) for phrase in unknown_phrases))))
+    include_source_filename = match_store.has_multiple_source_files()
+    match_contexts = extract_values.PhraseMatchContexts(
+        show_n_words_context_before, show_n_words_context_after)
+    patient_aggregator = None
+    if aggregate is not None:
+        patient_aggregator = extract_values.PatientAggregator(
+            aggregate, match_store.phrase_type)
+    # The store is read once for each output rather than holding every note
+    # in memory.
+    if (patient_aggregator is not None or show_n_words_context_before or
+            show_n_words_context_after):
+        for phrase_matches in match_store.iterate_note_phrase_matches(
+                phrases):
+            note = phrase_matches.rpdr_note.note
+            for match_start, match_end, _, _ in phrase_matches.get_matches():
+                match_contexts.add_match_context(note, match_start, match_end)
+            if patient_aggregator is not None:
+                patient_aggregator.add_note_phrase_matches(phrase_matches)
+        match_contexts.print_ordered_contexts()
+    if output_filename is not None:
+        if patient_aggregator is not None:
+            extract_values._write_aggregate_csv_output(
+                patient_aggregator, output_filename, include_source_filename)
+        else:
+            extract_values._write_csv_output(
+                match_store.iterate_note_phrase_matches(phrases),
+                output_filename, include_source_filename)
+    if turk_csv_filename is not None:
+        extract_values._write_turk_verification_csv(
+            match_store.iterate_note_phrase_matches(phrases),
+            phrases or match_store.phrases, context_size, turk_csv_filename,
+            num_negative_matches_to_show, turk_random_seed,
+            stratify_negative_turk_matches, turk_shard_size,
+            turk_max_note_chars)
+    match_store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store_filename', help=(
+        'Path to a match store written by extract_values.py --match_store.'))
+    parser.add_argument('--output_filename', help=(
+        'Path to write the output CSV to, with the same rows as '
+        'extract_values.py.'))
+    parser.add_argument('--turk_csv_filename', help=(
+        'Path to write the localturk tasks CSV to, e.g. localturk/tasks.csv'))
+    parser.add_argument('--phrases', help=(
+        'Only use the matches of these comma separated phrases, which must '
+        'be phrases the store was extracted with.'))
+    parser.add_argument(
+        '--aggregate', choices=extract_values.AGGREGATE_MODES, help=(
+            'Write one output row per patient with the values of the '
+            'patient\'s notes aggregated with this function, as with '
+            'extract_values.py --aggregate.'))
+    parser.add_argument('--context_size', type=int, help=(
+        'Amount of context to show before/after a match (number of words).'))
+    parser.add_argument(
+        '--num_negative_turk_matches_to_show', type=int, default=0, help=(
+            'Turk verification will ask to verify all positive matches, and '
+            'up to this many negative matches.'))
+    parser.add_argument(
+        '--turk_random_seed', type=int, help=(
+            'Seed for sampling the negative matches shown for turk '
+            'verification, so the same notes are sampled on every run.'))
+    parser.add_argument(
+        '--stratify_negative_turk_matches', default=False,
+        action='store_true', help=(
+            'Sample negative matches from each report type in proportion to '
+            'the number of negative matches of that report type.'))
+    parser.add_argument(
+        '--turk_shard_size', type=int, help=(
+            'Write the turk verification tasks to numbered files of this many '
+            'tasks each, along with a manifest listing the finished files.'))
+    parser.add_argument(
+        '--turk_max_note_chars', type=int, help=(
+            'Cut notes longer than this many characters down to the text '
+            'around their matches for turk verification.'))
+    parser.add_argument(
+        '--show_n_words_context_before', type=int, default=0, help=(
+            'If specified, N words of context will be printed prior to each '
+            'match, along with the frequency of each context.'))
+    parser.add_argument(
+        '--show_n_words_context_after', type=int, default=0, help=(
+            'If specified, N words of context will be printed after each '
+            'match, along with the frequency of each context.'))
+    args = parser.parse_args()
+
+    phrases = None
+    if args.phrases is not None:
+        phrases = args.phrases.split(',')
+    main(args.store_filename, args.output_filename, args.turk_csv_filename,
+         args.context_size, args.num_negative_turk_matches_to_show,
+         args.show_n_words_context_before, args.show_n_words_context_after,
+         args.aggregate, phrases, args.turk_random_seed,
+         args.stratify_negative_turk_matches, args.turk_shard_size,
+         args.turk_max_note_chars)
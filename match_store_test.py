@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import extract_values
+import match_store
+
+RPDR_NOTES = (
+    b'EMPI|MRN_Type|MRN|Report_Number|Report_Date_Time|Report_Description|'
+    b'Report_Type|Report_Text\n'
+    b'1|MGH|1|R1|05/01/2016|Note|PRG|\n'
+    b'EF is 40, ejection fraction: 45. ef 50\n'
+    b'[report_end]\n'
+    b'2|MGH|2|R2|05/02/2016|Note|PRG|\n'
+    b'No echo.\n'
+    b'[report_end]\n'
+    b'2|MGH|2|R3|05/03/2016|Echo|CAR|\n'
+    b'ejection fraction of 55\n'
+    b'[report_end]\n')
+
+
+class TestMatchStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_filename = os.path.join(self.tmp_dir, 'matches.db')
+        rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        self.phrases = [b'ef', b'ejection fraction']
+        self.note_phrase_matches = extract_values._find_phrase_matches(
+            extract_values._read_notes(rpdr_filename),
+            extract_values.PHRASE_TYPE_NUM, self.phrases,
+            extract_values.PhraseMatchContexts(0, 0))
+        match_store.write_match_store(
+            self.store_filename, self.note_phrase_matches,
+            extract_values.PHRASE_TYPE_NUM, self.phrases)
+        self.match_store = match_store.MatchStore(self.store_filename)
+
+    def tearDown(self):
+        self.match_store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stored_rows_match_extraction(self):
+        self.assertEqual(extract_values.PHRASE_TYPE_NUM,
+                         self.match_store.phrase_type)
+        self.assertEqual(self.phrases, self.match_store.phrases)
+        stored_phrase_matches = list(
+            self.match_store.iterate_note_phrase_matches())
+        self.assertEqual(
+            extract_values._get_csv_output_rows(self.note_phrase_matches),
+            extract_values._get_csv_output_rows(stored_phrase_matches))
+        self.assertEqual(
+            extract_values._get_turk_verification_rows(
+                self.note_phrase_matches, 3, 1, 0),
+            extract_values._get_turk_verification_rows(
+                stored_phrase_matches, 3, 1, 0))
+
+    def test_only_matches_of_given_phrases(self):
+        self.assertEqual(
+            [[45.0], [], [55.0]],
+            [[phrase_match.extracted_value
+              for phrase_match in phrase_matches.phrase_matches]
+             for phrase_matches in
+             self.match_store.iterate_note_phrase_matches(
+                 [b'ejection fraction'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
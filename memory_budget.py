@@ -0,0 +1,209 @@
+"""Memory accounting with spilling to temporary files on disk.
+
+Used by extract_values.py --max_memory. Containers charge the approximate
+size of the items they hold to a shared MemoryBudget. The budget is exceeded
+when those sizes add up to more than the limit, or when the measured resident
+memory of the process is over the limit, and the containers then write their
+items to a temporary run file and drop them from memory. Items are read back
+from the runs when the container is iterated.
+"""
+import heapq
+import logging
+import re
+import sys
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import compat
+
+MEMORY_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                     'T': 1024 ** 4}
+
+
+def parse_memory_size(memory_size):
+    """Convert a size like "512M" or "2G" to a number of bytes."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$',
+                     memory_size.upper())
+    if not match:
+        raise ValueError('Invalid memory size %s. Expected a number of bytes '
+                         'optionally followed by K, M, G or T.' % memory_size)
+    number, unit = match.groups()
+    return int(float(number) * MEMORY_SIZE_UNITS[unit])
+
+
+def get_resident_bytes():
+    """Return the resident memory of this process in bytes, or None if it
+    can't be measured.
+
+    Uses /proc/self/statm where it exists. Otherwise falls back to the peak
+    resident memory from getrusage, which never goes down.
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+class MemoryBudget(object):
+    """Number of bytes held by the containers sharing it, checked against a
+    limit on the memory of the whole process.
+
+    The containers report approximate item sizes. Every measure_interval
+    bytes added, the resident memory of the process is also measured, and
+    once it is over max_bytes the containers spill whenever they hold at
+    least min_spill_bytes, so that memory used elsewhere, or underestimated
+    item sizes, still lead to spilling.
+    """
+    def __init__(self, max_bytes, spill_dir=None,
+                 get_resident_bytes=get_resident_bytes,
+                 measure_interval=2 ** 20, min_spill_bytes=2 ** 20):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.get_resident_bytes = get_resident_bytes
+        self.measure_interval = measure_interval
+        self.min_spill_bytes = min_spill_bytes
+        self.used_bytes = 0
+        self.num_runs = 0
+        self.resident_bytes = None
+        self.bytes_since_measured = 0
+
+    def add(self, num_bytes):
+        self.used_bytes += num_bytes
+        self.bytes_since_measured += num_bytes
+
+    def release(self, num_bytes):
+        self.used_bytes -= num_bytes
+
+    def is_exceeded(self):
+        if self.used_bytes > self.max_bytes:
+            return True
+        if self.bytes_since_measured >= self.measure_interval:
+            self.bytes_since_measured = 0
+            self.resident_bytes = self.get_resident_bytes()
+        return (self.resident_bytes is not None and
+                self.resident_bytes > self.max_bytes and
+                self.used_bytes >= self.min_spill_bytes)
+
+    def new_run_file(self):
+        self.num_runs += 1
+        if self.resident_bytes is None:
+            resident = 'unknown'
+        else:
+            resident = '%d bytes' % self.resident_bytes
+        logging.info('Memory budget of %d bytes exceeded (%d bytes held, '
+                     'resident memory %s), spilling run %d to disk' % (
+                         self.max_bytes, self.used_bytes, resident,
+                         self.num_runs))
+        return tempfile.TemporaryFile(dir=self.spill_dir)
+
+
+def _write_run(memory_budget, items):
+    run_file = memory_budget.new_run_file()
+    pickler = compat.pickle.Pickler(run_file, compat.pickle.HIGHEST_PROTOCOL)
+    for item in items:
+        pickler.dump(item)
+        # The pickler otherwise keeps a reference to every item written.
+        pickler.clear_memo()
+    return run_file
+
+
+def _read_run(run_file):
+    run_file.seek(0)
+    while True:
+        try:
+            # Items are loaded with a new memo each, to match the pickler's
+            # memo being cleared after each item.
+            yield compat.pickle.load(run_file)
+        except EOFError:
+            return
+
+
+class SpillList(object):
+    """An append only list that moves its items to disk when the memory
+    budget is exceeded. Iterating it yields all items in append order, and
+    it may be iterated any number of times."""
+    def __init__(self, memory_budget, get_size):
+        self.memory_budget = memory_budget
+        self.get_size = get_size
+        self.run_files = []
+        self.items = []
+        self.items_size = 0
+        self.num_items = 0
+
+    def append(self, item):
+        item_size = self.get_size(item)
+        self.items.append(item)
+        self.items_size += item_size
+        self.num_items += 1
+        self.memory_budget.add(item_size)
+        if self.memory_budget.is_exceeded():
+            self.spill()
+
+    def spill(self):
+        if not self.items:
+            return
+        self.run_files.append(_write_run(self.memory_budget, self.items))
+        self.memory_budget.release(self.items_size)
+        self.items = []
+        self.items_size = 0
+
+    def __len__(self):
+        return self.num_items
+
+    def __iter__(self):
+        for run_file in self.run_files:
+            for item in _read_run(run_file):
+                yield item
+        for item in self.items:
+            yield item
+
+    def close(self):
+        for run_file in self.run_files:
+            run_file.close()
+        self.memory_budget.release(self.items_size)
+        self.run_files = []
+        self.items = []
+        self.items_size = 0
+
+
+def iterate_sorted(items, get_key, memory_budget, get_size):
+    """Yield (key, item) for all items sorted by key, with items of equal key
+    in their original order, using sorted runs on disk when the memory
+    budget is exceeded."""
+    run_files = []
+    buffered = []
+    buffered_size = 0
+    for item_number, item in enumerate(items):
+        item_size = get_size(item)
+        buffered.append((get_key(item), item_number, item))
+        buffered_size += item_size
+        memory_budget.add(item_size)
+        if memory_budget.is_exceeded():
+            buffered.sort(key=lambda x: x[:2])
+            run_files.append(_write_run(memory_budget, buffered))
+            memory_budget.release(buffered_size)
+            buffered = []
+            buffered_size = 0
+    buffered.sort(key=lambda x: x[:2])
+    # Keys and item numbers are unique together, so items are never compared.
+    runs = [_read_run(run_file) for run_file in run_files] + [iter(buffered)]
+    try:
+        for key, _, item in heapq.merge(*runs):
+            yield key, item
+    finally:
+        memory_budget.release(buffered_size)
+        for run_file in run_files:
+            run_file.close()
@@ -0,0 +1,100 @@
+import unittest
+
+import memory_budget
+
+
+class TestParseMemorySize(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(100, memory_budget.parse_memory_size('100'))
+        self.assertEqual(512 * 1024 ** 2,
+                         memory_budget.parse_memory_size('512M'))
+        self.assertEqual(int(1.5 * 1024 ** 3),
+                         memory_budget.parse_memory_size('1.5gb'))
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, memory_budget.parse_memory_size, 'lots')
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_exceeded_by_measured_memory(self):
+        resident_bytes = [100]
+        budget = memory_budget.MemoryBudget(
+            1000, get_resident_bytes=lambda: resident_bytes[0],
+            measure_interval=10, min_spill_bytes=20)
+        budget.add(50)
+        self.assertFalse(budget.is_exceeded())
+        resident_bytes[0] = 2000
+        budget.add(5)
+        # Not measured again until measure_interval bytes are added.
+        self.assertFalse(budget.is_exceeded())
+        budget.add(5)
+        self.assertTrue(budget.is_exceeded())
+        # Nothing is spilled while less than min_spill_bytes are held.
+        budget.release(50)
+        self.assertFalse(budget.is_exceeded())
+
+    def test_unmeasured_memory_uses_item_sizes(self):
+        budget = memory_budget.MemoryBudget(
+            1000, get_resident_bytes=lambda: None, measure_interval=1,
+            min_spill_bytes=1)
+        budget.add(1000)
+        self.assertFalse(budget.is_exceeded())
+        budget.add(1)
+        self.assertTrue(budget.is_exceeded())
+
+    def test_get_resident_bytes(self):
+        resident_bytes = memory_budget.get_resident_bytes()
+        self.assertTrue(resident_bytes is None or resident_bytes > 0)
+
+
+class TestSpillList(unittest.TestCase):
+    def test_spilled_items_are_read_back_in_order(self):
+        budget = memory_budget.MemoryBudget(10)
+        spill_list = memory_budget.SpillList(budget, len)
+        items = ['item%d' % i for i in range(20)]
+        for item in items:
+            spill_list.append(item)
+        self.assertTrue(budget.num_runs > 1)
+        self.assertEqual(20, len(spill_list))
+        self.assertEqual(items, list(spill_list))
+        # Runs can be read more than once.
+        self.assertEqual(items, list(spill_list))
+        spill_list.close()
+        self.assertEqual(0, budget.used_bytes)
+
+    def test_no_spill_under_budget(self):
+        budget = memory_budget.MemoryBudget(1000)
+        spill_list = memory_budget.SpillList(budget, len)
+        spill_list.append('item')
+        self.assertEqual(0, budget.num_runs)
+        self.assertEqual(['item'], list(spill_list))
+
+    def test_spill_when_process_memory_is_over_budget(self):
+        budget = memory_budget.MemoryBudget(
+            1000, get_resident_bytes=lambda: 5000, measure_interval=8,
+            min_spill_bytes=8)
+        spill_list = memory_budget.SpillList(budget, len)
+        items = ['item%d' % i for i in range(10)]
+        for item in items:
+            spill_list.append(item)
+        self.assertEqual(5, budget.num_runs)
+        self.assertEqual(items, list(spill_list))
+        spill_list.close()
+
+
+class TestIterateSorted(unittest.TestCase):
+    def test_stable_sort_across_runs(self):
+        budget = memory_budget.MemoryBudget(20)
+        items = [('b', 1), ('a', 2), ('c', 3), ('a', 4), ('b', 5), ('a', 6)]
+        sorted_items = list(memory_budget.iterate_sorted(
+            items, lambda item: item[0], budget, lambda item: 8))
+        self.assertTrue(budget.num_runs > 1)
+        self.assertEqual(
+            [('a', ('a', 2)), ('a', ('a', 4)), ('a', ('a', 6)),
+             ('b', ('b', 1)), ('b', ('b', 5)), ('c', ('c', 3))],
+            sorted_items)
+        self.assertEqual(0, budget.used_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+"""Build and query a positional inverted index over the tokens of a notes file.
+
+Notes are split into whitespace separated tokens, the same boundaries that
+the PHRASE_TYPE_WORD patterns in extract_values.py require around a phrase.
+Each lowercased token is indexed, along with each prefix of the token that
+ends right before one of the punctuation characters allowed after a phrase
+(",.?!-"), so "vent," is found when querying "vent".
+
+The index file holds, for every term, a posting list of (note id, token
+positions and character offsets), delta and varint encoded, followed by a
+pickled term dictionary and an 8 byte footer with the dictionary's offset.
+Terms are bytes, like the notes they come from.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import struct
+
+import compat
+import extract_values
+
+INDEX_VERSION = 1
+
+TOKEN_RE = re.compile(br'\S+')
+
+# Characters allowed right after a phrase by the PHRASE_TYPE_WORD patterns.
+PHRASE_END_PUNCTUATION = b',.?!-'
+
+# Phrases containing these are regexes rather than literal phrases and can't
+# be answered from the index.
+REGEX_CHARACTERS_RE = re.compile(br'[\\^$.*+?{}\[\]()|]')
+# Whitespace other than spaces, which the index can't match in a phrase.
+NON_SPACE_WHITESPACE_RE = re.compile(br'[^\S ]')
+
+FOOTER_FORMAT = '<Q'
+# Pickle protocol of the term dictionary, the highest both Python 2 and 3
+# can read.
+PICKLE_PROTOCOL = 2
+
+
+def get_default_index_filename(input_filename):
+    return input_filename + '.idx'
+
+
+def _encode_varint(value, output):
+    while value >= 0x80:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def _decode_varints(data):
+    """Yield each varint encoded in data."""
+    value = 0
+    shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = 0
+            shift = 0
+
+
+class _PostingListBuilder(object):
+    """Encodes the occurrences of one term, one note at a time."""
+    def __init__(self):
+        self.data = bytearray()
+        self.last_note_id = 0
+
+    def add_note(self, note_id, occurrences):
+        _encode_varint(note_id - self.last_note_id, self.data)
+        self.last_note_id = note_id
+        _encode_varint(len(occurrences), self.data)
+        last_position = 0
+        last_offset = 0
+        for position, offset in occurrences:
+            _encode_varint(position - last_position, self.data)
+            _encode_varint(offset - last_offset, self.data)
+            last_position = position
+            last_offset = offset
+
+
+def _decode_posting_list(data):
+    """Return a dict mapping note ids to a dict of token position to
+    character offset."""
+    note_id_to_occurrences = {}
+    varints = _decode_varints(data)
+    note_id = 0
+    for note_id_delta in varints:
+        note_id += note_id_delta
+        occurrences = {}
+        position = 0
+        offset = 0
+        for _ in compat.xrange(next(varints)):
+            position += next(varints)
+            offset += next(varints)
+            occurrences[position] = offset
+        note_id_to_occurrences[note_id] = occurrences
+    return note_id_to_occurrences
+
+
+def _get_note_terms(note):
+    """Return (term_occurrences, prefix_term_occurrences) mapping each term
+    of note to a list of (token position, character offset)."""
+    term_occurrences = {}
+    prefix_term_occurrences = {}
+    for position, match in enumerate(TOKEN_RE.finditer(note)):
+        token = match.group().lower()
+        offset = match.start()
+        term_occurrences.setdefault(token, []).append((position, offset))
+        prefixes = set()
+        for i in compat.xrange(1, len(token)):
+            if token[i:i + 1] in PHRASE_END_PUNCTUATION:
+                prefixes.add(token[:i])
+        for prefix in prefixes:
+            prefix_term_occurrences.setdefault(prefix, []).append(
+                (position, offset))
+    return term_occurrences, prefix_term_occurrences
+
+
+def build_index(input_filename, index_filename, input_format='rpdr'):
+    """Index every note of input_filename, as numbered by its NoteReader."""
+    term_postings = {}
+    prefix_term_postings = {}
+    num_notes = 0
+    for rpdr_note in extract_values.NOTE_READERS[input_format](
+            input_filename):
+        num_notes += 1
+        term_occurrences, prefix_term_occurrences = _get_note_terms(
+            rpdr_note.note)
+        for postings, occurrences in [
+                (term_postings, term_occurrences),
+                (prefix_term_postings, prefix_term_occurrences)]:
+            for term, term_occurrences in occurrences.items():
+                if term not in postings:
+                    postings[term] = _PostingListBuilder()
+                postings[term].add_note(rpdr_note.note_id, term_occurrences)
+
+    input_stat = os.stat(input_filename)
+    header = {
+        'version': INDEX_VERSION,
+        'input_format': input_format,
+        'source_size': input_stat.st_size,
+        'source_mtime': input_stat.st_mtime,
+        'num_notes': num_notes,
+    }
+    with open(index_filename, 'wb') as index_file:
+        for name, postings in [('terms', term_postings),
+                               ('prefix_terms', prefix_term_postings)]:
+            term_locations = {}
+            for term, posting_list in postings.items():
+                term_locations[term] = (index_file.tell(),
+                                        len(posting_list.data))
+                index_file.write(posting_list.data)
+            header[name] = term_locations
+        header_offset = index_file.tell()
+        compat.pickle.dump(header, index_file, PICKLE_PROTOCOL)
+        index_file.write(struct.pack(FOOTER_FORMAT, header_offset))
+    return num_notes
+
+
+def is_indexable_phrase(phrase):
+    """Return True if phrase is a literal phrase the index can answer."""
+    if not phrase or phrase != phrase.strip() or b'  ' in phrase:
+        return False
+    if NON_SPACE_WHITESPACE_RE.search(phrase):
+        return False
+    return not REGEX_CHARACTERS_RE.search(phrase)
+
+
+def _load_header(index_file):
+    if compat.PY2:
+        return compat.pickle.load(index_file)
+    # Indexes built under Python 2 pickle their terms as str, which are
+    # loaded as latin-1 text and turned back into the same bytes.
+    header = compat.pickle.load(index_file, encoding='latin1')
+    for name in ['terms', 'prefix_terms']:
+        header[name] = dict(
+            (term.encode('latin1') if isinstance(term, str) else term,
+             location) for term, location in header[name].items())
+    return header
+
+
+class NoteIndex(object):
+    """A note index built by build_index, read from disk as needed."""
+    def __init__(self, index_filename):
+        self.index_filename = index_filename
+        self.index_file = open(index_filename, 'rb')
+        footer_size = struct.calcsize(FOOTER_FORMAT)
+        self.index_file.seek(-footer_size, os.SEEK_END)
+        header_offset, = struct.unpack(FOOTER_FORMAT,
+                                       self.index_file.read(footer_size))
+        self.index_file.seek(header_offset)
+        header = _load_header(self.index_file)
+        if header['version'] != INDEX_VERSION:
+            raise ValueError('Index %s has version %s, expected %s. Rebuild '
+                             'it with note_index.py' %
+                             (index_filename, header['version'],
+                              INDEX_VERSION))
+        self.header = header
+        self.num_notes = header['num_notes']
+
+    def close(self):
+        self.index_file.close()
+
+    def check_source(self, input_filename, input_format='rpdr'):
+        """Raise a ValueError if the index was not built from the current
+        version of input_filename."""
+        input_stat = os.stat(input_filename)
+        if (input_stat.st_size != self.header['source_size'] or
+                input_stat.st_mtime != self.header['source_mtime'] or
+                input_format != self.header['input_format']):
+            raise ValueError('Index %s is out of date for %s. Rebuild it with '
+                             'note_index.py' % (self.index_filename,
+                                                input_filename))
+
+    def _get_postings(self, name, term):
+        location = self.header[name].get(term)
+        if location is None:
+            return {}
+        offset, length = location
+        self.index_file.seek(offset)
+        return _decode_posting_list(self.index_file.read(length))
+
+    def find_phrase(self, phrase):
+        """Return a dict mapping note ids to a list of (match_start,
+        match_end) for each occurrence of phrase.
+
+        Matches are case insensitive and use the same boundaries as the
+        PHRASE_TYPE_WORD patterns, except that words in the phrase may be
+        separated by any single whitespace character, every occurrence is
+        returned once and matches don't include the surrounding whitespace.
+        The notes returned therefore include every note the patterns match,
+        and extract_values matches the patterns against just those notes.
+        """
+        if not is_indexable_phrase(phrase):
+            raise ValueError('Phrase %s can not be answered from the index' %
+                             compat.to_str(phrase))
+        words = phrase.lower().split(b' ')
+        # The last word may be followed by punctuation, other words must be
+        # whole tokens.
+        last_word_postings = self._get_postings('terms', words[-1])
+        for note_id, occurrences in self._get_postings(
+                'prefix_terms', words[-1]).items():
+            last_word_postings.setdefault(note_id, {}).update(occurrences)
+        word_postings = [self._get_postings('terms', word)
+                         for word in words[:-1]] + [last_word_postings]
+
+        note_ids = set(word_postings[0])
+        for postings in word_postings[1:]:
+            note_ids.intersection_update(postings)
+
+        note_id_to_matches = {}
+        for note_id in note_ids:
+            matches = []
+            for position, offset in sorted(
+                    word_postings[0][note_id].items()):
+                word_offset = offset
+                for i in compat.xrange(1, len(words)):
+                    word_offset += len(words[i - 1]) + 1
+                    if (word_postings[i][note_id].get(position + i) !=
+                            word_offset):
+                        break
+                else:
+                    matches.append((offset, offset + len(phrase)))
+            if matches:
+                note_id_to_matches[note_id] = matches
+        return note_id_to_matches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_filename',
+                        help=('Path to an RPDR formatted '
+                              'text file, e.g. /Users/user1/../file.txt'))
+    parser.add_argument(
+        '--index_filename', help=(
+            'Path to write the index at. Defaults to the input filename '
+            'with .idx appended.'))
+    parser.add_argument(
+        '--input_format', default='rpdr',
+        choices=sorted(extract_values.NOTE_READERS),
+        help='Format of the input file. Defaults to rpdr.')
+    args = parser.parse_args()
+    index_filename = (args.index_filename or
+                      get_default_index_filename(args.input_filename))
+    num_notes = build_index(args.input_filename, index_filename,
+                            args.input_format)
+    print('Indexed %d notes to %s' % (num_notes, index_filename))
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import extract_values
+import note_index
+
+RPDR_NOTES = (
+    b'EMPI|MRN_Type|MRN|Report_Number|Report_Date_Time|Report_Description|'
+    b'Report_Type|Report_Text\n'
+    b'1|MGH|1|R1|05/01/2016|Note|PRG|\n'
+    b'Pt on Vent, with g-tube.\n'
+    b'[report_end]\n'
+    b'2|MGH|2|R2|05/01/2016|Note|PRG|\n'
+    b'ventilate full code (confirmed) vent\n'
+    b'[report_end]\n'
+    b'3|MGH|3|R3|05/01/2016|Note|PRG|\n'
+    b'full code confirmed. full  code\n'
+    b'[report_end]\n')
+
+
+class TestNoteIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        self.index_filename = note_index.get_default_index_filename(
+            self.rpdr_filename)
+        note_index.build_index(self.rpdr_filename, self.index_filename)
+        self.rpdr_note_index = note_index.NoteIndex(self.index_filename)
+        self.rpdr_notes = extract_values._parse_rpdr_text_file(
+            self.rpdr_filename)
+
+    def tearDown(self):
+        self.rpdr_note_index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _get_regex_match_note_ids(self, phrase):
+        match_contexts = extract_values.PhraseMatchContexts(0, 0)
+        return set(
+            rpdr_note.note_id for rpdr_note in self.rpdr_notes
+            if extract_values._extract_phrase_from_notes(
+                extract_values.PHRASE_TYPE_WORD, [phrase], rpdr_note,
+                match_contexts).phrase_matches)
+
+    def test_same_notes_as_regex(self):
+        for phrase in [b'vent', b'VENT', b'g-tube', b'g', b'tube',
+                       b'full code', b'full code confirmed', b'code confirmed',
+                       b'confirmed', b'ventilate', b'pt on vent']:
+            self.assertEqual(
+                self._get_regex_match_note_ids(phrase),
+                set(self.rpdr_note_index.find_phrase(phrase)), phrase)
+
+    def test_match_offsets(self):
+        note_id_to_matches = self.rpdr_note_index.find_phrase(b'full code')
+        self.assertEqual({1: [(10, 19)], 2: [(0, 9)]}, note_id_to_matches)
+        self.assertEqual(b'full code',
+                         self.rpdr_notes[1].note[10:19])
+
+    def test_same_matches_as_scanning_notes(self):
+        rpdr_filename = os.path.join(self.tmp_dir, 'other_notes.txt')
+        with open(rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(
+                b'EMPI|MRN_Type|MRN|Report_Number|Report_Text\n'
+                b'1|MGH|1|R1|\nvent vent vent\nVent\n[report_end]\n'
+                b'2|MGH|2|R2|\nfull\ncode, full  code full code-\n'
+                b'[report_end]\n'
+                b'3|MGH|3|R3|\nventilate. vent.\tcode\n[report_end]\n'
+                b'4|MGH|4|R4|\nnothing here\n[report_end]\n')
+        index_filename = note_index.get_default_index_filename(rpdr_filename)
+        note_index.build_index(rpdr_filename, index_filename)
+        rpdr_note_index = note_index.NoteIndex(index_filename)
+        results = []
+        for index in [None, rpdr_note_index]:
+            match_contexts = extract_values.PhraseMatchContexts(1, 1)
+            note_phrase_matches = extract_values._find_phrase_matches(
+                extract_values._read_notes(rpdr_filename),
+                extract_values.PHRASE_TYPE_WORD,
+                [b'vent', b'full code', b'code'], match_contexts,
+                rpdr_note_index=index)
+            results.append(([phrase_matches.get_matches()
+                             for phrase_matches in note_phrase_matches],
+                            match_contexts.context_frequencies))
+        rpdr_note_index.close()
+        self.assertEqual(results[0], results[1])
+        # Every note but the last has matches for the index to find.
+        self.assertEqual([True, True, True, False],
+                         [bool(matches) for matches in results[0][0]])
+
+    def test_regex_phrases_are_not_indexable(self):
+        self.assertFalse(note_index.is_indexable_phrase(b'ef|lvef'))
+        self.assertFalse(note_index.is_indexable_phrase(b'b.i.d'))
+        self.assertFalse(note_index.is_indexable_phrase(b'full  code'))
+        self.assertTrue(note_index.is_indexable_phrase(b'g-tube placed'))
+
+    def test_stale_index_is_rejected(self):
+        with open(self.rpdr_filename, 'ab') as rpdr_file:
+            rpdr_file.write(b'\n')
+        self.assertRaises(ValueError, self.rpdr_note_index.check_source,
+                          self.rpdr_filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
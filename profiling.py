@@ -0,0 +1,153 @@
+"""Profiling hooks shared by the command line tools.
+
+Each tool's --profile option runs its main function under a profiler and
+writes the profile to --profile_dir:
+
+    python extract_values.py notes.txt --phrases EF --profile cpu
+    python -m pstats extract_values.20161018-101500.1234.prof
+
+cpu profiles are cProfile dumps, readable with pstats or snakeviz. memory
+profiles are tracemalloc snapshots, along with a text file of the lines
+holding the most memory at the end of the run. Only the main process is
+profiled, not --workers processes.
+"""
+from __future__ import print_function
+
+import cProfile
+import heapq
+import itertools
+import os
+import time
+
+import compat
+
+PROFILE_CPU = 'cpu'
+PROFILE_MEMORY = 'memory'
+PROFILE_MODES = [PROFILE_CPU, PROFILE_MEMORY]
+
+# Frames kept for each memory allocation, and lines listed in the memory
+# profile summary.
+MEMORY_TRACEBACK_FRAMES = 10
+MEMORY_TOP_LINES = 50
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        '--profile', choices=PROFILE_MODES, help=(
+            'Profile the run: cpu writes a cProfile dump and memory writes a '
+            'tracemalloc snapshot, which needs Python 3.4 or later.'))
+    parser.add_argument(
+        '--profile_dir', default='.', help=(
+            'Directory to write --profile dumps to. Defaults to the current '
+            'directory.'))
+
+
+def _import_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        raise Exception('--profile memory requires the tracemalloc module, '
+                        'which is part of Python 3.4 or later.')
+    return tracemalloc
+
+
+def _get_profile_filename(profile_dir, name, extension):
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    return os.path.join(profile_dir, '%s.%s.%d.%s' % (
+        name, time.strftime('%Y%m%d-%H%M%S'), os.getpid(), extension))
+
+
+def run_profiled(profile_mode, profile_dir, name, function, *args, **kwargs):
+    """Return function(*args, **kwargs), profiled with profile_mode if it is
+    not None and the profile written to profile_dir in files starting with
+    name."""
+    if profile_mode is None:
+        return function(*args, **kwargs)
+    if profile_mode == PROFILE_CPU:
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            profile_filename = _get_profile_filename(profile_dir, name,
+                                                     'prof')
+            profiler.dump_stats(profile_filename)
+            print('Wrote CPU profile to %s' % profile_filename)
+    elif profile_mode == PROFILE_MEMORY:
+        tracemalloc = _import_tracemalloc()
+        tracemalloc.start(MEMORY_TRACEBACK_FRAMES)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak_size = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            profile_filename = _get_profile_filename(profile_dir, name,
+                                                     'tracemalloc')
+            snapshot.dump(profile_filename)
+            with open(profile_filename + '.txt', 'w') as summary_file:
+                summary_file.write('Peak traced memory: %d bytes\n' %
+                                   peak_size)
+                for statistic in snapshot.statistics('lineno')[
+                        :MEMORY_TOP_LINES]:
+                    summary_file.write('%s\n' % statistic)
+            print('Wrote memory profile to %s' % profile_filename)
+    else:
+        raise ValueError('Invalid profile mode %s' % profile_mode)
+
+
+class SlowNoteLog(object):
+    """The max_notes notes that took longest to match, for each phrase."""
+    def __init__(self, max_notes):
+        self.max_notes = max_notes
+        # Phrase to a heap of (seconds, number, note description), where
+        # number keeps entries with equal times from comparing descriptions.
+        self.phrase_to_slow_notes = {}
+        self.entry_numbers = itertools.count()
+
+    def _add(self, phrase, seconds, note_description):
+        slow_notes = self.phrase_to_slow_notes.setdefault(phrase, [])
+        entry = (seconds, next(self.entry_numbers), note_description)
+        if len(slow_notes) < self.max_notes:
+            heapq.heappush(slow_notes, entry)
+        elif seconds > slow_notes[0][0]:
+            heapq.heapreplace(slow_notes, entry)
+
+    def add_note(self, rpdr_note, phrase_seconds):
+        """Record the seconds it took to match each phrase in rpdr_note,
+        given as a dict of phrase to seconds."""
+        note_description = (rpdr_note.note_id, rpdr_note.source_filename,
+                            rpdr_note.empi, rpdr_note.report_number,
+                            rpdr_note.get_note_length())
+        for phrase, seconds in phrase_seconds.items():
+            self._add(phrase, seconds, note_description)
+
+    def get_slow_notes(self):
+        """Return a dict of phrase to a list of (seconds, note description)
+        for its slowest notes, slowest first and in the order they were added
+        for equal times."""
+        return dict(
+            (phrase, [(seconds, note_description) for seconds, _,
+                      note_description in sorted(
+                          slow_notes, key=lambda entry: (-entry[0],
+                                                         entry[1]))])
+            for phrase, slow_notes in self.phrase_to_slow_notes.items())
+
+    def add_slow_notes(self, phrase_to_slow_notes):
+        """Add the slow notes of another log, as returned by its
+        get_slow_notes."""
+        for phrase, slow_notes in phrase_to_slow_notes.items():
+            for seconds, note_description in slow_notes:
+                self._add(phrase, seconds, note_description)
+
+    def print_slow_notes(self):
+        for phrase, slow_notes in sorted(self.get_slow_notes().items()):
+            print('Slowest notes to match "%s":' %
+                  compat.to_display_str(phrase))
+            for seconds, note_description in slow_notes:
+                (note_id, source_filename, empi, report_number,
+                 note_length) = note_description
+                print('%.6fs note %s of %s, EMPI %s, report %s, %d chars' %
+                      (seconds, note_id, source_filename,
+                       compat.to_display_str(empi),
+                       compat.to_display_str(report_number), note_length))
@@ -0,0 +1,60 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import extract_values
+import profiling
+
+
+class TestRunProfiled(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cpu_profile(self):
+        profile_dir = os.path.join(self.tmp_dir, 'profiles')
+        self.assertEqual(3, profiling.run_profiled(
+            profiling.PROFILE_CPU, profile_dir, 'test', sum, [1, 2]))
+        profile_filenames = os.listdir(profile_dir)
+        self.assertEqual(1, len(profile_filenames))
+        self.assertTrue(profile_filenames[0].startswith('test.'))
+        stats = pstats.Stats(os.path.join(profile_dir, profile_filenames[0]))
+        self.assertTrue(stats.total_calls > 0)
+
+    def test_no_profile(self):
+        self.assertEqual(3, profiling.run_profiled(None, self.tmp_dir, 'test',
+                                                   sum, [1, 2]))
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+
+class TestSlowNoteLog(unittest.TestCase):
+    def test_keeps_slowest_notes_per_phrase(self):
+        slow_note_log = profiling.SlowNoteLog(2)
+        for note_id, seconds in enumerate([0.1, 0.3, 0.2, 0.3]):
+            rpdr_note = extract_values.RPDRNote(
+                {'EMPI': '1', 'MRN_Type': 'MGH', 'MRN': '1',
+                 'Report_Number': 'R%d' % note_id}, 'x' * note_id, note_id)
+            slow_note_log.add_note(rpdr_note, {'ef': seconds,
+                                               'echo': seconds / 10})
+        slow_notes = slow_note_log.get_slow_notes()
+        self.assertEqual(['echo', 'ef'], sorted(slow_notes))
+        self.assertEqual(
+            [(0.3, (1, None, '1', 'R1', 1)), (0.3, (3, None, '1', 'R3', 3))],
+            slow_notes['ef'])
+
+        merged_log = profiling.SlowNoteLog(2)
+        merged_log.add_slow_notes({'ef': [(0.25, (5, 'b.txt', '2', 'R5', 9))]})
+        merged_log.add_slow_notes(slow_notes)
+        self.assertEqual([0.3, 0.3], [
+            seconds for seconds, _ in merged_log.get_slow_notes()['ef']])
+        self.assertEqual([1, 3], [
+            note_description[0] for _, note_description in
+            merged_log.get_slow_notes()['echo']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,301 @@
+"""Serve extraction queries against RPDR notes files loaded into memory once.
+
+Notes files are parsed when the server starts and kept in memory, along with
+the compiled phrase patterns and the results of recent queries, so repeated
+queries don't pay the startup, parsing and pattern compilation costs of
+extract_values.py. Indexes built with note_index.py next to the notes files
+are loaded too and used for the queries they can answer.
+
+Queries are POSTed as JSON to /extract, e.g.
+    curl -d '{"phrases": ["ef"], "phrase_type": "num"}' localhost:8765/extract
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import copy
+import csv
+import json
+import logging
+import os
+import re
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from StringIO import StringIO
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from io import StringIO
+
+import compat
+import extract_values
+import note_index
+
+PHRASE_TYPES = {
+    'word': extract_values.PHRASE_TYPE_WORD,
+    'num': extract_values.PHRASE_TYPE_NUM,
+    'date': extract_values.PHRASE_TYPE_DATE,
+}
+
+OUTPUT_TYPES = ['rows', 'csv', 'turk']
+
+# Number of query results kept for repeated queries.
+MAX_CACHED_RESULTS = 64
+
+
+class QueryError(Exception):
+    """Raised for invalid extraction queries."""
+
+
+class ExtractionCorpus(object):
+    """RPDR notes from one or more files, kept in memory between queries."""
+    def __init__(self, input_filenames, input_format='rpdr'):
+        self.filename_to_notes = collections.OrderedDict()
+        self.filename_to_note_index = {}
+        for input_filename in input_filenames:
+            self.filename_to_notes[input_filename] = (
+                extract_values._read_notes(input_filename, input_format))
+            logging.info('Loaded %d notes from %s' % (
+                len(self.filename_to_notes[input_filename]), input_filename))
+            index_filename = note_index.get_default_index_filename(
+                input_filename)
+            if not os.path.exists(index_filename):
+                continue
+            rpdr_note_index = note_index.NoteIndex(index_filename)
+            try:
+                rpdr_note_index.check_source(input_filename, input_format)
+            except ValueError as e:
+                logging.warning(str(e))
+                rpdr_note_index.close()
+                continue
+            self.filename_to_note_index[input_filename] = rpdr_note_index
+            logging.info('Loaded index %s' % index_filename)
+        # Copies of the notes with punctuation removed, made on first use.
+        self.filename_to_notes_without_punctuation = {}
+        self.cached_results = collections.OrderedDict()
+
+    def get_status(self):
+        return {
+            'files': [{'filename': filename, 'num_notes': len(rpdr_notes),
+                       'indexed': filename in self.filename_to_note_index}
+                      for filename, rpdr_notes in
+                      self.filename_to_notes.items()],
+            'num_cached_results': len(self.cached_results),
+        }
+
+    def _get_notes(self, input_filename, ignore_punctuation):
+        if input_filename not in self.filename_to_notes:
+            raise QueryError('File not loaded: %s' % input_filename)
+        if not ignore_punctuation:
+            return self.filename_to_notes[input_filename]
+        if input_filename not in self.filename_to_notes_without_punctuation:
+            notes_without_punctuation = []
+            for rpdr_note in self.filename_to_notes[input_filename]:
+                rpdr_note = copy.copy(rpdr_note)
+                rpdr_note.remove_punctuation_from_note()
+                notes_without_punctuation.append(rpdr_note)
+            self.filename_to_notes_without_punctuation[input_filename] = (
+                notes_without_punctuation)
+        return self.filename_to_notes_without_punctuation[input_filename]
+
+    def query(self, query):
+        """Return (content_type, body) for a query dict, reusing the result
+        of an identical earlier query if there was one."""
+        cache_key = json.dumps(query, sort_keys=True)
+        if cache_key in self.cached_results:
+            return self.cached_results[cache_key]
+        result = self._run_query(query)
+        self.cached_results[cache_key] = result
+        if len(self.cached_results) > MAX_CACHED_RESULTS:
+            self.cached_results.popitem(last=False)
+        return result
+
+    def _run_query(self, query):
+        phrases = query.get('phrases')
+        if isinstance(phrases, compat.string_types):
+            phrases = phrases.split(',')
+        if (not isinstance(phrases, list) or not phrases or
+                not all(isinstance(phrase, compat.string_types)
+                        for phrase in phrases)):
+            raise QueryError('Expected a list of phrases.')
+        phrase_type = query.get('phrase_type', 'word')
+        if (not isinstance(phrase_type, compat.string_types) or
+                phrase_type not in PHRASE_TYPES):
+            raise QueryError('Invalid phrase_type %s. Expected one of %s' %
+                             (phrase_type, sorted(PHRASE_TYPES)))
+        phrase_type = PHRASE_TYPES[phrase_type]
+        output = query.get('output', 'rows')
+        if output not in OUTPUT_TYPES:
+            raise QueryError('Invalid output %s. Expected one of %s' %
+                             (output, OUTPUT_TYPES))
+        aggregate = query.get('aggregate')
+        patient_aggregator = None
+        if aggregate is not None:
+            try:
+                patient_aggregator = extract_values.PatientAggregator(
+                    aggregate, phrase_type)
+            except ValueError as e:
+                raise QueryError(str(e))
+        for name in ['report_description', 'report_type']:
+            value = query.get(name)
+            if value is not None and not isinstance(value,
+                                                    compat.string_types):
+                raise QueryError('Expected %s to be a string.' % name)
+        for name in ['context_size', 'show_n_words_context_before',
+                     'show_n_words_context_after',
+                     'num_negative_turk_matches_to_show',
+                     'turk_max_note_chars']:
+            value = query.get(name)
+            if value is not None and (not isinstance(value, int) or
+                                      isinstance(value, bool) or value < 0):
+                raise QueryError('Expected %s to be a non-negative integer.'
+                                 % name)
+        input_filenames = query.get('input_filenames',
+                                    list(self.filename_to_notes))
+        if (not isinstance(input_filenames, list) or
+                not all(isinstance(input_filename, compat.string_types)
+                        for input_filename in input_filenames)):
+            raise QueryError('Expected a list of input_filenames.')
+        group_by_patient = query.get('group_by_patient', False)
+        context_size = query.get('context_size')
+        if context_size is None and group_by_patient:
+            context_size = 10
+        ignore_punctuation = query.get('ignore_punctuation', False)
+        if patient_aggregator is not None:
+            group_by_patient = False
+        # The query encodes the phrases and report filters as UTF-8 bytes.
+        try:
+            extraction_query = extract_values.ExtractionQuery(
+                phrases, phrase_type, ignore_punctuation,
+                query.get('report_description'), query.get('report_type'))
+        except re.error as e:
+            raise QueryError('Invalid phrase: %s' % e)
+        use_note_index = extraction_query.can_use_note_index(group_by_patient)
+        match_contexts = extract_values.PhraseMatchContexts(
+            query.get('show_n_words_context_before', 0),
+            query.get('show_n_words_context_after', 0))
+
+        filename_to_rpdr_notes = collections.OrderedDict()
+        for input_filename in input_filenames:
+            filename_to_rpdr_notes[input_filename] = list(
+                extraction_query.filter_notes(
+                    self._get_notes(input_filename, ignore_punctuation)))
+        if group_by_patient:
+            # Patients may have notes in several files.
+            rpdr_notes = []
+            for file_rpdr_notes in filename_to_rpdr_notes.values():
+                rpdr_notes.extend(file_rpdr_notes)
+            filename_to_rpdr_notes = {
+                None: extract_values._group_rpdr_notes_by_patient(rpdr_notes)}
+        note_phrase_matches = []
+        for input_filename, rpdr_notes in filename_to_rpdr_notes.items():
+            rpdr_note_index = None
+            if use_note_index:
+                rpdr_note_index = self.filename_to_note_index.get(
+                    input_filename)
+            # The notes already have their punctuation removed for
+            # ignore_punctuation.
+            note_phrase_matches.extend(extract_values._find_phrase_matches(
+                rpdr_notes, phrase_type, extraction_query.phrases,
+                match_contexts, patient_aggregator, rpdr_note_index))
+
+        if output == 'turk':
+            return 'text/csv', _get_csv(
+                [extract_values.TURK_CSV_HEADER] +
+                extract_values._get_turk_verification_rows(
+                    note_phrase_matches, context_size,
+                    query.get('num_negative_turk_matches_to_show', 0),
+                    query.get('turk_random_seed'),
+                    query.get('stratify_negative_turk_matches', False),
+                    query.get('turk_max_note_chars')))
+        if patient_aggregator is not None:
+            rows = patient_aggregator.get_rows()
+        else:
+            rows = extract_values._get_csv_output_rows(note_phrase_matches)
+        if output == 'csv':
+            return 'text/csv', _get_csv(rows)
+        return 'application/json', json.dumps({
+            'rows': rows,
+            'contexts': [(compat.to_str(context), frequency) for
+                         context, frequency in
+                         match_contexts.get_ordered_contexts()],
+        })
+
+
+def _get_csv(rows):
+    csv_file = StringIO()
+    csv.writer(csv_file).writerows(rows)
+    return csv_file.getvalue()
+
+
+class ExtractionRequestHandler(BaseHTTPRequestHandler):
+    """GET /status describes the loaded files, POST /extract runs a query."""
+    def do_GET(self):
+        if self.path != '/status':
+            self._send(404, 'text/plain', 'Not found\n')
+            return
+        self._send(200, 'application/json',
+                   json.dumps(self.server.corpus.get_status()))
+
+    def do_POST(self):
+        if self.path != '/extract':
+            self._send(404, 'text/plain', 'Not found\n')
+            return
+        try:
+            content_length = int(self.headers.get('content-length', 0))
+            query = json.loads(compat.to_str(
+                self.rfile.read(content_length)))
+            if not isinstance(query, dict):
+                raise QueryError('Expected a JSON object.')
+            content_type, body = self.server.corpus.query(query)
+        except (QueryError, ValueError) as e:
+            self._send(400, 'text/plain', '%s\n' % e)
+            return
+        except Exception:
+            logging.exception('Query failed')
+            self._send(500, 'text/plain', 'Internal server error\n')
+            return
+        self._send(200, content_type, body)
+
+    def _send(self, status, content_type, body):
+        body = compat.to_bytes(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+def main(input_filenames, input_format, host, port):
+    corpus = ExtractionCorpus(input_filenames, input_format)
+    server = HTTPServer((host, port), ExtractionRequestHandler)
+    server.corpus = corpus
+    print('Serving %d files on http://%s:%d' % (len(input_filenames), host,
+                                                port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_filenames', nargs='+',
+                        help=('Paths to RPDR formatted text files, e.g. '
+                              '/Users/user1/../file.txt'))
+    parser.add_argument(
+        '--input_format', default='rpdr',
+        choices=sorted(extract_values.NOTE_READERS),
+        help='Format of the input files. Defaults to rpdr.')
+    parser.add_argument('--host', default='127.0.0.1', help=(
+        'Address to listen on. Defaults to 127.0.0.1 so only local clients '
+        'can connect.'))
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on. Defaults to 8765.')
+    parser.add_argument('--verbosity', '-v', action='count')
+    args = parser.parse_args()
+
+    if args.verbosity:
+        logging.basicConfig(level=logging.INFO)
+
+    main(args.input_filenames, args.input_format, args.host, args.port)
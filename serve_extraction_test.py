@@ -0,0 +1,209 @@
+import csv
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from httplib import HTTPConnection
+    from StringIO import StringIO
+except ImportError:
+    from http.client import HTTPConnection
+    from io import StringIO
+
+import compat
+import extract_values
+import note_index
+import serve_extraction
+
+RPDR_NOTES = (
+    b'EMPI|MRN_Type|MRN|Report_Number|Report_Date_Time|Report_Description|'
+    b'Report_Type|Report_Text\n'
+    b'1|MGH|11|R1|05/01/2016|Echo|CAR|\n'
+    b'EF is 40, on vent\n'
+    b'[report_end]\n'
+    b'2|MGH|22|R2|05/02/2016|Note|PRG|\n'
+    b'no vent. ef 55\n'
+    b'[report_end]\n'
+    b'3|MGH|33|R3|05/03/2016|Note|PRG|\n'
+    b'nothing here\n'
+    b'[report_end]\n')
+
+
+class TestExtractionCorpus(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        self.corpus = serve_extraction.ExtractionCorpus([self.rpdr_filename])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _get_rows(self, query):
+        content_type, body = self.corpus.query(query)
+        self.assertEqual('application/json', content_type)
+        return json.loads(body)['rows']
+
+    def test_rows(self):
+        content_type, body = self.corpus.query({
+            'phrases': ['ef'], 'phrase_type': 'num',
+            'show_n_words_context_before': 1})
+        result = json.loads(body)
+        self.assertEqual(
+            [['1', 'MGH', '11', 'CAR', 'R1', '05/01/2016', 40.0],
+             ['2', 'MGH', '22', 'PRG', 'R2', '05/02/2016', 55.0],
+             ['3', 'MGH', '33', 'PRG', 'R3', '05/03/2016', None]],
+            result['rows'])
+        self.assertEqual([[' ef 55', 1], [' EF is 40', 1]],
+                         sorted(result['contexts'], reverse=True))
+
+    def test_csv(self):
+        content_type, body = self.corpus.query({
+            'phrases': 'ef,vent', 'output': 'csv'})
+        self.assertEqual('text/csv', content_type)
+        self.assertEqual([['1', 'MGH', '11', 'CAR', 'R1', '05/01/2016', '1'],
+                          ['2', 'MGH', '22', 'PRG', 'R2', '05/02/2016', '1'],
+                          ['3', 'MGH', '33', 'PRG', 'R3', '05/03/2016', '']],
+                         list(csv.reader(StringIO(body))))
+
+    def test_turk(self):
+        content_type, body = self.corpus.query({
+            'phrases': ['vent'], 'output': 'turk', 'context_size': 1,
+            'num_negative_turk_matches_to_show': 1})
+        self.assertEqual('text/csv', content_type)
+        rows = list(csv.reader(StringIO(body)))
+        self.assertEqual(extract_values.TURK_CSV_HEADER, rows[0])
+        self.assertEqual([('1', 'R1'), ('1', 'R2'), ('', 'R3')],
+                         [(row[1], row[3]) for row in rows[1:]])
+        self.assertIn("<span class='highlight'> vent", rows[1][0])
+
+    def test_report_filters(self):
+        self.assertEqual(['R1'], [row[4] for row in self._get_rows({
+            'phrases': ['ef'], 'report_type': 'CAR'})])
+        self.assertEqual(['R2', 'R3'], [row[4] for row in self._get_rows({
+            'phrases': ['ef'], 'report_description': 'Note'})])
+
+    def test_repeated_query_is_cached(self):
+        query = {'phrases': ['ef'], 'phrase_type': 'num'}
+        self.assertIs(self.corpus.query(query), self.corpus.query(query))
+        self.assertEqual(1, self.corpus.get_status()['num_cached_results'])
+
+    def test_invalid_queries(self):
+        for query in [
+                {},
+                {'phrases': []},
+                {'phrases': [1]},
+                {'phrases': ['(']},
+                {'phrases': ['ef'], 'phrase_type': 'number'},
+                {'phrases': ['ef'], 'phrase_type': ['num']},
+                {'phrases': ['ef'], 'output': 'xml'},
+                {'phrases': ['ef'], 'aggregate': 'median'},
+                {'phrases': ['ef'], 'aggregate': 'mean'},
+                {'phrases': ['ef'], 'report_type': 1},
+                {'phrases': ['ef'], 'context_size': 'ten'},
+                {'phrases': ['ef'], 'input_filenames': self.rpdr_filename},
+                {'phrases': ['ef'], 'input_filenames': ['other.txt']}]:
+            self.assertRaises(serve_extraction.QueryError, self.corpus.query,
+                              query)
+
+
+class TestIndexedExtractionCorpus(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        note_index.build_index(
+            self.rpdr_filename,
+            note_index.get_default_index_filename(self.rpdr_filename))
+        self.corpus = serve_extraction.ExtractionCorpus([self.rpdr_filename])
+
+    def tearDown(self):
+        for rpdr_note_index in self.corpus.filename_to_note_index.values():
+            rpdr_note_index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_result_as_scanning_notes(self):
+        self.assertTrue(self.corpus.get_status()['files'][0]['indexed'])
+        rpdr_note_index = self.corpus.filename_to_note_index[
+            self.rpdr_filename]
+        indexed_phrases = []
+        find_phrase = rpdr_note_index.find_phrase
+
+        def record_find_phrase(phrase):
+            indexed_phrases.append(phrase)
+            return find_phrase(phrase)
+
+        rpdr_note_index.find_phrase = record_find_phrase
+        query = {'phrases': ['vent', 'ef'], 'show_n_words_context_before': 1}
+        indexed_result = json.loads(self.corpus.query(query)[1])
+        self.assertEqual([b'vent', b'ef'], indexed_phrases)
+        del self.corpus.filename_to_note_index[self.rpdr_filename]
+        self.corpus.cached_results.clear()
+        self.assertEqual(json.loads(self.corpus.query(query)[1]),
+                         indexed_result)
+        rpdr_note_index.close()
+
+
+class FailingCorpus(object):
+    def query(self, query):
+        raise RuntimeError('unexpected')
+
+
+class TestExtractionRequestHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        self.server = serve_extraction.HTTPServer(
+            ('127.0.0.1', 0), serve_extraction.ExtractionRequestHandler)
+        self.server.corpus = serve_extraction.ExtractionCorpus(
+            [rpdr_filename])
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _post(self, body):
+        connection = HTTPConnection('127.0.0.1', self.server.server_port)
+        try:
+            connection.request('POST', '/extract', compat.to_bytes(body))
+            response = connection.getresponse()
+            return response.status, compat.to_str(response.read())
+        finally:
+            connection.close()
+
+    def test_query(self):
+        status, body = self._post(json.dumps({'phrases': ['vent']}))
+        self.assertEqual(200, status)
+        self.assertEqual(3, len(json.loads(body)['rows']))
+
+    def test_invalid_queries(self):
+        for body in ['not json', '[]', '{"phrases": ["("]}',
+                     '{"phrases": [1]}']:
+            status, _ = self._post(body)
+            self.assertEqual(400, status)
+
+    def test_unexpected_error(self):
+        self.server.corpus = FailingCorpus()
+        logging.disable(logging.ERROR)
+        try:
+            status, body = self._post(json.dumps({'phrases': ['vent']}))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(500, status)
+        self.assertEqual('Internal server error\n', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,390 @@
+"""Keep parsed notes in OS shared memory for concurrent extraction processes.
+
+create_shared_corpus parses notes files once and writes the note text and a
+table of note offsets and header values to a file in /dev/shm. Every
+extract_values.py --shared_corpus process, and each of their --workers
+processes, maps that file read-only instead of parsing its own copy of the
+notes, so the note text is held in memory once however many processes use
+it. Notes read from the corpus only hold their offsets, and their text is
+read from the shared mapping when it is used.
+
+    python shared_corpus.py create lno2016 /path/to/notes_*.txt
+    python extract_values.py --shared_corpus lno2016 --phrases EF --workers 8
+    python shared_corpus.py remove lno2016
+
+The corpus stays in shared memory until it is removed or the host restarts.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import tempfile
+
+import compat
+import extract_values
+import memory_budget as memory_budget_module
+import profiling
+
+CORPUS_VERSION = 1
+
+MAGIC = b'RXCORPUS'
+
+# Magic, version, number of notes and the offsets of the note table, header
+# values and metadata.
+HEADER_FORMAT = '<8sIQQQQ'
+# Start and end offsets of the note text and of its header values, and the
+# note id (-1 for None).
+NOTE_FORMAT = '<QQQQq'
+
+# Header values of a note, in the order they are stored.
+KEY_ATTRIBUTES = ['empi', 'mrn_type', 'mrn', 'report_type', 'report_number',
+                  'report_description', 'report_date', 'source_filename']
+KEY_SEPARATOR = b'\x1f'
+NONE_KEY = b'\x1e'
+
+CORPUS_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def _get_shared_memory_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def get_corpus_filename(corpus_name):
+    if not CORPUS_NAME_RE.match(corpus_name):
+        raise ValueError('Invalid shared corpus name %s. Use only letters, '
+                         'digits, ".", "_" and "-".' % corpus_name)
+    return os.path.join(_get_shared_memory_dir(),
+                        'regex_extraction_%s.corpus' % corpus_name)
+
+
+def _encode_keys(rpdr_note):
+    return KEY_SEPARATOR.join(
+        NONE_KEY if getattr(rpdr_note, attribute) is None else
+        compat.to_bytes(getattr(rpdr_note, attribute))
+        for attribute in KEY_ATTRIBUTES)
+
+
+def create_shared_corpus(corpus_name, input_filenames, input_format='rpdr'):
+    """Parse the notes of input_filenames into a new shared corpus named
+    corpus_name, replacing any corpus with that name, and return the number
+    of notes."""
+    corpus_filename = get_corpus_filename(corpus_name)
+    temp_filename = corpus_filename + '.tmp'
+    header_size = struct.calcsize(HEADER_FORMAT)
+    note_table = bytearray()
+    keys_data = bytearray()
+    num_notes = 0
+    with open(temp_filename, 'wb') as corpus_file:
+        corpus_file.write(b'\0' * header_size)
+        text_offset = header_size
+        for rpdr_note in extract_values._iterate_notes_from_files(
+                input_filenames, input_format):
+            note = rpdr_note.note
+            keys = _encode_keys(rpdr_note)
+            corpus_file.write(note)
+            note_table.extend(struct.pack(
+                NOTE_FORMAT, text_offset, text_offset + len(note),
+                len(keys_data), len(keys_data) + len(keys),
+                -1 if rpdr_note.note_id is None else rpdr_note.note_id))
+            keys_data.extend(keys)
+            text_offset += len(note)
+            num_notes += 1
+        # Offsets of header values are made absolute once the text size is
+        # known.
+        keys_offset = text_offset
+        corpus_file.write(keys_data)
+        table_offset = keys_offset + len(keys_data)
+        note_size = struct.calcsize(NOTE_FORMAT)
+        for note_number in compat.xrange(num_notes):
+            (text_start, text_end, keys_start, keys_end, note_id) = (
+                struct.unpack_from(NOTE_FORMAT, note_table,
+                                   note_number * note_size))
+            corpus_file.write(struct.pack(
+                NOTE_FORMAT, text_start, text_end, keys_offset + keys_start,
+                keys_offset + keys_end, note_id))
+        metadata_offset = table_offset + num_notes * note_size
+        corpus_file.write(compat.to_bytes(json.dumps({
+            'input_filenames': input_filenames,
+            'input_format': input_format,
+        })))
+        corpus_file.seek(0)
+        corpus_file.write(struct.pack(
+            HEADER_FORMAT, MAGIC, CORPUS_VERSION, num_notes, table_offset,
+            keys_offset, metadata_offset))
+    os.rename(temp_filename, corpus_filename)
+    return num_notes
+
+
+def remove_shared_corpus(corpus_name):
+    os.remove(get_corpus_filename(corpus_name))
+    _attached_corpora.pop(corpus_name, None)
+
+
+class SharedRPDRNote(extract_values.RPDRNote):
+    """An RPDRNote whose text is read from a SharedCorpus each time it is
+    used, unless the text has been replaced, e.g. by
+    remove_punctuation_from_note.
+
+    Pickled notes refer to the corpus by name, so they stay small.
+    """
+    __slots__ = ('corpus', 'note_number', 'text_start', 'text_end',
+                 'note_override')
+
+    @property
+    def note(self):
+        if self.note_override is not None:
+            return self.note_override
+        return self.corpus.data[self.text_start:self.text_end]
+
+    @note.setter
+    def note(self, note):
+        self.note_override = note
+
+    def get_note_length(self):
+        if self.note_override is not None:
+            return len(self.note_override)
+        return self.text_end - self.text_start
+
+    def __reduce__(self):
+        return (_get_shared_note, (self.corpus.corpus_name, self.note_number,
+                                   self.note_override))
+
+
+def _get_shared_note(corpus_name, note_number, note_override=None):
+    rpdr_note = attach_shared_corpus(corpus_name).get_note(note_number)
+    rpdr_note.note_override = note_override
+    return rpdr_note
+
+
+class SharedCorpus(object):
+    """A read-only mapping of a corpus written by create_shared_corpus."""
+    def __init__(self, corpus_name):
+        self.corpus_name = corpus_name
+        corpus_filename = get_corpus_filename(corpus_name)
+        if not os.path.exists(corpus_filename):
+            raise ValueError('Shared corpus %s does not exist. Create it with '
+                             'shared_corpus.py create' % corpus_name)
+        with open(corpus_filename, 'rb') as corpus_file:
+            self.data = mmap.mmap(corpus_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        (magic, version, self.num_notes, self.table_offset, keys_offset,
+         metadata_offset) = struct.unpack_from(HEADER_FORMAT, self.data)
+        if magic != MAGIC or version != CORPUS_VERSION:
+            raise ValueError('Shared corpus %s has an unexpected format. '
+                             'Create it again with shared_corpus.py create' %
+                             corpus_name)
+        metadata = json.loads(compat.to_str(self.data[metadata_offset:]))
+        # json returns unicode filenames under Python 2.
+        self.input_filenames = [
+            compat.to_str(compat.to_bytes(filename))
+            for filename in metadata['input_filenames']]
+        self.input_format = str(metadata['input_format'])
+        self.note_size = struct.calcsize(NOTE_FORMAT)
+
+    def __len__(self):
+        return self.num_notes
+
+    def get_note(self, note_number):
+        (text_start, text_end, keys_start, keys_end, note_id) = (
+            struct.unpack_from(NOTE_FORMAT, self.data,
+                               self.table_offset + note_number *
+                               self.note_size))
+        rpdr_note = SharedRPDRNote.__new__(SharedRPDRNote)
+        for attribute, key in zip(
+                KEY_ATTRIBUTES,
+                self.data[keys_start:keys_end].split(KEY_SEPARATOR)):
+            if key == NONE_KEY:
+                key = None
+            elif attribute == 'source_filename':
+                # Filenames are native strings, unlike the note keys.
+                key = extract_values._intern(compat.to_str(key))
+            else:
+                key = extract_values._intern(key)
+            setattr(rpdr_note, attribute, key)
+        rpdr_note.note_id = None if note_id == -1 else note_id
+        rpdr_note.corpus = self
+        rpdr_note.note_number = note_number
+        rpdr_note.text_start = text_start
+        rpdr_note.text_end = text_end
+        rpdr_note.note_override = None
+        return rpdr_note
+
+    def __iter__(self):
+        for note_number in compat.xrange(self.num_notes):
+            yield self.get_note(note_number)
+
+
+_attached_corpora = {}  # corpus name to SharedCorpus, for this process
+
+
+def attach_shared_corpus(corpus_name):
+    """Return the SharedCorpus named corpus_name, mapping it into this
+    process the first time."""
+    if corpus_name not in _attached_corpora:
+        _attached_corpora[corpus_name] = SharedCorpus(corpus_name)
+    return _attached_corpora[corpus_name]
+
+
+def _iterate_notes_reading_text_once(rpdr_notes):
+    """Yield rpdr_notes with their text copied out of the corpus once while
+    each note is matched, instead of on every use, and released when the
+    next note is read."""
+    for rpdr_note in rpdr_notes:
+        rpdr_note.note = rpdr_note.note
+        yield rpdr_note
+        rpdr_note.note = None
+
+
+def _find_note_matches(args):
+    """Return, for each note number, a list of (match_start, match_end,
+    phrase, extracted_value) for its matches, the context frequencies of the
+    matches and the slow notes found if log_slow_notes is given. Run in
+    worker processes."""
+    (corpus_name, note_numbers, phrase_type, phrases, ignore_punctuation,
+     show_n_words_context_before, show_n_words_context_after,
+     deduplicate_text, log_slow_notes) = args
+    shared_corpus = attach_shared_corpus(corpus_name)
+    rpdr_notes = _iterate_notes_reading_text_once(
+        shared_corpus.get_note(note_number) for note_number in note_numbers)
+    if ignore_punctuation:
+        rpdr_notes = extract_values._iterate_notes_without_punctuation(
+            rpdr_notes)
+    match_contexts = extract_values.PhraseMatchContexts(
+        show_n_words_context_before, show_n_words_context_after)
+    slow_note_log = None
+    if log_slow_notes:
+        slow_note_log = profiling.SlowNoteLog(log_slow_notes)
+    note_matches = []
+    for phrase_matches in extract_values._iterate_phrase_matches(
+            rpdr_notes, phrase_type, phrases, match_contexts,
+            deduplicate_text=deduplicate_text, slow_note_log=slow_note_log):
+        note_matches.append(phrase_matches.get_matches())
+    slow_notes = None
+    if slow_note_log is not None:
+        slow_notes = slow_note_log.get_slow_notes()
+    return note_matches, match_contexts.context_frequencies, slow_notes
+
+
+def iterate_phrase_matches(
+        shared_corpus, rpdr_notes, phrase_type, phrases, ignore_punctuation,
+        show_n_words_context_before, show_n_words_context_after, workers,
+        patient_aggregator=None, deduplicate_text=False, max_contexts=None,
+        slow_note_log=None, match_table=None):
+    """Yield the same NotePhraseMatches as
+    extract_values.ExtractionQuery.iterate_phrase_matches for rpdr_notes,
+    notes of shared_corpus, searching them in workers processes that each
+    map the corpus. Only note numbers and matches are passed between
+    processes. The match contexts are printed once all notes are searched."""
+    if ignore_punctuation:
+        phrases = [extract_values._remove_punctuation(phrase)
+                   for phrase in phrases]
+    rpdr_notes = list(rpdr_notes)
+    num_chunks = min(len(rpdr_notes), workers * 4) or 1
+    chunk_size = -(-len(rpdr_notes) // num_chunks)
+    note_chunks = [rpdr_notes[i:i + chunk_size]
+                   for i in compat.xrange(0, len(rpdr_notes), chunk_size)]
+    match_contexts = extract_values.PhraseMatchContexts(
+        show_n_words_context_before, show_n_words_context_after)
+    log_slow_notes = None
+    if slow_note_log is not None:
+        log_slow_notes = slow_note_log.max_notes
+    pool = multiprocessing.Pool(workers)
+    try:
+        chunk_results = pool.imap(_find_note_matches, [
+            (shared_corpus.corpus_name,
+             [rpdr_note.note_number for rpdr_note in note_chunk],
+             phrase_type, phrases, ignore_punctuation,
+             show_n_words_context_before, show_n_words_context_after,
+             deduplicate_text, log_slow_notes) for note_chunk in note_chunks])
+        for note_chunk, (note_matches, context_frequencies, slow_notes) in (
+                zip(note_chunks, chunk_results)):
+            if slow_notes is not None:
+                slow_note_log.add_slow_notes(slow_notes)
+            for context, frequency in context_frequencies.items():
+                match_contexts.context_frequencies[context] = (
+                    match_contexts.context_frequencies.get(context, 0) +
+                    frequency)
+            for rpdr_note, matches in zip(note_chunk, note_matches):
+                if ignore_punctuation:
+                    # Match offsets are for the note without punctuation.
+                    rpdr_note.remove_punctuation_from_note()
+                phrase_matches = extract_values.NotePhraseMatches(
+                    rpdr_note, match_table)
+                for match_start, match_end, phrase, extracted_value in (
+                        matches):
+                    phrase_matches.add_match(extracted_value, match_start,
+                                             match_end, phrase)
+                phrase_matches.finalize_phrase_matches()
+                if patient_aggregator is not None:
+                    patient_aggregator.add_note_phrase_matches(phrase_matches)
+                yield phrase_matches
+    finally:
+        pool.close()
+        pool.join()
+    match_contexts.print_ordered_contexts(max_contexts)
+
+
+def find_phrase_matches(
+        shared_corpus, rpdr_notes, phrase_type, phrases, ignore_punctuation,
+        show_n_words_context_before, show_n_words_context_after, workers,
+        patient_aggregator=None, memory_budget=None, deduplicate_text=False,
+        max_contexts=None, slow_note_log=None):
+    """Return a list of the NotePhraseMatches of iterate_phrase_matches, or
+    with memory_budget, a SpillList of them."""
+    if memory_budget is None:
+        match_table = extract_values.PhraseMatchTable(phrase_type)
+        note_phrase_matches = []
+    else:
+        match_table = None
+        note_phrase_matches = memory_budget_module.SpillList(
+            memory_budget, extract_values._get_note_phrase_matches_size)
+    for phrase_matches in iterate_phrase_matches(
+            shared_corpus, rpdr_notes, phrase_type, phrases,
+            ignore_punctuation, show_n_words_context_before,
+            show_n_words_context_after, workers, patient_aggregator,
+            deduplicate_text, max_contexts, slow_note_log, match_table):
+        note_phrase_matches.append(phrase_matches)
+    return note_phrase_matches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    create_parser = subparsers.add_parser(
+        'create', help='Parse notes files into a shared corpus.')
+    create_parser.add_argument('corpus_name', help=(
+        'Name of the corpus, passed to extract_values.py --shared_corpus.'))
+    create_parser.add_argument(
+        'input_filenames', nargs='+', help=(
+            'Paths to RPDR formatted text files, directories or glob '
+            'patterns, as for extract_values.py.'))
+    create_parser.add_argument(
+        '--input_format', default='rpdr',
+        choices=sorted(extract_values.NOTE_READERS),
+        help='Format of the input files. Defaults to rpdr.')
+    remove_parser = subparsers.add_parser(
+        'remove', help='Remove a shared corpus, freeing its memory.')
+    remove_parser.add_argument('corpus_name')
+    parser.add_argument('--verbosity', '-v', action='count')
+    args = parser.parse_args()
+
+    if args.verbosity:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'create':
+        input_filenames = extract_values._expand_input_filenames(
+            args.input_filenames)
+        num_notes = create_shared_corpus(args.corpus_name, input_filenames,
+                                         args.input_format)
+        print('Loaded %d notes into %s' % (
+            num_notes, get_corpus_filename(args.corpus_name)))
+    else:
+        remove_shared_corpus(args.corpus_name)
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import compat
+import extract_values
+import shared_corpus
+
+RPDR_NOTES = (
+    b'EMPI|MRN_Type|MRN|Report_Number|Report_Date_Time|Report_Description|'
+    b'Report_Type|Report_Text\n'
+    b'1|MGH|1|R1|05/01/2016|Note|PRG|\n'
+    b'EF is 40, on vent.\n'
+    b'[report_end]\n'
+    b'2|MGH|2|R2|05/02/2016||CAR|\n'
+    b'No echo.\n'
+    b'[report_end]\n'
+    b'2|MGH|2|R3|05/03/2016|Echo|CAR|\n'
+    b'ejection fraction: 55, ef 60\n'
+    b'[report_end]\n')
+
+
+class TestSharedCorpus(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpdr_filename = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(self.rpdr_filename, 'wb') as rpdr_file:
+            rpdr_file.write(RPDR_NOTES)
+        self.corpus_name = 'test_%d' % os.getpid()
+        shared_corpus.create_shared_corpus(self.corpus_name,
+                                           [self.rpdr_filename])
+        self.corpus = shared_corpus.attach_shared_corpus(self.corpus_name)
+
+    def tearDown(self):
+        shared_corpus.remove_shared_corpus(self.corpus_name)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_notes_match_parsed_notes(self):
+        rpdr_notes = extract_values._read_notes(self.rpdr_filename)
+        self.assertEqual([self.rpdr_filename], self.corpus.input_filenames)
+        self.assertEqual(
+            [(rpdr_note.get_keys(), rpdr_note.report_description,
+              rpdr_note.source_filename, rpdr_note.note_id, rpdr_note.note)
+             for rpdr_note in rpdr_notes],
+            [(rpdr_note.get_keys(), rpdr_note.report_description,
+              rpdr_note.source_filename, rpdr_note.note_id, rpdr_note.note)
+             for rpdr_note in self.corpus])
+
+    def test_note_text_is_read_once(self):
+        rpdr_notes = list(shared_corpus._iterate_notes_reading_text_once(
+            self.corpus))
+        self.assertEqual(
+            [len(rpdr_note.note) for rpdr_note in rpdr_notes],
+            [rpdr_note.get_note_length() for rpdr_note in rpdr_notes])
+        self.assertEqual([None] * len(rpdr_notes),
+                         [rpdr_note.note_override for rpdr_note in rpdr_notes])
+        for rpdr_note in shared_corpus._iterate_notes_reading_text_once(
+                self.corpus):
+            self.assertIsNotNone(rpdr_note.note_override)
+
+    def test_pickled_notes_refer_to_corpus(self):
+        rpdr_note = self.corpus.get_note(2)
+        pickled_note = compat.pickle.dumps(rpdr_note,
+                                           compat.pickle.HIGHEST_PROTOCOL)
+        self.assertTrue(rpdr_note.note not in pickled_note)
+        self.assertEqual(rpdr_note.note,
+                         compat.pickle.loads(pickled_note).note)
+        rpdr_note.remove_punctuation_from_note()
+        self.assertEqual(
+            b'ejection fraction 55 ef 60\nreportend\n',
+            compat.pickle.loads(compat.pickle.dumps(
+                rpdr_note, compat.pickle.HIGHEST_PROTOCOL)).note)
+
+    def test_workers_find_same_matches(self):
+        phrases = [b'ef', b'ejection fraction']
+        expected_rows = extract_values._get_csv_output_rows(
+            extract_values._find_phrase_matches(
+                extract_values._read_notes(self.rpdr_filename),
+                extract_values.PHRASE_TYPE_NUM, phrases,
+                extract_values.PhraseMatchContexts(0, 0)))
+        self.assertEqual(expected_rows, extract_values._get_csv_output_rows(
+            shared_corpus.find_phrase_matches(
+                self.corpus, self.corpus, extract_values.PHRASE_TYPE_NUM,
+                phrases, False, 0, 0, 2)))
+
+
+if __name__ == '__main__':
+    unittest.main()